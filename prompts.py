@@ -1,4 +1,5 @@
 import json
+import math
 from src.application.services.assets.autonomous_complete_game.utils import (
     symbol_asset_structure, asset_structure, asset_format_string
 )
@@ -152,7 +153,56 @@ def get_audio_asset_instructions():
     return system_instruction, user_prompt
 
 # ----- re-design -----
-def get_redesign_symbols_instructions(game_story_design_data, decompose_data):
+# All four redesign calls share one byte-identical prefix: the common system text followed by the
+# serialized style guide. The asset-specific directives come after it, and the blueprint goes into
+# the user prompt, so provider-side prefix caches can reuse the style guide across calls and runs.
+# Pass with_stats=True to a builder to also get its token estimates as a third return value.
+REDESIGN_SHARED_SYSTEM_PREFIX = (
+    "You are part of a pipeline that redesigns every asset of an existing slot game (symbols, main scene, popups and audio) "
+    "to a new creative mandate. The 'NEW GAME STORY DESIGN' below is the single source of truth for the new theme, story, "
+    "characters, color palette, materials, mood and pace. Every rewritten description must strictly conform to it."
+)
+
+CHARS_PER_TOKEN = 4  # rough average for English prose and pretty-printed JSON
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token); good enough for budgeting and cache accounting."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def serialize_json(data):
+    """
+    Pretty-printed JSON in the data's own key order. Serializing a few kilobytes of style guide is
+    cheap, so it is not memoized: an in-place edit of the data is always reflected in the prompt.
+    """
+    return json.dumps(data, indent=2)
+
+def prompt_stats(system, user_prompt, shared_prefix=""):
+    """Token estimates for one (system, user) prompt pair."""
+    return {
+        "shared_prefix_tokens": estimate_tokens(shared_prefix),
+        "system_tokens": estimate_tokens(system),
+        "user_tokens": estimate_tokens(user_prompt),
+        "total_tokens": estimate_tokens(system) + estimate_tokens(user_prompt),
+    }
+
+def get_redesign_shared_prefix(game_story_design_data):
+    """The byte-identical system prefix shared by all redesign calls for one style guide."""
+    return (
+        f"{REDESIGN_SHARED_SYSTEM_PREFIX}\n\n"
+        f"[NEW GAME STORY DESIGN (Style Guide)]\n"
+        f"{serialize_json(game_story_design_data)}\n\n"
+        f"[ASSET-SPECIFIC DIRECTIVES]\n"
+    )
+
+def _assemble_redesign(game_story_design_data, system_instruction, user_prompt, with_stats):
+    prefix = get_redesign_shared_prefix(game_story_design_data)
+    system = prefix + system_instruction
+    if with_stats:
+        return system, user_prompt, prompt_stats(system, user_prompt, prefix)
+    return system, user_prompt
+
+def get_redesign_symbols_instructions(game_story_design_data, decompose_data, with_stats=False):
     """
     Generates prompts for redesigning the slot symbol assets found in the rules screen.
     """
@@ -168,22 +218,19 @@ def get_redesign_symbols_instructions(game_story_design_data, decompose_data):
 
     REDESIGN_SYMBOLS_USER_PROMPT = f"""
     [TASK START]
-    Rewrite the asset descriptions in the 'ASSET BLUEPRINT' JSON. The new descriptions must transform the original symbol concepts to match the visual and thematic style defined in the 'NEW GAME STORY DESIGN'.
+    Rewrite the asset descriptions in the 'ASSET BLUEPRINT' JSON. The new descriptions must transform the original symbol concepts to match the visual and thematic style defined in the 'NEW GAME STORY DESIGN' (see the system instruction).
 
     **Example Transformation Principle:**
     If the ASSET BLUEPRINT has a 'Low Value Symbol' described as "A simple red cherry icon," and the NEW GAME STORY DESIGN has a theme of "Cyberpunk Dystopia," the new 'description_for_generator' should be rewritten to something like: "A glitching, low-resolution pixel art image of a neon-magenta skull, reflecting the analog static of a dying screen."
 
-    [NEW GAME STORY DESIGN (Style Guide)]
-    {json.dumps(game_story_design_data, indent=2)}
-
     [ASSET BLUEPRINT (Symbol Data to be Transformed)]
-    {json.dumps(decompose_data, indent=2)}
+    {serialize_json(decompose_data)}
 
     GENERATE ONLY THE REDESIGNED JSON OBJECT NOW.
     """
-    return REDESIGN_SYMBOLS_SYSTEM_INSTRUCTION, REDESIGN_SYMBOLS_USER_PROMPT
+    return _assemble_redesign(game_story_design_data, REDESIGN_SYMBOLS_SYSTEM_INSTRUCTION, REDESIGN_SYMBOLS_USER_PROMPT, with_stats)
 
-def get_redesign_mainscene_instructions(game_story_design_data, decompose_data):
+def get_redesign_mainscene_instructions(game_story_design_data, decompose_data, with_stats=False):
     """
     Generates prompts for redesigning all UI, frames, backgrounds, and characters 
     visible in the main gameplay screen.
@@ -201,7 +248,7 @@ def get_redesign_mainscene_instructions(game_story_design_data, decompose_data):
 
     REDESIGN_MAINSCENES_USER_PROMPT = f"""
     [TASK START]
-    Rewrite the asset descriptions in the 'ASSET BLUEPRINT' JSON below. The new descriptions must transform the assets to match the visual and thematic style defined in the 'NEW GAME STORY DESIGN'.
+    Rewrite the asset descriptions in the 'ASSET BLUEPRINT' JSON below. The new descriptions must transform the assets to match the visual and thematic style defined in the 'NEW GAME STORY DESIGN' (see the system instruction).
 
     **Key Transformation Rules:**
     * **Character Redesign:** The description for the character asset must generate the character/mascot **ONLY**. If the asset represents a human or humanoid, the description **MUST** detail the **full body** (isolated from any frame or background).
@@ -209,17 +256,14 @@ def get_redesign_mainscene_instructions(game_story_design_data, decompose_data):
     * **Color/Theme:** Update all metallic/material descriptions (borders, panels, bases) to match the `color_palette` and `geology_feature` described in the new main scene design.
     * **Scene:** The background scene description must strictly adhere to the new `scene_name`, `geology_feature`, and `color_palette`.
 
-    [NEW GAME STORY DESIGN (Style Guide)]
-    {json.dumps(game_story_design_data, indent=2)}
-
     [ASSET BLUEPRINT (Main Scene Data to be Transformed)]
-    {json.dumps(decompose_data, indent=2)}
+    {serialize_json(decompose_data)}
 
     GENERATE ONLY THE REDESIGNED JSON OBJECT NOW.
     """
-    return REDESIGN_MAINSCENES_SYSTEM_INSTRUCTION, REDESIGN_MAINSCENES_USER_PROMPT
+    return _assemble_redesign(game_story_design_data, REDESIGN_MAINSCENES_SYSTEM_INSTRUCTION, REDESIGN_MAINSCENES_USER_PROMPT, with_stats)
 
-def get_redesign_popups_instructions(game_story_design_data, decompose_data):
+def get_redesign_popups_instructions(game_story_design_data, decompose_data, with_stats=False):
     """
     Generates prompts for redesigning all UI, frames, and background assets 
     visible in the popups/modal screens.
@@ -237,7 +281,7 @@ def get_redesign_popups_instructions(game_story_design_data, decompose_data):
 
     REDESIGN_POPUPS_USER_PROMPT = f"""
     [TASK START]
-    Rewrite the asset descriptions in the 'ASSET BLUEPRINT' JSON below. The new descriptions must transform the modal panels, borders, buttons, and text elements to match the visual and thematic style defined in the 'NEW GAME STORY DESIGN'.
+    Rewrite the asset descriptions in the 'ASSET BLUEPRINT' JSON below. The new descriptions must transform the modal panels, borders, buttons, and text elements to match the visual and thematic style defined in the 'NEW GAME STORY DESIGN' (see the system instruction).
 
     **Key Transformation Rules:**
     * **Character Redesign:** The description for the character asset must generate the character/mascot **ONLY**. If the asset represents a human or humanoid, the description **MUST** detail the **full body** (isolated from any frame or background).
@@ -245,17 +289,14 @@ def get_redesign_popups_instructions(game_story_design_data, decompose_data):
     * **Color/Theme:** Update all borders and panel fills (especially those with '_filled' filenames) to align with the new game's aesthetic and color palette (e.g., transforming 'Glossy Gold' into 'Rusted Copper' if the theme is 'Post-Apocalyptic').
     * **Structure:** Maintain the distinction between '_frameonly' (transparent inner area) and '_filled' (opaque inner area) assets.
 
-    [NEW GAME STORY DESIGN (Style Guide)]
-    {json.dumps(game_story_design_data, indent=2)}
-
     [ASSET BLUEPRINT (Popup Scene Data to be Transformed)]
-    {json.dumps(decompose_data, indent=2)}
+    {serialize_json(decompose_data)}
 
     GENERATE ONLY THE REDESIGNED JSON OBJECT NOW.
     """
-    return REDESIGN_POPUPS_SYSTEM_INSTRUCTION, REDESIGN_POPUPS_USER_PROMPT
+    return _assemble_redesign(game_story_design_data, REDESIGN_POPUPS_SYSTEM_INSTRUCTION, REDESIGN_POPUPS_USER_PROMPT, with_stats)
 
-def get_redesign_audio_asset_instructions(game_story_design_data, decompose_data):
+def get_redesign_audio_asset_instructions(game_story_design_data, decompose_data, with_stats=False):
     REDESIGN_AUDIO_SYSTEM_INSTRUCTION = (
         "You are an **Expert Game Composer and Sound Designer Prompt Engineer**. Your task is to rewrite the audio descriptions "
         "to reflect a new creative mandate. You must transform the original audio concepts to match the new game's theme, mood, and pace."
@@ -270,21 +311,18 @@ def get_redesign_audio_asset_instructions(game_story_design_data, decompose_data
 
     REDESIGN_AUDIO_USER_PROMPT = f"""
     [TASK START]
-    Rewrite the audio asset descriptions in the 'ASSET BLUEPRINT' JSON below. The new descriptions must transform the BGM and SFX assets to match the sound and mood of the 'NEW GAME STORY DESIGN'.
+    Rewrite the audio asset descriptions in the 'ASSET BLUEPRINT' JSON below. The new descriptions must transform the BGM and SFX assets to match the sound and mood of the 'NEW GAME STORY DESIGN' (see the system instruction).
 
     **Key Transformation Rules:**
     * **BGM Pacing:** Analyze the video clip to determine the general pace and mood of the original game's normal and bonus rounds. Update the musical genre, instrumentation, and overall mood (prompts) to match the new story and character, ensuring the **Freespin track is faster and more intense** than the Normal track, and the **BPMs are adjusted** accordingly.
     * **SFX Texture:** Maintain the functional purpose of the sound (e.g., a spin button sound) but change its sonic texture to fit the new aesthetic (e.g., changing 'chime' to 'mechanical grind' or 'digital glitch').
 
-    [NEW GAME STORY DESIGN (Style Guide)]
-    {json.dumps(game_story_design_data, indent=2)}
-
     [ASSET BLUEPRINT (Audio Data to be Transformed)]
-    {json.dumps(decompose_data, indent=2)}
+    {serialize_json(decompose_data)}
 
     GENERATE ONLY THE REDESIGNED JSON OBJECT.
     """
-    return REDESIGN_AUDIO_SYSTEM_INSTRUCTION, REDESIGN_AUDIO_USER_PROMPT
+    return _assemble_redesign(game_story_design_data, REDESIGN_AUDIO_SYSTEM_INSTRUCTION, REDESIGN_AUDIO_USER_PROMPT, with_stats)
 
 # ----- validation -----
 DIGIT_EXTRACTOR_SYSTEM_INSTRUCTION = (
@@ -350,6 +388,30 @@ def get_character_extractor_prompts(description=None):
     else:
         return DIGIT_EXTRACTOR_SYSTEM_INSTRUCTION, DIGIT_EXTRACTOR_USER_PROMPT
 
+def get_background_validation_instructions(description):
+    system_instruction = (
+        "You are a **Game Background Quality Control Auditor**. Your sole task is to decide whether a generated "
+        "game background image is a **FULL-BLEED** composition that fills the entire canvas. "
+        "1. **Failure Definition:** The image FAILS if it has borders, frames, padding, solid-color bands, fade-outs, "
+        "vignetting, or transparent/empty areas along any edge. "
+        "2. **Strict Output:** Output **ONLY** a single, valid JSON object following the provided schema."
+    )
+    user_prompt = f"""
+    [TASK START]
+    Inspect the attached background image and decide whether it fills the entire canvas from edge to edge.
+
+    [INPUT DATA]
+    - **Generation Prompt:** "{description}"
+    - **Input Image:** [The attached image file]
+
+    [OUTPUT SCHEMA]
+    {{
+      "passed": true/false,
+      "error_details": "Describe which edge fails and how (e.g., 'Black fade-out along the bottom edge.'). If passed, state: 'N/A'"
+    }}
+    """
+    return system_instruction, user_prompt
+
 # ----- retry -----
 def get_background_enhanced_instructions(original_description):
     system_instruction = (
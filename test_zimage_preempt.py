@@ -0,0 +1,73 @@
+"""
+StepScheduler 交替推进多个任务时，开启步缓存的结果应与逐个单独生成一致。
+
+只用极小的随机 transformer 和 scheduler，不需要 tokenizer / 文本编码器 / VAE：
+    python -m pytest -q test_zimage_preempt.py
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from diffusers import FlowMatchEulerDiscreteScheduler
+
+from zimage_preempt import Job, StepScheduler
+from zimage_stepcache import enable_step_cache
+from zimage_tiny import build_tiny_transformer
+
+
+class LatentOnlyPipe:
+    """StepScheduler._prepare / _advance 用到的最小 pipeline：文本编码由 prompt 决定的随机张量代替"""
+
+    vae_scale_factor = 8
+
+    def __init__(self):
+        self.transformer = build_tiny_transformer(n_layers=4)
+        self.scheduler = FlowMatchEulerDiscreteScheduler()
+
+    def encode_prompt(self, prompt, device=None, do_classifier_free_guidance=False):
+        generator = torch.Generator().manual_seed(sum(map(ord, prompt)))
+        return [torch.randn(12, 16, generator=generator)], None
+
+
+def denoise(scheduler, jobs, order):
+    """按 order 给出的任务顺序逐步推进，返回各任务的最终 latents"""
+    for index in order:
+        scheduler._advance(jobs[index])
+    assert all(job.done for job in jobs)
+    return [job.latents.clone() for job in jobs]
+
+
+@pytest.fixture
+def scheduler():
+    pipe = LatentOnlyPipe()
+    # threshold 很大：预热之后尽可能跳步，让缓存的 residual 真正参与计算
+    enable_step_cache(pipe.transformer, threshold=10.0, max_consecutive=2)
+    scheduler = StepScheduler(pipe, device="cpu")
+    yield scheduler
+    scheduler.close()
+
+
+def make_jobs(steps):
+    return [
+        Job("a golden coin", 128, 128, steps=steps, seed=1),
+        Job("a blue gem", 128, 128, steps=steps, seed=2),
+    ]
+
+
+def test_interleaved_jobs_match_sequential_with_step_cache(scheduler):
+    steps = 6
+    sequential = denoise(scheduler, make_jobs(steps), [0] * steps + [1] * steps)
+    interleaved = denoise(scheduler, make_jobs(steps), [0, 1] * steps)
+    for expected, actual in zip(sequential, interleaved):
+        torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+
+
+def test_step_cache_skips_steps_per_job(scheduler):
+    steps = 6
+    jobs = make_jobs(steps)
+    denoise(scheduler, jobs, [0, 1] * steps)
+    for job in jobs:
+        report = job.step_cache_state["report"]
+        assert [r["step"] for r in report] == list(range(steps))
+        assert any(r["skipped"] for r in report)
@@ -0,0 +1,585 @@
+"""
+素材流水线编排：把 prompts.py 中的各个阶段串成一张 DAG，用 asyncio 并发执行。
+
+    story ────────────────┐
+    decompose_symbols ────┼─> redesign_symbols ───> generate_symbols ───> validate_symbols
+    decompose_mainscene ──┼─> redesign_mainscene ─> generate_mainscene ─> validate_mainscene
+    decompose_popups ─────┼─> redesign_popups ────> generate_popups ────> validate_popups
+    decompose_audio ──────┴─> redesign_audio
+
+- 互不依赖的分支并发运行；每个后端（llm / zimage）各有一个信号量限制同时进行的调用数，
+  Z-Image 默认 1（单卡），LLM 默认 8
+- 每个阶段的输出按 (阶段名, 参数, 上游输出, 后端) 的内容哈希记忆化到 MEMO_DIR，
+  重跑时只执行输入变化了的阶段；输出中引用的图片文件不存在时视为失效
+- 重设计得到的 description_for_generator 直接组成 Z-Image 批任务（generate_batch），
+  不再手工复制到 prompts.txt
+- 校验阶段：先用 zimage_prevalidate 对整组图片做本地打分。背景图明确通过/失败时不再调用
+  LLM 校验，失败的直接用 get_background_enhanced_instructions 改写 prompt 后重画；
+  透明底的含引号文字素材明确贴边时直接换种子重画（不透明的整幅素材无法本地判断），
+  否则调用文字校验（get_character_extractor_prompts）。
+  报告中统计本地判定省下的远程校验次数
+- StubLLM 按阶段返回确定的假数据，配合 --stub（StubPipeline）可以离线跑通整条流水线；
+  prompts.py 的外部依赖不可用时，--stub 下由 StubPrompts 代替提示词模板
+
+任务文件（JSON）：
+    {
+      "concept": "A steampunk airship heist ...",
+      "media": {"symbols": "rules.png", "mainscene": "main.png", "popups": "popup.png", "audio": "clip.mp4"},
+      "output_dir": "output/assets",
+      "seed": 0
+    }
+media 中缺少的分组不会运行。
+
+用法：
+    python zimage_assets.py job.json --stub                     # 离线：StubLLM + StubPipeline
+    python zimage_assets.py job.json --llm mypkg.llm:GeminiBackend
+"""
+import abc
+import argparse
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import re
+import time
+
+import zimage_loop_from_file as zl
+
+# ===== 配置区域 =====
+MEMO_DIR = os.path.join(".cache", "asset_stages")
+BACKEND_LIMITS = {"llm": 8, "zimage": 1}   # 每个后端同时进行的调用数
+MAX_RETRIES = 2                            # 校验失败后最多重画次数
+PREVALIDATE = True                         # 先做本地预校验，明确通过/失败的图片不再调用 LLM 校验
+ASSET_SIZES = [                            # 文件名包含关键字 -> 生成尺寸（宽, 高），其余用默认尺寸
+    ("background", (1536, 864)),
+    ("bg_", (1536, 864)),
+]
+STAGE_VERSION = 1                          # 修改阶段逻辑或 prompt 后递增，使旧的记忆化结果失效
+# ====================
+
+IMAGE_GROUPS = ("symbols", "mainscene", "popups")
+GROUPS = IMAGE_GROUPS + ("audio",)
+QUOTED_TEXT = re.compile(r"'([^']+)'")
+
+
+def parse_json(text):
+    """解析 LLM 返回的 JSON，容忍 ```json 代码块和前后多余文字"""
+    if isinstance(text, (dict, list)):
+        return text
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    try:
+        return json.loads(text)
+    except ValueError:
+        start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+        if start < 0:
+            raise
+        return json.JSONDecoder().raw_decode(text[start:])[0]
+
+def content_hash(value) -> str:
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def file_fingerprint(path):
+    """媒体文件的 (路径, 大小, 修改时间)，文件变化时记忆化结果随之失效"""
+    if not path or not os.path.exists(path):
+        return path
+    st = os.stat(path)
+    return [path, st.st_size, int(st.st_mtime)]
+
+def collect_assets(data, group: str):
+    """遍历重设计结果，取出所有带 description_for_generator 的素材"""
+    assets = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if node.get("description_for_generator"):
+                n = len(assets)
+                assets.append({
+                    "group": group,
+                    "filename": node.get("filename") or f"{group}_{n}.png",
+                    "description": node["description_for_generator"],
+                })
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(data)
+    return assets
+
+def asset_size(filename: str):
+    lowered = filename.lower()
+    for keyword, size in ASSET_SIZES:
+        if keyword in lowered:
+            return size
+    return zl.DEFAULT_WIDTH, zl.DEFAULT_HEIGHT
+
+def is_background(asset) -> bool:
+    name = asset["filename"].lower()
+    return "background" in name or name.startswith("bg_")
+
+def _outputs_exist(value) -> bool:
+    if isinstance(value, dict):
+        if "path" in value and isinstance(value["path"], str) and not os.path.exists(value["path"]):
+            return False
+        return all(_outputs_exist(v) for v in value.values())
+    if isinstance(value, list):
+        return all(_outputs_exist(v) for v in value)
+    return True
+
+
+# ----- 后端 -----
+class LLMBackend(abc.ABC):
+    """
+    LLM 后端接口。接入实际使用的客户端时继承并实现 complete()：
+    返回模型输出的文本（或已解析的 JSON）；media 为随消息附带的图片/视频路径列表。
+    没有实现 complete() 的子类在创建实例时就会报 TypeError，而不是跑到 DAG 中途才失败。
+    """
+    name = "llm"
+
+    @abc.abstractmethod
+    async def complete(self, system: str, user: str, media=None, stage: str = None):
+        """返回模型输出"""
+
+
+class StubLLM(LLMBackend):
+    """按阶段返回确定的假数据；重设计阶段会解析 prompt 中的 ASSET BLUEPRINT 并改写描述"""
+    name = "stub"
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = []
+
+    async def complete(self, system, user, media=None, stage=None):
+        self.calls.append(stage)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        kind = (stage or "").split(":")[0]
+        if kind == "story":
+            return json.dumps({
+                "storyline": "A crew of sky pirates chases a stolen clockwork heart across the clouds.",
+                "main_scene": {"scene_name": "Brass Sky Harbor", "color_palette": ["copper", "teal"], "geology_feature": "floating islands"},
+                "symbols": [{"symbol_type": "High", "appearance": "a brass airship captain"}],
+            })
+        if kind == "decompose_symbols":
+            return json.dumps({"symbols": [
+                {"filename": "sym_high_1.png", "symbol_type": "High", "description_for_generator": "A golden crown icon"},
+                {"filename": "sym_low_1.png", "symbol_type": "Low", "description_for_generator": "A simple red cherry icon"},
+                {"filename": "sym_wild.png", "symbol_type": "Wild", "description_for_generator": "A glowing emblem with the text 'WILD'"},
+            ]})
+        if kind == "decompose_mainscene":
+            return json.dumps({
+                "background": [{"filename": "main_background.png", "description_for_generator": "A jungle temple at dusk"}],
+                "ui": [{"filename": "btn_spin.png", "description_for_generator": "A round button with the text 'SPIN'"}],
+            })
+        if kind == "decompose_popups":
+            return json.dumps({"popups": [
+                {"filename": "popup_bigwin_filled.png", "description_for_generator": "A gold panel with the text 'BIG WIN'"},
+            ]})
+        if kind == "decompose_audio":
+            return json.dumps({
+                "bgm": [{"filename": "bgm_normal.mp3", "prompt1": "calm jungle drums", "prompt2": "", "bpm": 90}],
+                "sfx": [{"filename": "sfx_click.mp3", "description": "A coin clink.", "duration_seconds": 0.5}],
+            })
+        if kind == "redesign":
+            blueprint = parse_json(user.split("[ASSET BLUEPRINT", 1)[1].split("\n", 1)[1])
+            return json.dumps(self._restyle(blueprint))
+        if kind == "validate_bg":
+            return json.dumps({"passed": True, "error_details": "N/A"})
+        if kind == "validate":
+            required = QUOTED_TEXT.findall(user.split("**Generation Prompt:**", 1)[-1].split("\n", 1)[0])
+            return json.dumps({"passed": True, "required_text_list": required, "detected_text_list": required, "error_details": "N/A"})
+        if kind == "enhance":
+            original = user.split('"', 2)[1] if '"' in user else ""
+            return f"{original}, FULL-BLEED composition that fills the entire canvas from edge to edge, no borders, no fade-out, no vignette"
+        return "{}"
+
+    def _restyle(self, node):
+        if isinstance(node, dict):
+            out = {}
+            for key, value in node.items():
+                if key in ("description_for_generator", "description", "prompt1") and isinstance(value, str) and value:
+                    out[key] = f"Steampunk brass-and-teal restyle: {value}"
+                else:
+                    out[key] = self._restyle(value)
+            return out
+        if isinstance(node, list):
+            return [self._restyle(v) for v in node]
+        return node
+
+
+class StubPrompts:
+    """
+    prompts.py 的离线替身：prompts.py 导入时依赖外部的 src.application 包，--stub 且导入失败时使用。
+    只生成 StubLLM 会解析的部分（ASSET BLUEPRINT、Generation Prompt、引号中的原 prompt）。
+    """
+    SYMBOLS_SYSTEM_INSTRUCTION = SYMBOLS_USER_PROMPT = ""
+    MAINSCENES_SYSTEM_INSTRUCTION = MAINSCENES_USER_PROMPT = ""
+    POPUPS_SYSTEM_INSTRUCTION = POPUPS_USER_PROMPT = ""
+
+    @staticmethod
+    def get_story_designer_instructions(game_concept):
+        return "", game_concept
+
+    @staticmethod
+    def get_audio_asset_instructions():
+        return "", ""
+
+    @staticmethod
+    def _redesign(game_story_design_data, decompose_data):
+        return "", f"[ASSET BLUEPRINT]\n{json.dumps(decompose_data, ensure_ascii=False)}"
+
+    get_redesign_symbols_instructions = _redesign
+    get_redesign_mainscene_instructions = _redesign
+    get_redesign_popups_instructions = _redesign
+    get_redesign_audio_asset_instructions = _redesign
+
+    @staticmethod
+    def get_character_extractor_prompts(description=None):
+        return "", f'- **Generation Prompt:** "{description}"\n'
+
+    get_background_validation_instructions = get_character_extractor_prompts
+
+    @staticmethod
+    def get_background_enhanced_instructions(original_description):
+        return "", f'"{original_description}"'
+
+
+def load_templates(stub: bool = False):
+    """返回 prompts 模块；stub 且 prompts.py 的外部依赖不可用时返回 StubPrompts"""
+    try:
+        return importlib.import_module("prompts")
+    except ImportError as e:
+        if not stub:
+            raise
+        print(f"[WARN] 无法导入 prompts（{e}），--stub 下改用 StubPrompts")
+        return StubPrompts
+
+
+class ZImageBackend:
+    """在线程中调用 generate_batch()，同尺寸的素材合并成一次 pipe() 调用"""
+    name = "zimage"
+
+    def __init__(self, pipe, device: str = zl.DEVICE):
+        self.pipe = pipe
+        self.device = device
+
+    def generate(self, items, output_dir: str):
+        """返回与 items 一一对应的图片路径；按位置对应，同名素材各自保留一张"""
+        os.makedirs(output_dir, exist_ok=True)
+        results = []
+        for batch in zl.make_batches(items, zl.MAX_BATCH, num_images=1):
+            results.extend(zl.generate_batch(self.pipe, batch, num_images=1, device=self.device))
+        # 一次保存：同名素材在同一次 save_results 中才能分到不同的文件名
+        saved = zl.save_results(results, output_dir)
+        position = {id(item): i for i, item in enumerate(items)}
+        paths = [None] * len(items)
+        for (item, _, _), path in zip(results, saved):
+            paths[position[id(item)]] = path
+        return paths
+
+
+# ----- DAG -----
+class Stage:
+    def __init__(self, name: str, fn, deps=(), params=None):
+        self.name = name
+        self.fn = fn                   # async fn(runner, **上游输出) -> 可 JSON 序列化的结果
+        self.deps = tuple(deps)
+        self.params = params or {}     # 参与记忆化键的额外参数（媒体指纹、尺寸等）
+
+
+class DagRunner:
+    def __init__(self, stages, llm: LLMBackend, images: ZImageBackend, job: dict,
+                 limits=None, memo_dir: str = MEMO_DIR, templates=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.llm = llm
+        self.templates = templates if templates is not None else load_templates()   # prompts 模块或 StubPrompts
+        self.images = images
+        self.job = job
+        self.memo_dir = memo_dir
+        self.limits = {**BACKEND_LIMITS, **(limits or {})}
+        self.semaphores = {}
+        self.stats = {}                # 阶段名 -> {"seconds", "cached"}
+        self.counts = {"llm": 0, "zimage": 0, "avoided": 0}
+
+    # 后端调用统一经过信号量
+    async def call_llm(self, system, user, media=None, stage=None):
+        async with self.semaphores["llm"]:
+            self.counts["llm"] += 1
+            return await self.llm.complete(system, user, media=media, stage=stage)
+
+    async def generate_images(self, items, output_dir):
+        async with self.semaphores["zimage"]:
+            self.counts["zimage"] += 1
+            return await asyncio.to_thread(self.images.generate, items, output_dir)
+
+    def _memo_path(self, stage: Stage, inputs: dict) -> str:
+        key = content_hash({
+            "stage": stage.name,
+            "version": STAGE_VERSION,
+            "params": stage.params,
+            "inputs": inputs,
+            "llm": getattr(self.llm, "name", type(self.llm).__name__),
+        })
+        return os.path.join(self.memo_dir, f"{stage.name}-{key[:24]}.json")
+
+    async def _run_stage(self, stage: Stage, tasks: dict):
+        inputs = {}
+        for dep in stage.deps:
+            inputs[dep] = await tasks[dep]
+
+        memo_path = self._memo_path(stage, inputs) if self.memo_dir else None
+        if memo_path and os.path.exists(memo_path):
+            with open(memo_path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            if _outputs_exist(result):
+                self.stats[stage.name] = {"seconds": 0.0, "cached": True}
+                print(f"   [{stage.name}] 命中缓存")
+                return result
+
+        t0 = time.perf_counter()
+        result = await stage.fn(self, **inputs)
+        elapsed = time.perf_counter() - t0
+        self.stats[stage.name] = {"seconds": round(elapsed, 3), "cached": False}
+        print(f"   [{stage.name}] 完成（{elapsed:.2f}s）")
+
+        if memo_path:
+            os.makedirs(self.memo_dir, exist_ok=True)
+            tmp = f"{memo_path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, memo_path)
+        return result
+
+    async def run(self):
+        self.semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        tasks = {}
+        for stage in self.stages.values():
+            missing = [d for d in stage.deps if d not in self.stages]
+            if missing:
+                raise ValueError(f"阶段 {stage.name} 依赖不存在的阶段：{missing}")
+            tasks[stage.name] = asyncio.ensure_future(self._run_stage(stage, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+    def summary(self) -> str:
+        cached = sum(1 for s in self.stats.values() if s["cached"])
+        return (f"阶段 {len(self.stats)} 个（缓存命中 {cached}），"
+                f"LLM 调用 {self.counts['llm']} 次，Z-Image 调用 {self.counts['zimage']} 次，"
+                f"本地预校验省下 LLM 校验 {self.counts['avoided']} 次")
+
+
+# ----- 阶段实现 -----
+async def stage_story(runner):
+    system, user = runner.templates.get_story_designer_instructions(runner.job["concept"])
+    return parse_json(await runner.call_llm(system, user, stage="story"))
+
+def make_decompose(group: str):
+    async def stage(runner):
+        prompts = runner.templates
+        if group == "symbols":
+            system, user = prompts.SYMBOLS_SYSTEM_INSTRUCTION, prompts.SYMBOLS_USER_PROMPT
+        elif group == "mainscene":
+            system, user = prompts.MAINSCENES_SYSTEM_INSTRUCTION, prompts.MAINSCENES_USER_PROMPT
+        elif group == "popups":
+            system, user = prompts.POPUPS_SYSTEM_INSTRUCTION, prompts.POPUPS_USER_PROMPT
+        else:
+            system, user = prompts.get_audio_asset_instructions()
+        media = [runner.job["media"][group]] if runner.job["media"].get(group) else None
+        return parse_json(await runner.call_llm(system, user, media=media, stage=f"decompose_{group}"))
+    return stage
+
+def make_redesign(group: str):
+    async def stage(runner, story, **decomposed):
+        prompts = runner.templates
+        builder = {
+            "symbols": prompts.get_redesign_symbols_instructions,
+            "mainscene": prompts.get_redesign_mainscene_instructions,
+            "popups": prompts.get_redesign_popups_instructions,
+            "audio": prompts.get_redesign_audio_asset_instructions,
+        }[group]
+        system, user = builder(story, decomposed[f"decompose_{group}"])
+        media = [runner.job["media"][group]] if runner.job["media"].get(group) else None
+        return parse_json(await runner.call_llm(system, user, media=media, stage=f"redesign:{group}"))
+    return stage
+
+def asset_item(asset, job_seed: int, attempt: int = 0, prompt: str = None):
+    from zimage_jobs import derive_seed
+    width, height = asset_size(asset["filename"])
+    return {
+        "prompt": prompt or asset["description"],
+        "width": width,
+        "height": height,
+        "name": os.path.splitext(asset["filename"])[0] + (f"_retry{attempt}" if attempt else ""),
+        "seed": derive_seed(job_seed, f"{asset['filename']}:{attempt}"),
+        "count": 1,
+    }
+
+def make_generate(group: str):
+    async def stage(runner, **redesigned):
+        assets = collect_assets(redesigned[f"redesign_{group}"], group)
+        if not assets:
+            return []
+        items = [asset_item(a, runner.job.get("seed", 0)) for a in assets]
+        paths = await runner.generate_images(items, os.path.join(runner.job["output_dir"], group))
+        return [{**a, "prompt": item["prompt"], "seed": item["seed"], "path": path}
+                for a, item, path in zip(assets, items, paths)]
+    return stage
+
+def asset_kind(asset):
+    """本地预校验的类别：背景图 / 含引号文字的素材 / 其他（不校验）"""
+    if is_background(asset):
+        return "background"
+    if QUOTED_TEXT.search(asset["prompt"]):
+        return "text"
+    return None
+
+async def prevalidate_assets(assets):
+    """按类别整批做本地打分，返回与 assets 对应的预校验结果（不校验的为 None）"""
+    from zimage_prevalidate import prevalidate
+    results = [None] * len(assets)
+    if not PREVALIDATE:
+        return results
+    for kind in ("background", "text"):
+        indices = [i for i, a in enumerate(assets) if asset_kind(a) == kind]
+        if indices:
+            scored = await asyncio.to_thread(prevalidate, [assets[i]["path"] for i in indices], kind)
+            for i, result in zip(indices, scored):
+                results[i] = result
+    return results
+
+async def check_asset(runner, asset, local):
+    """返回 (是否通过, 失败原因)；本地预校验明确时不调用 LLM"""
+    prompts = runner.templates
+    kind = asset_kind(asset)
+    if kind is None:
+        return True, None
+    verdict = local["verdict"] if local else "uncertain"
+    if verdict == "fail":
+        runner.counts["avoided"] += 1
+        scores = {k: v for k, v in local.items() if k != "verdict"}
+        return False, f"本地预校验未通过：{scores}"
+    if kind == "background":
+        if verdict == "pass":
+            runner.counts["avoided"] += 1
+            return True, None
+        system, user = prompts.get_background_validation_instructions(asset["prompt"])
+        stage = f"validate_bg:{asset['filename']}"
+    else:
+        # 本地只能判断是否贴边，文字是否完整准确仍需 LLM 校验
+        system, user = prompts.get_character_extractor_prompts(asset["prompt"])
+        stage = f"validate:{asset['filename']}"
+    result = parse_json(await runner.call_llm(system, user, media=[asset["path"]], stage=stage))
+    return bool(result.get("passed")), result.get("error_details")
+
+async def validate_asset(runner, asset, local=None):
+    """校验单个素材，失败时重画；返回带 passed / attempts 的素材记录"""
+    prompts = runner.templates
+    job_seed = runner.job.get("seed", 0)
+    output_dir = os.path.join(runner.job["output_dir"], asset["group"])
+    current = dict(asset)
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            local = (await prevalidate_assets([current]))[0]
+        passed, reason = await check_asset(runner, current, local)
+        if passed or attempt == MAX_RETRIES:
+            return {**current, "passed": passed, "attempts": attempt + 1, "reason": None if passed else reason}
+
+        prompt = current["prompt"]
+        if is_background(current):
+            system, user = prompts.get_background_enhanced_instructions(prompt)
+            prompt = (await runner.call_llm(system, user, stage=f"enhance:{current['filename']}")).strip().strip('"')
+        item = asset_item(current, job_seed, attempt + 1, prompt)
+        path = (await runner.generate_images([item], output_dir))[0]
+        current = {**current, "prompt": prompt, "seed": item["seed"], "path": path}
+
+def make_validate(group: str):
+    async def stage(runner, **generated):
+        assets = generated[f"generate_{group}"]
+        local = await prevalidate_assets(assets)
+        return list(await asyncio.gather(*(validate_asset(runner, a, r) for a, r in zip(assets, local))))
+    return stage
+
+def build_stages(job: dict):
+    media = job.get("media", {})
+    thresholds = None
+    if PREVALIDATE:
+        from zimage_prevalidate import load_thresholds
+        thresholds = load_thresholds()
+    stages = [Stage("story", stage_story, params={"concept": job["concept"]})]
+    for group in GROUPS:
+        if group not in media:
+            continue
+        stages.append(Stage(f"decompose_{group}", make_decompose(group),
+                            params={"media": file_fingerprint(media[group])}))
+        stages.append(Stage(f"redesign_{group}", make_redesign(group), deps=("story", f"decompose_{group}")))
+        if group in IMAGE_GROUPS:
+            params = {"output_dir": job["output_dir"], "seed": job.get("seed", 0), "sizes": ASSET_SIZES,
+                      "model": zl.MODEL_ID, "revision": zl.MODEL_REVISION, "steps": zl.NUM_STEPS, "stub": zl.USE_STUB}
+            stages.append(Stage(f"generate_{group}", make_generate(group), deps=(f"redesign_{group}",), params=params))
+            stages.append(Stage(f"validate_{group}", make_validate(group), deps=(f"generate_{group}",),
+                                params={"max_retries": MAX_RETRIES, "prevalidate": PREVALIDATE, "thresholds": thresholds}))
+    return stages
+
+def load_llm(spec: str) -> LLMBackend:
+    """'包.模块:类名' -> 后端实例"""
+    module_name, _, class_name = spec.partition(":")
+    backend = getattr(importlib.import_module(module_name), class_name)()
+    # 不继承 LLMBackend 的类同样要在这里检查，不要等到 DAG 中途第一次调用才失败
+    if not callable(getattr(backend, "complete", None)):
+        raise TypeError(f"{spec} 没有实现 complete()")
+    return backend
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent asset pipeline over the prompts.py stages")
+    parser.add_argument("job", help="任务文件（JSON）")
+    parser.add_argument("--stub", action="store_true", help="StubLLM + StubPipeline，离线运行")
+    parser.add_argument("--llm", default=None, help="LLM 后端类，格式 包.模块:类名")
+    parser.add_argument("--llm-limit", type=int, default=BACKEND_LIMITS["llm"])
+    parser.add_argument("--no-memo", action="store_true", help="不读写阶段缓存")
+    args = parser.parse_args()
+
+    with open(args.job, "r", encoding="utf-8") as f:
+        job = json.load(f)
+    job.setdefault("output_dir", os.path.join(zl.OUTPUT_DIR, "assets"))
+    job.setdefault("media", {})
+
+    zl.USE_STUB = args.stub
+    if args.stub:
+        llm = StubLLM()
+    elif args.llm:
+        llm = load_llm(args.llm)
+    else:
+        parser.error("需要 --llm 指定 LLM 后端，或使用 --stub")
+
+    pipe = zl.load_pipeline()
+    runner = DagRunner(build_stages(job), llm, ZImageBackend(pipe), job,
+                       limits={"llm": args.llm_limit}, memo_dir=None if args.no_memo else MEMO_DIR,
+                       templates=load_templates(stub=args.stub))
+    t0 = time.perf_counter()
+    results = asyncio.run(runner.run())
+    print(f"\n>> 完成，用时 {time.perf_counter() - t0:.2f}s；{runner.summary()}")
+
+    for group in IMAGE_GROUPS:
+        for asset in results.get(f"validate_{group}", []):
+            status = "通过" if asset["passed"] else f"未通过（{asset['reason']}）"
+            print(f"  {asset['path']}  {status}，尝试 {asset['attempts']} 次")
+    if "redesign_audio" in results:
+        path = os.path.join(job["output_dir"], "audio_redesign.json")
+        os.makedirs(job["output_dir"], exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results["redesign_audio"], f, ensure_ascii=False, indent=2)
+        print(f"  音频重设计 -> {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+基准测试：把 zimage_test.py 的单次计时推广为参数矩阵。
+
+扫描 分辨率 x batch x 步数 x dtype x 注意力后端 x compile x offload，
+每个组合先预热、再重复计时，输出 p50/p95 延迟、张/秒、峰值显存及相对用例开始时的增量
+（CPU 上为该用例期间采样到的峰值 RSS），结果写成 JSON 和 CSV，并记录 git commit，方便跨提交对比。
+
+用法：
+    python zimage_bench.py --sizes 1024x1024,1024x1360 --batches 1,2,4 --steps 9
+    python zimage_bench.py --attention sdpa,flash --compile off,on
+    python zimage_bench.py --tiny --device cpu --sizes 64x64 --batches 1,2   # CPU CI 用
+    python zimage_bench.py --postprocess --sizes 1024x1360 --batches 3      # 只比较后处理：PIL vs 张量
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+import torch
+
+MODEL_ID = "Tongyi-MAI/Z-Image-Turbo"
+PROMPT = "Young Chinese woman in red Hanfu, intricate embroidery. Impeccable makeup, red floral forehead pattern. Elaborate high bun, golden phoenix headdress, red flowers, beads."
+DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
+
+
+def parse_list(text: str, conv=str):
+    return [conv(x.strip()) for x in text.split(",") if x.strip()]
+
+def parse_size(text: str):
+    w, h = text.lower().replace("×", "x").split("x")
+    return int(w), int(h)
+
+def parse_flag(text: str) -> bool:
+    return text.strip().lower() in {"1", "on", "true", "yes"}
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * q
+    lo, hi = int(pos), min(int(pos) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def sync(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+def current_rss_mb():
+    """当前 RSS（MB）；没有 /proc 时返回 None"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+class RssSampler:
+    """
+    后台线程按固定间隔采样当前 RSS，得到单个用例期间的峰值。
+    ru_maxrss 是整个进程生命周期的峰值、只增不减，前面用例（或加载时）的峰值会掩盖后面的用例。
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.baseline = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.baseline = current_rss_mb()
+        self.peak = self.baseline
+        if self.baseline is not None:
+            self._thread = threading.Thread(target=self._loop, name="rss-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+
+def memory_start(device: str):
+    """开始一个用例的内存统计；返回 peak_memory() 需要的状态"""
+    if device.startswith("cuda"):
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+        return torch.cuda.memory_allocated() / 1024 / 1024
+    return RssSampler().start()
+
+def peak_memory(device: str, state):
+    """
+    (峰值 MB, 相对用例开始时的增量 MB)。
+    CUDA：max_memory_allocated；CPU：用例期间采样到的 RSS 峰值（无 /proc 时退回进程级 ru_maxrss，增量为 None）
+    """
+    if device.startswith("cuda"):
+        peak = torch.cuda.max_memory_allocated() / 1024 / 1024
+        return peak, peak - state
+    state.stop()
+    if state.peak is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, None
+    return state.peak, state.peak - state.baseline
+
+def load_pipeline(args, dtype, attention: str, compile_: bool, offload: bool, quant: str = "none"):
+    bits = None if quant == "none" else int(quant[3:])
+    if args.tiny:
+        from zimage_tiny import build_tiny_pipeline
+        pipe = build_tiny_pipeline(args.device if not offload and not bits else "cpu", dtype)
+        if bits:
+            from zimage_quant import quantize_pipeline
+            quantize_pipeline(pipe, bits, min_features=0)
+    elif bits:
+        from zimage_quant import load_quantized_pipeline
+        pipe = load_quantized_pipeline(MODEL_ID, bits=bits, dtype=dtype)
+        pipe.set_progress_bar_config(disable=True)
+    else:
+        from diffusers import ZImagePipeline
+        pipe = ZImagePipeline.from_pretrained(MODEL_ID, torch_dtype=dtype, low_cpu_mem_usage=True)
+        pipe.set_progress_bar_config(disable=True)
+
+    if offload:
+        pipe.enable_model_cpu_offload()
+    else:
+        pipe.to(args.device)
+    if attention and attention != "default":
+        pipe.transformer.set_attention_backend(attention)
+    if compile_:
+        pipe.transformer.compile()
+    return pipe
+
+def run_case(pipe, args, width: int, height: int, batch: int, steps: int):
+    def once():
+        pipe(
+            prompt=PROMPT,
+            height=height,
+            width=width,
+            num_inference_steps=steps,
+            guidance_scale=0.0,
+            num_images_per_prompt=batch,
+            generator=torch.Generator("cpu").manual_seed(42),
+        )
+
+    state = memory_start(args.device)
+    try:
+        for _ in range(args.warmup):
+            once()
+        sync(args.device)
+
+        times = []
+        for _ in range(args.repeat):
+            sync(args.device)
+            t0 = time.perf_counter()
+            once()
+            sync(args.device)
+            times.append(time.perf_counter() - t0)
+    finally:
+        peak_mb, delta_mb = peak_memory(args.device, state)
+
+    p50 = percentile(times, 0.5)
+    return {
+        "p50_s": round(p50, 4),
+        "p95_s": round(percentile(times, 0.95), 4),
+        "mean_s": round(sum(times) / len(times), 4),
+        "images_per_s": round(batch / p50, 4) if p50 else 0.0,
+        "peak_mem_mb": round(peak_mb, 1),
+        "mem_delta_mb": None if delta_mb is None else round(delta_mb, 1),
+        "runs": [round(t, 4) for t in times],
+    }
+
+def bench_postprocess(args, sizes, batches):
+    """
+    不加载模型，只比较 VAE 输出之后的后处理：
+    pil     diffusers 默认路径 VaeImageProcessor.postprocess(output_type="pil")
+    tensor  zimage_postprocess.to_uint8 整批量化（含拷回 CPU）
+    报告每张图的耗时。
+    """
+    from diffusers.image_processor import VaeImageProcessor
+    from zimage_postprocess import split_batch, to_uint8
+
+    processor = VaeImageProcessor(vae_scale_factor=16)
+    rows = []
+    for (width, height), batch in itertools.product(sizes, batches):
+        # VAE 解码输出的范围是 [-1, 1]
+        decoded = torch.rand(batch, 3, height, width, device=args.device) * 2 - 1
+        for path in ("pil", "tensor"):
+            def once():
+                if path == "pil":
+                    return processor.postprocess(decoded, output_type="pil")
+                pt = processor.postprocess(decoded, output_type="pt")
+                return split_batch(to_uint8(pt))
+
+            for _ in range(args.warmup):
+                once()
+            times = []
+            for _ in range(args.repeat):
+                sync(args.device)
+                t0 = time.perf_counter()
+                once()
+                sync(args.device)
+                times.append(time.perf_counter() - t0)
+            per_image_ms = percentile(times, 0.5) / batch * 1000
+            rows.append({"path": path, "width": width, "height": height, "batch": batch,
+                         "p50_s": round(percentile(times, 0.5), 5), "per_image_ms": round(per_image_ms, 3)})
+            print(f"   {path:6s} {width}x{height} b{batch}: 每张 {per_image_ms:.2f} ms")
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Z-Image benchmark parameter sweep")
+    parser.add_argument("--sizes", default="1024x1024")
+    parser.add_argument("--batches", default="1")
+    parser.add_argument("--steps", default="9")
+    parser.add_argument("--dtypes", default="bf16", help="bf16,fp16,fp32")
+    parser.add_argument("--attention", default="default", help="default,flash,_flash_3,...")
+    parser.add_argument("--compile", default="off", help="off,on")
+    parser.add_argument("--offload", default="off", help="off,on")
+    parser.add_argument("--quant", default="none", help="none,int8,int4（仅权重量化）")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--tiny", action="store_true", help="使用随机初始化的极小模型（CPU CI）")
+    parser.add_argument("--out", default="bench_results", help="输出文件前缀（生成 .json 和 .csv）")
+    parser.add_argument("--postprocess", action="store_true", help="只测后处理（PIL vs 张量路径），不加载模型")
+    args = parser.parse_args()
+
+    sizes = parse_list(args.sizes, parse_size)
+    batches = parse_list(args.batches, int)
+    steps_list = parse_list(args.steps, int)
+    load_axes = list(itertools.product(
+        parse_list(args.dtypes),
+        parse_list(args.attention),
+        parse_list(args.compile, parse_flag),
+        parse_list(args.offload, parse_flag),
+        parse_list(args.quant),
+    ))
+
+    meta = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "device": args.device,
+        "gpu": torch.cuda.get_device_name() if args.device.startswith("cuda") and torch.cuda.is_available() else platform.processor(),
+        "torch": torch.__version__,
+        "tiny": args.tiny,
+        "warmup": args.warmup,
+        "repeat": args.repeat,
+    }
+    rows = []
+
+    if args.postprocess:
+        rows = bench_postprocess(args, sizes, batches)
+        with open(args.out + ".json", "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "postprocess": rows}, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.out}.json（commit {meta['commit']}）")
+        return
+
+    # 加载相关的维度（dtype/注意力/compile/offload/量化）在外层，只重新加载必要的次数
+    for dtype_name, attention, compile_, offload, quant in load_axes:
+        config = {"dtype": dtype_name, "attention": attention, "compile": compile_, "offload": offload, "quant": quant}
+        print(f">> 加载 pipeline：{config}")
+        try:
+            t0 = time.perf_counter()
+            pipe = load_pipeline(args, DTYPES[dtype_name], attention, compile_, offload, quant)
+            load_s = time.perf_counter() - t0
+            from zimage_quant import footprint
+            config["weights_mb"] = round(sum(footprint(pipe).values()), 1)
+        except Exception as e:
+            print(f"[WARN] 加载失败，跳过该组合：{e}")
+            rows.append({**config, "error": f"load: {e}"})
+            continue
+
+        for (width, height), batch, steps in itertools.product(sizes, batches, steps_list):
+            case = {**config, "width": width, "height": height, "batch": batch, "steps": steps, "load_s": round(load_s, 2)}
+            try:
+                case.update(run_case(pipe, args, width, height, batch, steps))
+                print(f"   {width}x{height} b{batch} s{steps}: p50 {case['p50_s']:.3f}s  p95 {case['p95_s']:.3f}s  "
+                      f"{case['images_per_s']:.2f} 张/秒  峰值 {case['peak_mem_mb']:.0f} MB")
+            except Exception as e:
+                print(f"[WARN] {width}x{height} b{batch} s{steps} 失败：{e}")
+                case["error"] = str(e)
+                if args.device.startswith("cuda"):
+                    torch.cuda.empty_cache()
+            rows.append(case)
+
+        del pipe
+        if args.device.startswith("cuda"):
+            torch.cuda.empty_cache()
+
+    with open(args.out + ".json", "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": rows}, f, ensure_ascii=False, indent=2)
+
+    fields = ["dtype", "attention", "compile", "offload", "quant", "weights_mb", "width", "height", "batch", "steps",
+              "p50_s", "p95_s", "mean_s", "images_per_s", "peak_mem_mb", "mem_delta_mb", "load_s", "error"]
+    with open(args.out + ".csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["commit"] + fields, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({"commit": meta["commit"], **row})
+
+    print(f"\n结果已写入 {args.out}.json / {args.out}.csv（commit {meta['commit']}）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+分辨率分桶 + transformer.compile() 预热与编译缓存持久化。
+
+parse_size() 接受任意 宽x高，开启 pipe.transformer.compile() 后每个新尺寸都会触发一次
+重新编译，耗时可能比生成本身还长。开启 SNAP_TO_BUCKETS 后：
+- 请求尺寸吸附到 SIZE_BUCKETS 中宽高比最接近的桶，按桶尺寸生成，
+  再等比缩放 + 居中裁剪回请求的精确尺寸
+- 启动时对所有桶、几种 caption 长度预热编译，并把 Inductor 编译缓存保存到磁盘，重启后复用
+"""
+import math
+import os
+import time
+
+from PIL import Image
+
+
+def snap_size(width: int, height: int, buckets):
+    """
+    返回与 (width, height) 宽高比最接近的桶；宽高比相同时优先选面积不小于请求、且最小的桶，
+    以免放大损失细节。
+    """
+    if (width, height) in buckets:
+        return width, height
+    target_ratio = math.log(width / height)
+    area = width * height
+
+    def score(bucket):
+        bw, bh = bucket
+        ratio_diff = round(abs(math.log(bw / bh) - target_ratio), 3)
+        too_small = bw * bh < area
+        return ratio_diff, too_small, abs(bw * bh - area)
+
+    return min(buckets, key=score)
+
+def fit_to_size(image, width: int, height: int):
+    """等比缩放到能覆盖 (width, height)，再居中裁剪到精确尺寸"""
+    if image.size == (width, height):
+        return image
+    scale = max(width / image.width, height / image.height)
+    resized = image.resize(
+        (max(width, round(image.width * scale)), max(height, round(image.height * scale))),
+        Image.LANCZOS,
+    )
+    left = (resized.width - width) // 2
+    top = (resized.height - height) // 2
+    return resized.crop((left, top, left + width, top + height))
+
+def apply_buckets(items, buckets):
+    """把任务的生成尺寸换成桶尺寸，原请求尺寸记在 out_width / out_height"""
+    for item in items:
+        bw, bh = snap_size(item["width"], item["height"], buckets)
+        if (bw, bh) != (item["width"], item["height"]):
+            item["out_width"], item["out_height"] = item["width"], item["height"]
+            item["width"], item["height"] = bw, bh
+    return items
+
+# ----- 编译缓存 -----
+_ARTIFACTS_FILE = "compile_artifacts.bin"
+
+
+def enable_compile_cache(cache_dir: str):
+    """
+    打开 Inductor 的 FX graph / AOTAutograd 磁盘缓存并指向 cache_dir；
+    如果 torch 支持 mega-cache（torch.compiler.load_cache_artifacts），同时加载上次保存的产物。
+    必须在第一次编译之前调用。
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+
+    import torch
+    path = os.path.join(cache_dir, _ARTIFACTS_FILE)
+    if os.path.exists(path) and hasattr(torch.compiler, "load_cache_artifacts"):
+        try:
+            with open(path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            print(f">> 已加载编译缓存：{path}")
+        except Exception as e:
+            print(f"[WARN] 编译缓存加载失败，将重新编译：{e}")
+
+def save_compile_cache(cache_dir: str):
+    """把本进程编译产生的产物写到 cache_dir（torch 不支持 mega-cache 时只依赖 Inductor 目录缓存）"""
+    import torch
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return
+    try:
+        result = torch.compiler.save_cache_artifacts()
+    except Exception as e:
+        print(f"[WARN] 编译缓存保存失败：{e}")
+        return
+    if result is None:
+        return
+    data, _ = result
+    path = os.path.join(cache_dir, _ARTIFACTS_FILE)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+# 预热用的 caption 词数：Z-Image 把 caption 按 32 token 的倍数补齐后进入 transformer，
+# 长度也是编译时的形状维度。只用一个短 prompt 预热时，第一条长 prompt 仍会触发重新编译；
+# 用几种长度预热后 dynamo 会把该维度标为动态，编译发生在预热阶段
+WARMUP_CAPTION_WORDS = (8, 64, 256)
+_WARMUP_TEXT = (
+    "a detailed game asset illustration of a glowing golden emblem on a dark velvet background, "
+    "soft rim light, rich colors, sharp focus, centered composition, clean edges"
+).split()
+
+
+def warmup_captions(word_counts=WARMUP_CAPTION_WORDS):
+    """按给定词数循环拼接描述文本，得到不同长度的预热 prompt"""
+    return [" ".join(_WARMUP_TEXT[i % len(_WARMUP_TEXT)] for i in range(n)) for n in word_counts]
+
+def prewarm(pipe, buckets, batch_sizes, steps: int = 2, captions=None):
+    """
+    对每个 (桶, 批大小) 用几种长度的 caption 各跑一次极短的生成，让编译尽量发生在启动阶段。
+    实际 prompt 长度超出预热范围、或 torch 关闭了自动动态形状时，仍可能在运行中重新编译一次。
+    """
+    captions = captions or warmup_captions()
+    for width, height in buckets:
+        for batch_size in batch_sizes:
+            t0 = time.time()
+            for caption in captions:
+                pipe(
+                    prompt=caption,
+                    height=height,
+                    width=width,
+                    num_inference_steps=steps,
+                    guidance_scale=0.0,
+                    num_images_per_prompt=batch_size,
+                )
+            print(f">> 预热 {width}x{height} x{batch_size}（{len(captions)} 种 caption 长度）：{time.time() - t0:.1f} 秒")
@@ -0,0 +1,91 @@
+"""
+zimage_server.py 的命令行客户端。不导入 torch/diffusers，启动几乎没有开销。
+
+用法：
+    python zimage_client.py "A cute shiba inu astronaut" --size 768x1024 --seed 42 --count 2
+    python zimage_client.py "..." --bytes --out-dir ./out   # 让服务端回传图片字节，本地保存
+    python zimage_client.py --ping
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import socket
+import sys
+import time
+
+SOCKET_PATH = "/tmp/zimage.sock"
+
+
+def request(payload: dict, socket_path: str = SOCKET_PATH, timeout: float = None) -> dict:
+    """发送一条 JSON 请求并返回响应"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+        chunks = []
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b"\n"):
+                break
+    return json.loads(b"".join(chunks))
+
+def main():
+    parser = argparse.ArgumentParser(description="Client for the resident Z-Image server")
+    parser.add_argument("prompt", nargs="?")
+    parser.add_argument("--size", default="1024x1024", help="宽x高，如 1024x1360")
+    parser.add_argument("--steps", type=int, default=9)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--bytes", action="store_true", help="回传图片字节而不是服务端路径")
+    parser.add_argument("--out-dir", default=".", help="--bytes 时本地保存目录")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--ping", action="store_true")
+    args = parser.parse_args()
+
+    if args.ping:
+        print(request({"op": "ping"}, args.socket))
+        return
+    if not args.prompt:
+        parser.error("需要 prompt")
+
+    m = re.match(r"^(\d+)\s*[Xx×]\s*(\d+)$", args.size.strip())
+    if not m:
+        parser.error(f"无法解析尺寸：{args.size}")
+
+    t0 = time.time()
+    resp = request({
+        "op": "generate",
+        "prompt": args.prompt,
+        "width": int(m.group(1)),
+        "height": int(m.group(2)),
+        "steps": args.steps,
+        "seed": args.seed,
+        "count": args.count,
+        "return": "bytes" if args.bytes else "paths",
+    }, args.socket)
+    elapsed = time.time() - t0
+
+    if not resp.get("ok"):
+        print(f"[ERROR] {resp.get('error')}")
+        sys.exit(1)
+
+    if args.bytes:
+        os.makedirs(args.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        for i, data in enumerate(resp["images"], start=1):
+            path = os.path.join(args.out_dir, f"{stamp}_{i}.png")
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(data))
+            print(path)
+    else:
+        for path in resp["paths"]:
+            print(path)
+    print(f"服务端生成 {resp['seconds']:.2f} 秒，客户端总耗时 {elapsed:.2f} 秒", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+草稿 -> 定稿 两级生成。
+
+大多数 prompts.txt 的迭代只是为了看构图，却每轮都按全尺寸、9 步、OUTPUT_NUM 张渲染。
+draft：对每一行以低分辨率、少步数渲染预览，并记录每张图的确切种子
+final：只把挑中的（prompt, 种子）按全尺寸、全步数重新渲染
+
+初始噪声由种子在 CPU 上按全尺寸潜空间生成：定稿直接使用它；草稿使用它的面积下采样
+（并按方差缩放回单位方差）。因此草稿与定稿共享低频噪声结构，构图基本一致，
+而定稿结果只取决于种子，任何设备上都可精确复现。
+开启 SNAP_TO_BUCKETS 时草稿与定稿都按桶尺寸渲染（噪声形状一致），最后再裁剪到请求的尺寸。
+
+用法：
+    python zimage_draft.py draft [--prompts prompts.txt] [--session 名称]
+    python zimage_draft.py list  <session>
+    python zimage_draft.py final <session> d0003 d0007 ...
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+
+import torch
+import torch.nn.functional as F
+
+import zimage_loop_from_file as zl
+
+# ===== 配置区域 =====
+DRAFTS_DIR = os.path.join(zl.OUTPUT_DIR, "drafts")
+DRAFT_SCALE = 0.5                  # 草稿边长相对全尺寸的比例
+DRAFT_STEPS = 4                    # 草稿步数
+LATENT_CHANNELS = 16
+VAE_SCALE = 8                      # 像素 -> 潜空间的缩放倍数
+SIZE_MULTIPLE = 16                 # 生成尺寸必须是 16 的倍数
+# ====================
+
+
+def full_noise(seed: int, width: int, height: int):
+    """由种子生成全尺寸的初始潜空间噪声 (1, C, H/8, W/8)，始终在 CPU 上生成以保证可复现"""
+    generator = torch.Generator("cpu").manual_seed(seed)
+    shape = (1, LATENT_CHANNELS, 2 * (height // (VAE_SCALE * 2)), 2 * (width // (VAE_SCALE * 2)))
+    return torch.randn(shape, generator=generator, dtype=torch.float32)
+
+def draft_size(width: int, height: int, scale: float = DRAFT_SCALE):
+    w = max(SIZE_MULTIPLE * 2, round(width * scale / SIZE_MULTIPLE) * SIZE_MULTIPLE)
+    h = max(SIZE_MULTIPLE * 2, round(height * scale / SIZE_MULTIPLE) * SIZE_MULTIPLE)
+    return w, h
+
+def draft_noise(noise, width: int, height: int):
+    """把全尺寸噪声面积下采样到草稿尺寸，并把方差缩放回 1"""
+    lh, lw = 2 * (height // (VAE_SCALE * 2)), 2 * (width // (VAE_SCALE * 2))
+    pooled = F.adaptive_avg_pool2d(noise, (lh, lw))
+    ratio = (noise.shape[-1] * noise.shape[-2]) / (lw * lh)
+    return pooled * math.sqrt(ratio)
+
+def session_dir(session: str) -> str:
+    return os.path.join(DRAFTS_DIR, session)
+
+def load_drafts(session: str):
+    path = os.path.join(session_dir(session), "drafts.jsonl")
+    if not os.path.exists(path):
+        raise SystemExit(f"[ERROR] 找不到草稿记录：{path}")
+    with open(path, "r", encoding="utf-8") as f:
+        return {rec["id"]: rec for rec in map(json.loads, f)}
+
+def run_draft(pipe, items, session: str, writer=None, embed_cache=None):
+    out_dir = session_dir(session)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # 展开为单张任务，每张一个显式记录的种子
+    tasks = []
+    for item in items:
+        count = item.get("count", zl.OUTPUT_NUM)
+        for i in range(count):
+            seed = item["seed"] + i if "seed" in item else random.randrange(1 << 63)
+            # width/height 是实际渲染尺寸（开启 SNAP_TO_BUCKETS 时为桶尺寸）；
+            # 定稿必须按同一尺寸渲染，共享噪声的潜空间形状才与草稿一致，out_* 只用于最后的裁剪
+            width, height = item["width"], item["height"]
+            dw, dh = draft_size(width, height)
+            task = {
+                "prompt": item["prompt"],
+                "width": dw,
+                "height": dh,
+                "steps": DRAFT_STEPS,
+                "seed": seed,
+                "final_width": width,
+                "final_height": height,
+                "final_steps": item.get("steps", zl.NUM_STEPS),
+            }
+            if "out_width" in item:
+                task["final_out_width"], task["final_out_height"] = item["out_width"], item["out_height"]
+                # 草稿同样裁剪到请求的宽高比，预览构图与定稿一致
+                task["out_width"], task["out_height"] = draft_size(item["out_width"], item["out_height"])
+            tasks.append(task)
+    for n, task in enumerate(tasks, start=1):
+        task["id"] = task["name"] = f"d{n:04d}"
+
+    print(f">> 草稿：{len(tasks)} 张，{DRAFT_STEPS} 步，约 {DRAFT_SCALE:.0%} 边长 -> {out_dir}")
+    t0 = time.time()
+    with open(os.path.join(out_dir, "drafts.jsonl"), "w", encoding="utf-8") as f:
+        for batch in zl.make_batches(tasks, num_images=1):
+            for task in batch:
+                noise = full_noise(task["seed"], task["final_width"], task["final_height"])
+                task["latents"] = draft_noise(noise, task["width"], task["height"])
+            results = zl.generate_batch(pipe, batch, num_images=1, embed_cache=embed_cache)
+            paths = zl.save_results(results, output_dir=out_dir, writer=writer)
+            for task, path in zip(batch, paths):
+                task.pop("latents")
+                rec = {k: task[k] for k in ("id", "prompt", "seed", "final_width", "final_height", "final_steps")}
+                if "final_out_width" in task:
+                    rec["final_out_width"] = task["final_out_width"]
+                    rec["final_out_height"] = task["final_out_height"]
+                rec["draft_path"] = path
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    if writer is not None:
+        writer.flush()
+    print(f">> 草稿完成，用时 {time.time() - t0:.2f} 秒。挑选后运行：python zimage_draft.py final {session} <id> ...")
+
+def run_final(pipe, session: str, ids, writer=None, embed_cache=None):
+    drafts = load_drafts(session)
+    missing = [i for i in ids if i not in drafts]
+    if missing:
+        raise SystemExit(f"[ERROR] 未知的草稿 id：{', '.join(missing)}")
+
+    out_dir = os.path.join(session_dir(session), "final")
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+    for draft_id in ids:
+        rec = drafts[draft_id]
+        tasks.append({
+            "prompt": rec["prompt"],
+            "width": rec["final_width"],
+            "height": rec["final_height"],
+            "steps": rec["final_steps"],
+            "seed": rec["seed"],
+            "name": draft_id,
+        })
+        if "final_out_width" in rec:
+            tasks[-1]["out_width"], tasks[-1]["out_height"] = rec["final_out_width"], rec["final_out_height"]
+
+    print(f">> 定稿：{len(tasks)} 张 -> {out_dir}")
+    for batch in zl.make_batches(tasks, num_images=1):
+        for task in batch:
+            task["latents"] = full_noise(task["seed"], task["width"], task["height"])
+        t0 = time.time()
+        results = zl.generate_batch(pipe, batch, num_images=1, embed_cache=embed_cache)
+        for task in batch:
+            task.pop("latents")
+        zl.save_results(results, output_dir=out_dir, writer=writer)
+        print(f"生成用时 {time.time() - t0:.2f} 秒\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Draft-then-final two-tier generation")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_draft = sub.add_parser("draft", help="低分辨率、少步数渲染所有 prompt 的预览")
+    p_draft.add_argument("--prompts", default=zl.PROMPT_FILE)
+    p_draft.add_argument("--session", default=time.strftime("%Y%m%d_%H%M%S"))
+    p_list = sub.add_parser("list", help="列出草稿")
+    p_list.add_argument("session")
+    p_final = sub.add_parser("final", help="按全尺寸、全步数重新渲染选中的草稿")
+    p_final.add_argument("session")
+    p_final.add_argument("ids", nargs="+")
+    for p in (p_draft, p_final):
+        p.add_argument("--stub", action="store_true", help="使用 StubPipeline，不加载模型")
+    args = parser.parse_args()
+
+    if args.cmd == "list":
+        for rec in load_drafts(args.session).values():
+            print(f"{rec['id']}  seed={rec['seed']}  {rec['final_width']}x{rec['final_height']}  "
+                  f"{rec['draft_path']}  {rec['prompt'][:60]}")
+        return
+
+    zl.USE_STUB = args.stub
+    pipe = zl.load_pipeline(image_counts=(1,))   # 草稿与定稿都是单张任务
+    embed_cache = zl.make_embed_cache(pipe)
+    writer = zl.make_writer()
+    try:
+        if args.cmd == "draft":
+            items = zl.load_prompts(args.prompts)
+            if not items:
+                print(f"[WARN] 没有在 {args.prompts} 中读到有效内容。")
+                return
+            run_draft(pipe, items, args.session, writer, embed_cache)
+        else:
+            run_final(pipe, args.session, args.ids, writer, embed_cache)
+    finally:
+        if writer is not None:
+            writer.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+文本编码（prompt -> prompt_embeds）缓存。
+
+同一批 prompt 每轮都会被重新编码，而 Qwen 文本编码器并不便宜。
+EmbeddingCache 放在 ZImagePipeline.encode_prompt 前面：
+- 内存层：按字节数限制大小的 LRU
+- 磁盘层：每条 prompt 一个 torch.save 文件，命中时用 mmap 方式加载
+键为 (模型 ID, 模型版本, max_sequence_length, prompt, variant) 的哈希，换模型版本自动失效；
+variant 记录影响编码结果的配置（如文本编码器的量化方式），不同配置互不复用。
+命中后把 prompt_embeds 直接传给 pipe()，跳过编码器。
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import torch
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        pipe,
+        model_id: str,
+        revision: str = "main",
+        max_bytes: int = 512 * 1024 * 1024,
+        cache_dir: str = None,
+        max_sequence_length: int = 512,
+        variant=None,
+    ):
+        self.pipe = pipe
+        self.model_id = model_id
+        self.revision = revision
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_sequence_length = max_sequence_length
+        self.variant = variant or {}   # 影响编码结果的配置（如量化方式）
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._mem = OrderedDict()      # key -> CPU tensor
+        self.bytes_held = 0
+        self.mem_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0      # 实际花在编码器上的时间
+
+    def key(self, prompt: str) -> str:
+        payload = f"{self.model_id}\0{self.revision}\0{self.max_sequence_length}\0{prompt}"
+        if self.variant:
+            # 默认配置（无 variant）保持原有的键，已有的磁盘缓存仍然有效
+            payload += "\0" + json.dumps(self.variant, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".pt")
+
+    def _remember(self, key: str, tensor):
+        if key in self._mem:
+            self._mem.move_to_end(key)
+            return
+        size = tensor.numel() * tensor.element_size()
+        if size > self.max_bytes:
+            return
+        self._mem[key] = tensor
+        self.bytes_held += size
+        while self.bytes_held > self.max_bytes:
+            _, old = self._mem.popitem(last=False)
+            self.bytes_held -= old.numel() * old.element_size()
+
+    def _lookup(self, key: str):
+        tensor = self._mem.get(key)
+        if tensor is not None:
+            self._mem.move_to_end(key)
+            self.mem_hits += 1
+            return tensor
+
+        if self.cache_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                try:
+                    tensor = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+                except Exception as e:
+                    print(f"[WARN] 嵌入缓存文件损坏，重新编码：{path} ({e})")
+                    return None
+                self.disk_hits += 1
+                self._remember(key, tensor)
+                return tensor
+        return None
+
+    def _store_disk(self, key: str, tensor):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 带 pid 的临时文件名：多个 worker 进程可能同时写同一条
+        tmp = f"{path}.{os.getpid()}.tmp"
+        torch.save(tensor, tmp)
+        os.replace(tmp, path)
+
+    def get(self, prompts, device):
+        """
+        返回与 prompts 一一对应的 prompt_embeds 列表（已在 device 上），
+        未命中的 prompt 合并成一次 encode_prompt 调用。
+        """
+        keys = [self.key(p) for p in prompts]
+        found = [self._lookup(k) for k in keys]
+
+        missing = [i for i, t in enumerate(found) if t is None]
+        if missing:
+            self.misses += len(missing)
+            t0 = time.time()
+            with torch.no_grad():
+                embeds, _ = self.pipe.encode_prompt(
+                    prompt=[prompts[i] for i in missing],
+                    device=device,
+                    do_classifier_free_guidance=False,
+                    max_sequence_length=self.max_sequence_length,
+                )
+            self.encode_seconds += time.time() - t0
+            for i, emb in zip(missing, embeds):
+                cpu = emb.detach().to("cpu").contiguous()
+                found[i] = cpu
+                self._remember(keys[i], cpu)
+                if self.cache_dir:
+                    self._store_disk(keys[i], cpu)
+
+        return [t.to(device, non_blocking=True) for t in found]
+
+    def stats(self) -> dict:
+        hits = self.mem_hits + self.disk_hits
+        per_encode = self.encode_seconds / self.misses if self.misses else 0.0
+        return {
+            "mem_hits": self.mem_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._mem),
+            "bytes_held": self.bytes_held,
+            "encode_seconds": round(self.encode_seconds, 3),
+            # 按平均单条编码耗时估算命中节省的时间
+            "est_saved_seconds": round(per_encode * hits, 3),
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (
+            f"嵌入缓存：内存命中 {s['mem_hits']}，磁盘命中 {s['disk_hits']}，未命中 {s['misses']}，"
+            f"内存占用 {s['bytes_held'] / 1024 / 1024:.1f} MB，约节省编码 {s['est_saved_seconds']:.2f} 秒"
+        )
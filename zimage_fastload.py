@@ -0,0 +1,125 @@
+"""
+内存映射加载：多个 CPU worker 通过页缓存共享同一份权重。
+
+from_pretrained 无论 low_cpu_mem_usage 取何值，都会在每个进程里把权重复制成私有内存，
+每台机器上 N 个 worker 的内存占用约为 N 倍权重大小。这里：
+- 直接解析 .safetensors 头部，用 mmap（写时复制）映射整个文件，
+  torch.frombuffer 在映射区上零拷贝地构造每个张量
+- 模型在 meta 设备上按配置构建（不分配参数内存），再用 load_state_dict(assign=True)
+  把映射出的张量直接作为参数
+- 只读使用时各进程的权重页都来自同一份页缓存；保持文件中的 dtype 不做转换，否则会产生私有副本
+只有 CPU 推理能从共享中受益；移到 GPU 时仍会整份复制到显存。
+
+tokenizer / scheduler 等小组件照常由 ZImagePipeline.from_pretrained 加载。
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+
+SAFETENSORS_DTYPES = {
+    "F64": "float64",
+    "F32": "float32",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool",
+}
+MMAP_COMPONENTS = ("transformer", "text_encoder", "vae")
+
+
+def read_safetensors_header(f):
+    """从文件开头读出 (头部长度, 头部 JSON)；只读头部，不读张量数据"""
+    header_len = struct.unpack("<Q", f.read(8))[0]
+    return header_len, json.loads(f.read(header_len))
+
+def mmap_safetensors(path: str) -> dict:
+    """把一个 .safetensors 文件映射为 {名称: 张量}；张量与映射区共享内存，不复制"""
+    import torch
+
+    with open(path, "rb") as f:
+        header_len, header = read_safetensors_header(f)
+        # ACCESS_COPY：未写入的页与页缓存共享；万一被写入只影响本进程
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    base = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = getattr(torch, SAFETENSORS_DTYPES[info["dtype"]])
+        start, end = info["data_offsets"]
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(buf, dtype=dtype, count=count, offset=base + start).view(info["shape"])
+    return tensors
+
+def mmap_component(cls, component_dir: str):
+    """在 meta 设备上构建 cls，并把 component_dir 下所有 .safetensors 映射为其参数"""
+    files = sorted(glob.glob(os.path.join(component_dir, "*.safetensors")))
+    if not files:
+        raise FileNotFoundError(f"{component_dir} 下没有 .safetensors 文件")
+
+    try:
+        from accelerate import init_empty_weights
+    except ImportError as e:
+        # 没有 accelerate 时只能先按随机初始化构建完整模型，整份权重被分配一遍，共享也就失去意义
+        raise ImportError("MMAP_WEIGHTS 需要 accelerate（pip install accelerate）") from e
+
+    if hasattr(cls, "load_config"):                      # diffusers 模型
+        config = cls.load_config(component_dir)
+        build = lambda: cls.from_config(config)
+    else:                                               # transformers 模型
+        config = cls.config_class.from_pretrained(component_dir)
+        build = lambda: cls(config)
+    # 只把参数放到 meta 上；buffer（如 rotary 的 inv_freq）照常初始化
+    with init_empty_weights():
+        model = build()
+
+    state_dict = {}
+    for path in files:
+        state_dict.update(mmap_safetensors(path))
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    # 共享权重（如 tied embedding）在 checkpoint 中只存一份
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+    still_meta = [n for n, p in model.named_parameters() if p.is_meta]
+    if still_meta:
+        raise RuntimeError(f"{component_dir} 缺少参数：{still_meta[:5]}")
+    if unexpected:
+        print(f"[WARN] {os.path.basename(component_dir)} 中有未使用的权重：{unexpected[:5]}")
+    return model.eval()
+
+def resolve_snapshot(model_id: str, revision: str = "main") -> str:
+    """本地目录原样返回；否则返回 HF 缓存中的快照目录（优先不联网）"""
+    if os.path.isdir(model_id):
+        return model_id
+    from huggingface_hub import snapshot_download
+    try:
+        return snapshot_download(model_id, revision=revision, local_files_only=True)
+    except Exception:
+        return snapshot_download(model_id, revision=revision)
+
+def load_mmap_pipeline(model_id: str, revision: str = "main"):
+    """transformer / text encoder / VAE 的权重以内存映射方式加载的 ZImagePipeline（CPU）"""
+    import importlib
+
+    from diffusers import ZImagePipeline
+
+    root = resolve_snapshot(model_id, revision)
+    with open(os.path.join(root, "model_index.json"), "r", encoding="utf-8") as f:
+        index = json.load(f)
+
+    components = {}
+    for name in MMAP_COMPONENTS:
+        library, class_name = index[name]
+        cls = getattr(importlib.import_module(library), class_name)
+        components[name] = mmap_component(cls, os.path.join(root, name))
+    return ZImagePipeline.from_pretrained(root, **components)
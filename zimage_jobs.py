@@ -0,0 +1,218 @@
+"""
+可断点续跑的大批量任务：每张图一条记录的追加式日志（journal）。
+
+通宵跑几千条 prompt 时，原来的循环不记录进度，文件名又带 datetime.now() 时间戳，
+崩溃或 Ctrl-C 之后只能从头再来，也无法识别重复。这里：
+- 每张图对应一个 (prompt, 尺寸, 步数, 序号, 基础种子) 键，基础种子是任务自带的 seed 或 job_seed，
+  实际种子由基础种子和该键确定性派生，
+  文件名也由键决定（不含时间戳）
+- 图片写盘成功后才向 journal.jsonl 追加一条 done 记录（写入后 fsync）
+- 重启时读取 journal，跳过已完成且文件存在的图片，精确地从中断处继续
+
+任务文件按流读取（zimage_loop_from_file.iter_tasks），支持 .jsonl/.csv 的逐条覆盖，
+数百万行的任务文件也不会一次性载入内存。
+
+用法：
+    python zimage_jobs.py --name overnight --job-seed 1234 [--prompts prompts.txt] [--count 3]
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+import zimage_loop_from_file as zl
+from zimage_writer import as_pil
+
+# ===== 配置区域 =====
+JOBS_DIR = os.path.join(zl.OUTPUT_DIR, "jobs")
+JOURNAL_NAME = "journal.jsonl"
+# ====================
+
+
+def image_key(item, index: int, steps: int, base_seed: int) -> str:
+    """base_seed 是该任务实际使用的种子（任务自带的 seed 或 job_seed），换种子即换键"""
+    width = item.get("out_width", item["width"])
+    height = item.get("out_height", item["height"])
+    payload = json.dumps([item["prompt"], width, height, steps, index, base_seed], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def derive_seed(job_seed: int, key: str) -> int:
+    """由任务种子和图片键派生出确定的 63 位种子"""
+    digest = hashlib.sha256(f"{job_seed}:{key}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & ((1 << 63) - 1)
+
+
+class Journal:
+    """追加式 JSONL 日志；容忍崩溃时写了一半的最后一行"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = {}                 # key -> record
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue       # 截断的最后一行
+                    if rec.get("status") == "done":
+                        self.done[rec["key"]] = rec
+                    else:
+                        self.done.pop(rec.get("key"), None)
+        self._f = open(path, "a", encoding="utf-8")
+
+    def is_done(self, key: str) -> bool:
+        rec = self.done.get(key)
+        if rec is None:
+            return False
+        # tar 分片中的样本记录为 "分片.tar:样本名"，检查分片文件是否存在
+        path = rec["path"].split(".tar:", 1)[0] + ".tar" if ".tar:" in rec["path"] else rec["path"]
+        return os.path.exists(path)
+
+    def append(self, record: dict):
+        record = {**record, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            if record.get("status") == "done":
+                self.done[record["key"]] = record
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+def expand_tasks(items, job_seed: int, count: int, job_dir: str, ext: str = ".png"):
+    """
+    把每条 prompt 展开成 count 个单张任务（逐条 yield），各自带确定的种子、键和文件名。
+    任务自带 "count" / "seed" 时分别覆盖 count 和 job_seed，带 "name" 时用作文件名前缀（后接键的前 12 位）。
+    """
+    for item in items:
+        steps = item.get("steps", zl.NUM_STEPS)
+        width = item.get("out_width", item["width"])
+        height = item.get("out_height", item["height"])
+        base_seed = item.get("seed", job_seed)
+        for index in range(1, item.get("count", count) + 1):
+            key = image_key(item, index, steps, base_seed)
+            if item.get("name"):
+                # 名字可能重复，换 job_seed 重跑也不能覆盖旧图：文件名里同样带上键
+                filename = f"{item['name']}_{key[:12]}_{index}{ext}"
+            else:
+                filename = f"{key[:12]}_{width}x{height}_{zl.slugify(item['prompt'])}_{index}{ext}"
+            task = {
+                **item,
+                "steps": steps,
+                "seed": derive_seed(base_seed, key),
+                "key": key,
+                "index": index,
+                "path": os.path.join(job_dir, filename),
+            }
+            task.pop("count", None)
+            yield task
+
+def run_job(pipe, items, job_dir: str, job_seed: int, count: int, embed_cache=None, writer=None, admission=None):
+    os.makedirs(job_dir, exist_ok=True)
+    meta_path = os.path.join(job_dir, "job.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("job_seed") != job_seed:
+            print(f"[WARN] 该任务目录之前使用 job_seed={meta.get('job_seed')}，现在是 {job_seed}，"
+                  f"未自带 seed 的任务会按新种子重新生成（键包含种子，旧图片不会被复用）")
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"job_seed": job_seed, "count": count, "model": zl.MODEL_ID, "revision": zl.MODEL_REVISION}, f, indent=2)
+
+    journal = Journal(os.path.join(job_dir, JOURNAL_NAME))
+    ext = zl.output_ext(writer)
+    print(f">> journal 中已完成 {len(journal.done)} 张，跳过这些图片继续生成")
+    skipped = 0
+
+    def pending_tasks():
+        nonlocal skipped
+        for task in expand_tasks(items, job_seed, count, job_dir, ext):
+            if journal.is_done(task["key"]):
+                skipped += 1
+                continue
+            yield task
+
+    def record(task, error=None, location=None):
+        rec = {"key": task["key"], "prompt": task["prompt"], "size": f"{task.get('out_width', task['width'])}x{task.get('out_height', task['height'])}",
+               "steps": task["steps"], "seed": task["seed"], "index": task["index"], "path": location or task["path"]}
+        if error is None:
+            journal.append({**rec, "status": "done"})
+        else:
+            journal.append({**rec, "status": "failed", "error": error})
+
+    done_count = 0
+    t_start = time.time()
+    try:
+        # 每个任务只生成 1 张（种子各不相同），同尺寸的任务照常合并成一批
+        for batch in zl.iter_batches(pending_tasks(), num_images=1):
+            try:
+                results = zl.generate_batch(pipe, batch, num_images=1, embed_cache=embed_cache, admission=admission)
+            except Exception as e:
+                print(f"[ERROR] 生成失败：{e}")
+                for task in batch:
+                    record(task, error=str(e))
+                continue
+
+            for task, _, image in results:
+                if writer is not None:
+                    writer.submit(
+                        image,
+                        task["path"],
+                        on_done=lambda err, location, task=task: record(task, None if err is None else str(err), location),
+                        meta=zl.image_meta(task, task["index"], job_seed=job_seed),
+                    )
+                else:
+                    as_pil(image).save(task["path"])
+                    record(task)
+            done_count += len(results)
+            elapsed = time.time() - t_start
+            print(f"  已生成 {done_count} 张（跳过已完成 {skipped} 张），{done_count / max(elapsed, 1e-6):.2f} 张/秒")
+    except KeyboardInterrupt:
+        print("\n>> 中断：已完成的图片都记录在 journal 中，重新运行同一命令即可继续。")
+    finally:
+        if writer is not None:
+            writer.flush()
+        journal.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Crash-resumable batch job runner")
+    parser.add_argument("--name", required=True, help="任务名，对应 output/jobs/<name>/")
+    parser.add_argument("--job-seed", type=int, required=True, help="任务种子，每张图的种子由它确定性派生")
+    parser.add_argument("--prompts", default=zl.PROMPT_FILE)
+    parser.add_argument("--count", type=int, default=zl.OUTPUT_NUM, help="每条 prompt 生成几张")
+    parser.add_argument("--stub", action="store_true", help="使用 StubPipeline，不加载模型")
+    args = parser.parse_args()
+
+    zl.USE_STUB = args.stub
+    if not os.path.exists(args.prompts):
+        print(f"[WARN] 任务文件不存在：{args.prompts}")
+        return
+    items = zl.iter_tasks(args.prompts)
+
+    pipe = zl.load_pipeline(image_counts=(1,))   # 任务都是单张，按 1..MAX_BATCH 张预热
+    writer = zl.make_writer()
+    try:
+        run_job(
+            pipe,
+            items,
+            os.path.join(JOBS_DIR, args.name),
+            args.job_seed,
+            args.count,
+            embed_cache=zl.make_embed_cache(pipe),
+            writer=writer,
+            admission=zl.make_admission(pipe),
+        )
+    finally:
+        if writer is not None:
+            writer.close()
+            print(writer.summary())
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,17 @@ import os
 import time
 import datetime
 import re
+import csv
+import json
+import hashlib
+import sys
+import threading
 
-import torch
-from diffusers import ZImagePipeline
+# torch / diffusers 在真正生成时才导入（见 load_pipeline），解析 prompt 文件或直接退出时不付出导入开销
 
 # ===== 配置区域 =====
 MODEL_ID = "Tongyi-MAI/Z-Image-Turbo"
+MODEL_REVISION = "main"            # 模型版本（分支/commit），也用作缓存键的一部分
 PROMPT_FILE = "prompts.txt"        # 同目录下的 prompt 文件
 OUTPUT_DIR = "output"              # 生成图片输出目录
 
@@ -17,8 +22,52 @@ NUM_STEPS = 9                      # 官方推荐 9 步
 GUIDANCE_SCALE = 0.0               # Turbo 必须为 0
 SEED = None                          # 固定随机种子，方便对比效果；为 None 则每次随机
 OUTPUT_NUM = 3                     # 每个 prompt 生成的图片数量
+DEVICE = "cuda"                    # 推理设备
+MAX_BATCH = 6                      # 单次 pipe() 调用最多生成的图片数（同尺寸的多条 prompt 会合并）
+USE_STUB = False                   # True 时使用 zimage_stub.StubPipeline，不加载模型（CPU 测试用）
+EMBED_CACHE = True                 # 缓存 prompt 文本编码结果，重复的 prompt 跳过文本编码器
+EMBED_CACHE_DIR = os.path.join(".cache", "embeds")   # 磁盘缓存目录；为 None 则只用内存
+EMBED_CACHE_MAX_MB = 512           # 内存缓存上限（MB）
+WRITER_THREADS = 4                 # 后台写盘线程数；为 0 则在生成线程里同步保存
+WRITER_MAX_PENDING = 12            # 等待写盘的图片上限，超出时生成线程阻塞（背压）
+OUTPUT_BACKEND = "files"           # "files"：每张图一个文件；"tar"：滚动 tar 分片（WebDataset 格式）
+OUTPUT_FORMAT = "png"              # "png" / "webp"（无损）/ "jpeg"
+JPEG_QUALITY = 95                  # OUTPUT_FORMAT 为 jpeg 时的质量
+SHARD_DIR = os.path.join(OUTPUT_DIR, "shards")   # tar 分片目录
+SHARD_MAX_MB = 1024                # 单个分片的大小上限（MB）
+METRICS_ENABLED = False            # 记录分阶段/逐步耗时（会同步 CUDA，略微降低吞吐）
+METRICS_JSONL = os.path.join(OUTPUT_DIR, "metrics.jsonl")   # 每次 pipe() 调用一行
+METRICS_PORT = None                # 设为端口号（如 9108）时提供 Prometheus /metrics
+COMPILE_TRANSFORMER = False        # pipe.transformer.compile()；首次编译慢，之后更快
+COMPILE_CACHE_DIR = os.path.join(".cache", "compile")   # 编译缓存目录，重启后复用
+MEMORY_ADMISSION = True            # 按预估峰值显存拆分过大的批次，放不下时才退到 CPU offload
+MEMORY_SAFETY = 0.9                # 显存预算 = (空闲 + 已占用) x 该系数
+MEMORY_MODEL_FILE = os.path.join(".cache", "memory_model.json")   # 校准结果，重启后复用
+CALIBRATION_SIZES = [(512, 512, 1), (1024, 1024, 1), (1024, 1024, 2)]   # (宽, 高, 张数)
+QUANTIZE = None                    # None / "int8" / "int4"：transformer 与 text encoder 仅权重量化，显存更省、每步略慢
+QUANT_CACHE_DIR = os.path.join(".cache", "quantized")   # 量化后的权重缓存，启动时不再重新量化
+STEP_CACHE = False                 # DiT 逐步特征缓存：变化小的步复用中间 block 的残差（有损，略快）
+STEP_CACHE_THRESHOLD = 0.1         # 累计相对变化低于该值时跳过；越大越快、质量损失越大
+LAZY_LOAD = True                   # 第一次生成时才加载模型（输入 q 直接退出时不导入 torch）
+MMAP_WEIGHTS = False               # CPU 多进程：权重以内存映射方式加载，各 worker 通过页缓存共享同一份
+RESULT_CACHE = False               # 固定种子时按完整生成参数缓存结果图片，重复运行直接返回
+RESULT_CACHE_DIR = os.path.join(".cache", "results")
+RESULT_CACHE_MAX_MB = 2048         # 结果缓存磁盘上限，超出时按最近最少使用淘汰
+RESULT_CACHE_NORMALIZE = False     # 缓存键忽略空白和标点差异
+POSTPROCESS = "pil"                # "pil"：pipeline 逐张转 PIL；"tensor"：整批张量一次量化为 uint8（更快）
+SNAP_TO_BUCKETS = False            # 把请求尺寸吸附到 SIZE_BUCKETS，生成后缩放裁剪回原尺寸
+SIZE_BUCKETS = [                   # 开启 compile 时建议打开，避免每个新尺寸都重新编译
+    (1024, 1024),
+    (1024, 1360), (1360, 1024),
+    (768, 1024), (1024, 768),
+    (1024, 1536), (1536, 1024),
+]
 # ====================
 
+# 当前这一秒内已分配的文件名主体：同一进程里先后几次 save_results（如服务中两个请求用了同一 prompt）也不会重名
+_claimed_stems = {"ts": None, "stems": set()}
+_claimed_lock = threading.Lock()
+
 
 def slugify(text: str, max_len: int = 40) -> str:
     """
@@ -48,6 +97,101 @@ def parse_size(size_str: str):
         return DEFAULT_WIDTH, DEFAULT_HEIGHT
     return w, h
 
+def parse_prompt_line(raw: str):
+    """
+    解析 prompts.txt 的一行：'1024x1344 || prompt 文本'，省略尺寸时使用默认尺寸。
+    空行、注释行或 prompt 为空时返回 None。
+    """
+    raw = raw.strip()
+    if not raw or raw.startswith("#"):
+        return None
+
+    # 按 '||' 分割：左边尺寸，右边 prompt
+    if "||" in raw:
+        size_part, prompt_part = raw.split("||", 1)
+        prompt = prompt_part.strip()
+        w, h = parse_size(size_part.strip())
+    else:
+        # 如果用户忘写尺寸，则使用默认尺寸
+        prompt = raw
+        w, h = DEFAULT_WIDTH, DEFAULT_HEIGHT
+
+    if not prompt:
+        return None
+    return {"prompt": prompt, "width": w, "height": h}
+
+def parse_record(rec: dict):
+    """
+    把 JSONL/CSV 的一条记录转成任务。字段：
+        prompt（必填）、size（'宽x高'）或 width/height、steps、seed、count、name
+    未给出的字段使用全局默认（DEFAULT_WIDTH/HEIGHT、NUM_STEPS、SEED、OUTPUT_NUM）。
+    CSV 中的空单元格视为未给出。字段不合法时抛出 ValueError。
+    """
+    if not isinstance(rec, dict):
+        raise ValueError(f"记录应为 JSON 对象，收到 {type(rec).__name__}")
+    rec = {k.strip().lower(): v for k, v in rec.items() if k and v not in (None, "")}
+    prompt = str(rec.get("prompt", "")).strip()
+    if not prompt:
+        raise ValueError("缺少 prompt")
+
+    if "size" in rec:
+        w, h = parse_size(str(rec["size"]))
+    else:
+        w = int(rec.get("width", DEFAULT_WIDTH))
+        h = int(rec.get("height", DEFAULT_HEIGHT))
+        if w <= 30 or h <= 30:
+            raise ValueError(f"尺寸过小：{w}x{h}")
+
+    item = {"prompt": prompt, "width": w, "height": h}
+    if "steps" in rec:
+        item["steps"] = int(rec["steps"])
+    if "seed" in rec:
+        item["seed"] = int(rec["seed"])
+    if "count" in rec:
+        item["count"] = max(1, int(rec["count"]))
+    if "name" in rec:
+        item["name"] = slugify(str(rec["name"]), max_len=120)
+    return item
+
+def iter_tasks(path: str):
+    """
+    流式读取任务文件，逐条 yield，内存占用与文件大小无关。
+    按扩展名选择格式：
+        .jsonl  每行一个 JSON 对象（字段见 parse_record）
+        .csv    带表头的 CSV（列名同上）
+        其他    原有的 '1024x1344 || prompt 文本' 格式
+    格式错误的行会打印警告并跳过。
+    """
+    if not os.path.exists(path):
+        print(f"[WARN] Prompt 文件不存在：{path}")
+        return
+
+    ext = os.path.splitext(path)[1].lower()
+    # utf-8-sig：Excel 等导出的 CSV 常带 BOM，否则第一列表头会变成 "\ufeffprompt"
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if ext == ".jsonl":
+            records = ((n, line) for n, line in enumerate(f, start=1) if line.strip())
+            parse = lambda line: parse_record(json.loads(line))
+        elif ext == ".csv":
+            records = enumerate(csv.DictReader(f), start=2)
+            parse = parse_record
+        else:
+            records = enumerate(f, start=1)
+            parse = parse_prompt_line
+
+        for n, rec in records:
+            try:
+                item = parse(rec)
+            except (ValueError, TypeError) as e:
+                print(f"[WARN] {path}:{n} 格式错误，已跳过：{e}")
+                continue
+            if item is None:
+                continue
+            if SNAP_TO_BUCKETS:
+                from zimage_buckets import apply_buckets
+                apply_buckets([item], SIZE_BUCKETS)
+            yield item
+
 def load_prompts(path: str):
     """
     从 prompts.txt 读取多条配置：
@@ -55,56 +199,459 @@ def load_prompts(path: str):
         1024x1344 || prompt 文本
     - 尺寸必须写在左边
     - 空行、以 # 开头的行会被忽略
-    返回：[{ "prompt": str, "width": int, "height": int }, ...]
+    也支持 .jsonl / .csv 任务文件（可逐条覆盖尺寸、步数、种子、张数、文件名），见 iter_tasks()。
+    返回：[{ "prompt": str, "width": int, "height": int, ... }, ...]
     """
-    if not os.path.exists(path):
-        print(f"[WARN] Prompt 文件不存在：{path}")
-        return []
+    return list(iter_tasks(path))
 
-    items = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            raw = line.strip()
-            if not raw:
-                continue
-            if raw.startswith("#"):
-                continue
+def prewarm_batch_sizes(image_counts=()):
+    """
+    make_batches 可能产生的每次 pipe() 图片总数：每种单条张数 n（默认 OUTPUT_NUM，加上任务自带的 count）
+    乘以 1..MAX_BATCH // n 条 prompt；不满一批的尾批也会用到这些批大小。
+    """
+    sizes = set()
+    for n in {OUTPUT_NUM, *image_counts}:
+        for k in range(1, max(1, MAX_BATCH // n) + 1):
+            sizes.add(k * n)
+    return sorted(sizes)
+
+def load_pipeline(device: str = DEVICE, image_counts=()):
+    """
+    加载 Z-Image-Turbo 并移动到 device。
+    USE_STUB 为 True 时返回 zimage_stub.StubPipeline（不加载权重，用于 CPU 上测试）。
+    image_counts：已知的任务自带 count，开启 compile 预热时一并预热对应的批大小。
+    """
+    if USE_STUB:
+        from zimage_stub import StubPipeline
+        print(">> Using stub pipeline (no model weights).")
+        return StubPipeline().to(device)
+
+    if QUANTIZE:
+        from zimage_quant import footprint, load_quantized_pipeline
+        print(f">> Loading Z-Image-Turbo pipeline ({QUANTIZE} weights, bf16 activations)...")
+        pipe = load_quantized_pipeline(MODEL_ID, MODEL_REVISION, bits=int(QUANTIZE[3:]), cache_dir=QUANT_CACHE_DIR)
+        print(f">> 权重体积（MB）：{footprint(pipe)}")
+    elif MMAP_WEIGHTS:
+        from zimage_fastload import load_mmap_pipeline
+        print(">> Loading Z-Image-Turbo pipeline (memory-mapped weights)...")
+        pipe = load_mmap_pipeline(MODEL_ID, MODEL_REVISION)
+    else:
+        import torch
+        from diffusers import ZImagePipeline
+        print(">> Loading Z-Image-Turbo pipeline (bf16, no offload)...")
+        pipe = ZImagePipeline.from_pretrained(
+            MODEL_ID,
+            revision=MODEL_REVISION,
+            torch_dtype=torch.bfloat16,   # 官方推荐：bf16
+            low_cpu_mem_usage=True,      # 可选：节省 CPU 内存
+        )
+    pipe.to(device)
+    pipe.set_progress_bar_config(disable=True)
+    print(f">> Pipeline loaded and moved to {device}.")
+
+    if STEP_CACHE:
+        from zimage_stepcache import enable_step_cache
+        enable_step_cache(pipe.transformer, threshold=STEP_CACHE_THRESHOLD)
+
+    if COMPILE_TRANSFORMER:
+        from zimage_buckets import enable_compile_cache, prewarm, save_compile_cache
+        enable_compile_cache(COMPILE_CACHE_DIR)
+        pipe.transformer.compile()
+        if SNAP_TO_BUCKETS:
+            # 每种可能的批大小都预热（含不满一批的尾批），否则第一次遇到时仍会重新编译
+            prewarm(pipe, SIZE_BUCKETS, prewarm_batch_sizes(image_counts))
+            save_compile_cache(COMPILE_CACHE_DIR)
+    return pipe
+
+def batch_key(item, num_images: int = OUTPUT_NUM):
+    """能合并进同一次 pipe() 调用的任务具有相同的 (宽, 高, 步数, 张数)"""
+    return (
+        item["width"],
+        item["height"],
+        item.get("steps", NUM_STEPS),
+        item.get("count", num_images),
+    )
+
+def make_batches(items, max_batch: int = MAX_BATCH, num_images: int = OUTPUT_NUM):
+    """
+    按 (width, height) 对任务分桶，把同尺寸的不同 prompt 打包成一次 pipe() 调用。
+    每批图片总数 = prompt 数 * num_images，不超过 max_batch（单条 prompt 超出时单独成批）。
+    步数或张数（"steps" / "count"）不同的任务不会同批。
+    桶按首次出现的顺序输出，桶内保持文件中的顺序。
+    返回：[[item, ...], ...]
+    """
+    buckets = {}
+    for item in items:
+        buckets.setdefault(batch_key(item, num_images), []).append(item)
+
+    batches = []
+    for key, bucket in buckets.items():
+        per_batch = max(1, max_batch // max(1, key[3]))
+        for start in range(0, len(bucket), per_batch):
+            batches.append(bucket[start:start + per_batch])
+    return batches
+
+def iter_batches(items, max_batch: int = MAX_BATCH, num_images: int = OUTPUT_NUM, max_pending: int = 256):
+    """
+    make_batches() 的流式版本：items 可以是任意长的迭代器。
+    某个桶凑满一批就立即产出；缓冲的任务超过 max_pending 条时先产出最满的桶，
+    因此内存占用有上限，代价是稀有尺寸的批可能不满。
+    """
+    buckets = {}
+    pending = 0
+    for item in items:
+        key = batch_key(item, num_images)
+        bucket = buckets.setdefault(key, [])
+        bucket.append(item)
+        pending += 1
+        if len(bucket) >= max(1, max_batch // max(1, key[3])):
+            yield buckets.pop(key)
+            pending -= len(bucket)
+        elif pending > max_pending:
+            fullest = max(buckets, key=lambda k: len(buckets[k]) * k[3])
+            flushed = buckets.pop(fullest)
+            pending -= len(flushed)
+            yield flushed
+
+    for bucket in buckets.values():
+        yield bucket
+
+def make_embed_cache(pipe):
+    """按配置创建 EmbeddingCache；关闭或使用 stub 时返回 None"""
+    if not EMBED_CACHE or USE_STUB:
+        return None
+    from zimage_embed_cache import EmbeddingCache
+    return EmbeddingCache(
+        pipe,
+        model_id=MODEL_ID,
+        revision=MODEL_REVISION,
+        max_bytes=EMBED_CACHE_MAX_MB * 1024 * 1024,
+        cache_dir=EMBED_CACHE_DIR,
+        # 量化后的文本编码器输出不同，不能与 bf16 共用缓存
+        variant={"quantize": QUANTIZE} if QUANTIZE else None,
+    )
+
+def make_admission(pipe, device: str = DEVICE):
+    """按配置创建显存准入控制器（仅 CUDA）；首次在该显卡上运行时先做校准"""
+    if not MEMORY_ADMISSION or USE_STUB or not str(device).startswith("cuda"):
+        return None
+    import torch
+    from zimage_memory import AdmissionController, MemoryModel
+    key = f"{torch.cuda.get_device_name(device)}|{pipe.transformer.dtype}"
+    if QUANTIZE:
+        key += f"|{QUANTIZE}"           # 量化后常驻权重不同，单独拟合
+    model = MemoryModel(MEMORY_MODEL_FILE, key=key)
+    admission = AdmissionController(pipe, device, model, safety=MEMORY_SAFETY)
+    if not model.ready:
+        print(">> 首次运行，校准显存模型...")
+        admission.calibrate(CALIBRATION_SIZES)
+    return admission
+
+def generate_batch(
+    pipe,
+    batch,
+    num_images: int = None,
+    device: str = DEVICE,
+    embed_cache=None,
+    recorder=None,
+    admission=None,
+    generators=None,
+    result_cache=None,
+):
+    """
+    对一批同尺寸任务调用一次 pipe(prompt=[...])，并把结果图片映射回各自的任务。
+    diffusers 的输出顺序是按 prompt 展开的：第 k 条 prompt 的图片位于
+    images[k * num_images : (k + 1) * num_images]。
+    传入 embed_cache 时改为传 prompt_embeds，跳过文本编码。
+    单条任务可以带 "steps" / "seed" / "count" 覆盖全局的 NUM_STEPS / SEED / OUTPUT_NUM；
+    num_images 显式给出时优先于 "count"。
+    传入 recorder（zimage_metrics.StageRecorder）时记录分阶段耗时。
+    传入 admission（zimage_memory.AdmissionController）时按显存预算拆成多次调用。
+    generators：与 batch 对齐的 torch.Generator 列表，拆分调用时由 admission 传入以延续随机序列。
+    传入 result_cache（zimage_result_cache.ResultCache）时，带种子且全部张数都已缓存的任务直接返回缓存图片。
+    每条任务只生成 1 张且都带 "latents"（初始噪声张量）时，直接使用这些噪声。
+    返回：[(item, 序号(从1开始), image), ...]
+    """
+    width = batch[0]["width"]
+    height = batch[0]["height"]
+
+    steps = batch[0].get("steps", NUM_STEPS)
+    if num_images is None:
+        num_images = batch[0].get("count", OUTPUT_NUM)
+    seeds = [item.get("seed", SEED) for item in batch]
+
+    if result_cache is not None:
+        return _cached_generate(
+            lambda sub, gens: generate_batch(
+                pipe, sub, num_images, device, embed_cache=embed_cache, recorder=recorder,
+                admission=admission, generators=gens,
+            ),
+            result_cache, batch, num_images, steps, seeds, generators,
+        )
+
+    if admission is not None:
+        return admission.run(
+            lambda sub, n, gens: generate_batch(
+                pipe, sub, n, device, embed_cache=embed_cache, recorder=recorder, generators=gens,
+            ),
+            batch,
+            num_images,
+            seeds,
+        )
+
+    import torch
 
-            # 按 '||' 分割：左边尺寸，右边 prompt
-            if "||" in raw:
-                size_part, prompt_part = raw.split("||", 1)
-                size_part = size_part.strip()
-                prompt = prompt_part.strip()
-                w, h = parse_size(size_part)
+    generator = None
+    if generators is not None and any(g is not None for g in generators):
+        generator = []
+        for g in generators:
+            if g is None:
+                g = torch.Generator(device)
+                g.seed()
+            generator.extend([g] * num_images)
+    elif any(seed is not None for seed in seeds):
+        # 每条 prompt 一个独立的 generator（同一对象重复 num_images 次），
+        # 保证同一 prompt 的结果与它被打包进哪一批无关
+        generator = []
+        for seed in seeds:
+            g = torch.Generator(device)
+            if seed is None:
+                g.seed()
             else:
-                # 如果用户忘写尺寸，则使用默认尺寸
-                prompt = raw
-                w, h = DEFAULT_WIDTH, DEFAULT_HEIGHT
+                g.manual_seed(seed)
+            generator.extend([g] * num_images)
 
-            if not prompt:
-                continue
+    prompts = [item["prompt"] for item in batch]
+    extra_kwargs = {}
+    if recorder is not None:
+        recorder.begin_call(width=width, height=height, num_steps=steps, prompts=len(batch), images=len(batch) * num_images)
+        extra_kwargs["callback_on_step_end"] = recorder.step_callback
 
-            items.append({
-                "prompt": prompt,
-                "width": w,
-                "height": h,
-            })
+    if embed_cache is not None:
+        prompt_kwargs = {"prompt_embeds": embed_cache.get(prompts, device)}
+    else:
+        prompt_kwargs = {"prompt": prompts}
 
-    return items
+    if POSTPROCESS == "tensor":
+        extra_kwargs["output_type"] = "pt"
+    if num_images == 1 and all("latents" in item for item in batch):
+        # 调用方给出了初始噪声（如草稿模式），此时 generator 不再起作用
+        extra_kwargs["latents"] = torch.cat([item["latents"] for item in batch]).to(device)
+        generator = None
 
-def main():
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    call_kwargs = dict(
+        **prompt_kwargs,
+        height=height,
+        width=width,
+        num_inference_steps=steps,
+        guidance_scale=GUIDANCE_SCALE,
+        generator=generator,
+        num_images_per_prompt=num_images,
+        **extra_kwargs,
+    )
+    if recorder is not None:
+        with recorder.stage("pipe_call"):
+            out = pipe(**call_kwargs)
+        recorder.end_call()
+    else:
+        out = pipe(**call_kwargs)
+
+    if POSTPROCESS == "tensor":
+        return _tensor_results(out.images, batch, num_images)
+
+    results = []
+    for k, item in enumerate(batch):
+        for i in range(num_images):
+            image = out.images[k * num_images + i]
+            if "out_width" in item:
+                # 按桶尺寸生成的图片，缩放裁剪回请求的尺寸
+                from zimage_buckets import fit_to_size
+                image = fit_to_size(image, item["out_width"], item["out_height"])
+            results.append((item, i + 1, image))
+    return results
 
-    print(">> Loading Z-Image-Turbo pipeline (bf16, no offload)...")
-    pipe = ZImagePipeline.from_pretrained(
-        MODEL_ID,
-        torch_dtype=torch.bfloat16,   # 官方推荐：bf16
-        low_cpu_mem_usage=True,      # 可选：节省 CPU 内存
+def _cached_generate(generate, result_cache, batch, num_images: int, steps: int, seeds, generators=None):
+    """先查结果缓存，只对未命中的任务调用 generate(子批, generators)，结果按 batch 顺序合并"""
+    keyed = [item if item.get("seed") == seed else {**item, "seed": seed} for item, seed in zip(batch, seeds)]
+    cached = [result_cache.lookup(item, num_images, steps, GUIDANCE_SCALE) for item in keyed]
+    missing = [k for k, images in enumerate(cached) if images is None]
+
+    generated = {}
+    if missing:
+        gens = None if generators is None else [generators[k] for k in missing]
+        results = generate([batch[k] for k in missing], gens)
+        for (item, i, image), k in zip(results, (k for k in missing for _ in range(num_images))):
+            generated.setdefault(k, []).append((item, i, image))
+            result_cache.put(result_cache.key(keyed[k], i, steps, GUIDANCE_SCALE), image)
+
+    results = []
+    for k, item in enumerate(batch):
+        if cached[k] is not None:
+            results.extend((item, i + 1, image) for i, image in enumerate(cached[k]))
+        else:
+            results.extend(generated[k])
+    return results
+
+def _tensor_results(images, batch, num_images: int):
+    """
+    POSTPROCESS="tensor" 时的结果映射：整批 (B, 3, H, W) 张量一次量化为 uint8，
+    每张图是 (H, W, 3) 的 ndarray 视图；分桶生成的图片按目标尺寸分组一起缩放裁剪。
+    """
+    from zimage_postprocess import split_batch, to_uint8
+
+    groups = {}
+    for k, item in enumerate(batch):
+        size = (item["out_width"], item["out_height"]) if "out_width" in item else None
+        groups.setdefault(size, []).append(k)
+
+    arrays = {}
+    for size, ks in groups.items():
+        if len(groups) == 1:
+            sub = images
+        else:
+            idx = [k * num_images + i for k in ks for i in range(num_images)]
+            sub = images[idx]
+        for k, array in zip(
+            [k for k in ks for _ in range(num_images)],
+            split_batch(to_uint8(sub, size)),
+        ):
+            arrays.setdefault(k, []).append(array)
+
+    results = []
+    for k, item in enumerate(batch):
+        for i, array in enumerate(arrays[k]):
+            results.append((item, i + 1, array))
+    return results
+
+def make_recorder(pipe, device: str = DEVICE):
+    """按配置创建分阶段计时器并挂到 pipeline 上；未启用时返回 None"""
+    if not METRICS_ENABLED:
+        return None
+    from zimage_metrics import StageRecorder
+    recorder = StageRecorder(device=device, jsonl_path=METRICS_JSONL).instrument(pipe)
+    if METRICS_PORT:
+        recorder.serve(METRICS_PORT)
+        print(f">> 阶段耗时指标：http://127.0.0.1:{METRICS_PORT}/metrics")
+    return recorder
+
+def make_writer():
+    """
+    按配置创建后台写盘器及输出后端；WRITER_THREADS 为 0 且使用默认的 PNG 文件输出时
+    返回 None（同步保存），其他后端/格式至少使用 1 个写盘线程。
+    """
+    if WRITER_THREADS <= 0 and OUTPUT_BACKEND == "files" and OUTPUT_FORMAT == "png":
+        return None
+    from zimage_writer import AsyncImageWriter, FileBackend, TarShardBackend
+    if OUTPUT_BACKEND == "tar":
+        backend = TarShardBackend(SHARD_DIR, OUTPUT_FORMAT, JPEG_QUALITY, max_bytes=SHARD_MAX_MB * 1024 * 1024)
+    elif OUTPUT_BACKEND == "files":
+        backend = FileBackend(OUTPUT_FORMAT, JPEG_QUALITY)
+    else:
+        raise ValueError(f"未知的 OUTPUT_BACKEND：{OUTPUT_BACKEND}")
+    return AsyncImageWriter(max_workers=max(1, WRITER_THREADS), max_pending=WRITER_MAX_PENDING, backend=backend)
+
+def output_ext(writer) -> str:
+    """输出文件扩展名：同步保存时总是 PNG，后台写盘时取决于 OUTPUT_FORMAT"""
+    if writer is None:
+        return ".png"
+    from zimage_writer import format_ext
+    return format_ext(OUTPUT_FORMAT)
+
+def image_meta(item, index: int, **extra):
+    """写入 tar 分片 .json 附属文件的元数据"""
+    return {
+        "prompt": item["prompt"],
+        "width": item.get("out_width", item["width"]),
+        "height": item.get("out_height", item["height"]),
+        "steps": item.get("steps", NUM_STEPS),
+        "seed": item.get("seed", SEED),
+        "index": index,
+        "model": MODEL_ID,
+        "revision": MODEL_REVISION,
+        **extra,
+    }
+
+def _unique_stem(stem: str, used: set, position: int) -> str:
+    """stem 已被占用时追加 -位置（仍冲突则继续递增），并登记到 used"""
+    base = stem
+    while stem in used:
+        stem = f"{base}-{position}"
+        position += 1
+    used.add(stem)
+    return stem
+
+def save_results(results, output_dir: str = OUTPUT_DIR, writer=None, meta=None):
+    """
+    保存 generate_batch() 的结果，命名：时间戳_宽x高_描述_哈希_序号.png；
+    任务带 "name" 时命名为 name_序号.png。同一批中重复的 prompt / name、
+    以及同一秒内本进程已用过的主体，在主体后追加批内位置
+    传入 writer 时交给后台线程编码写盘（按 OUTPUT_BACKEND / OUTPUT_FORMAT），本函数只在队列满时阻塞。
+    meta：附加到每张图元数据中的字段（如生成耗时）。
+    返回保存路径列表（与 results 顺序一致）
+    """
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    ext = output_ext(writer)
+    paths = []
+    stems = {}      # id(item) -> 文件名主体
+    named = set()
+    for item, i, image in results:
+        stem = stems.get(id(item))
+        if stem is None:
+            if item.get("name"):
+                stem = _unique_stem(item["name"], named, len(stems))
+            else:
+                # 描述只取前 40 个字符，加上 prompt 的短哈希区分前缀相同的 prompt
+                slug = slugify(item["prompt"])
+                digest = hashlib.sha1(item["prompt"].encode("utf-8")).hexdigest()[:6]
+                width = item.get("out_width", item["width"])
+                height = item.get("out_height", item["height"])
+                with _claimed_lock:
+                    if _claimed_stems["ts"] != ts:
+                        _claimed_stems["ts"], _claimed_stems["stems"] = ts, set()
+                    stem = _unique_stem(f"{ts}_{width}x{height}_{slug}_{digest}", _claimed_stems["stems"], len(stems))
+            stems[id(item)] = stem
+        filename = f"{stem}_{i}{ext}"
+        save_path = os.path.join(output_dir, filename)
+        if writer is not None:
+            writer.submit(image, save_path, meta=image_meta(item, i, **(meta or {})))
+        else:
+            if not hasattr(image, "save"):
+                from zimage_writer import as_pil
+                image = as_pil(image)
+            image.save(save_path)
+            print(f"  -> 保存到 {save_path}")
+        paths.append(save_path)
+    return paths
+
+def make_result_cache():
+    if not RESULT_CACHE:
+        return None
+    from zimage_result_cache import ResultCache
+    variant = {
+        "quantize": QUANTIZE,
+        "step_cache": STEP_CACHE_THRESHOLD if STEP_CACHE else None,
+        "stub": USE_STUB,
+        # 后处理路径决定量化方式和分桶缩放算法（PIL LANCZOS / torch bicubic），像素会略有不同
+        "postprocess": POSTPROCESS,
+        "resize": "torch-bicubic" if POSTPROCESS == "tensor" else "pil-lanczos",
+    }
+    return ResultCache(
+        RESULT_CACHE_DIR,
+        max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+        normalize=RESULT_CACHE_NORMALIZE,
+        model_id=MODEL_ID,
+        revision=MODEL_REVISION,
+        variant=variant,
+        array_output=(POSTPROCESS == "tensor"),
     )
-    pipe.to("cuda")
-    pipe.set_progress_bar_config(disable=True)
-    print(">> Pipeline loaded and moved to CUDA.")
 
+def load_runtime(device: str = DEVICE, image_counts=()):
+    """加载模型及依赖它的组件：(pipe, embed_cache, recorder, admission, result_cache)"""
+    pipe = load_pipeline(device, image_counts)
+    return pipe, make_embed_cache(pipe), make_recorder(pipe), make_admission(pipe, device), make_result_cache()
+
+def run_interactive(pipe, embed_cache=None, writer=None, recorder=None, admission=None, result_cache=None):
+    """pipe 为 None 时在第一次有任务的生成轮次才调用 load_runtime()"""
     print(f"\n使用说明：")
     print(f"- 在当前目录创建/编辑 {PROMPT_FILE}，每一行一条任务：")
     print(f"    prompt 文本 || 1024x1024")
@@ -114,53 +661,107 @@ def main():
     print(f"- 每次修改 {PROMPT_FILE} 后，回到程序按回车，就会重新读取文件并生成。")
     print(f"- 输入 q 回车可以退出程序。\n")
 
-    while True:
-        cmd = input("按回车开始本轮生成（或输入 q 回车退出）：").strip().lower()
-        if cmd in {"q", "quit", "exit"}:
-            print("退出程序。")
-            break
-
-        items = load_prompts(PROMPT_FILE)
-        if not items:
-            print(f"[WARN] 没有在 {PROMPT_FILE} 中读到有效内容（可能是空文件或只有注释）。")
-            continue
-
-        print(f"\n本轮共 {len(items)} 条任务，将逐条生成：\n")
-
-        for idx, item in enumerate(items, start=1):
-            prompt = item["prompt"]
-            width = item["width"]
-            height = item["height"]
-
-            print(f"[{idx}/{len(items)}] prompt: {prompt}")
-            print(f"    size: {width}x{height}")
-
-            generator = None
-            if SEED is not None:
-                generator = torch.Generator("cuda").manual_seed(SEED)
-
-            t0 = time.time()
-            out = pipe(
-                prompt=prompt,
-                height=height,
-                width=width,
-                num_inference_steps=NUM_STEPS,
-                guidance_scale=GUIDANCE_SCALE,
-                generator=generator,
-                num_images_per_prompt=OUTPUT_NUM,
-            )
-            t1 = time.time()
-
-            ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            slug = slugify(prompt)
-
-            for i, image in enumerate(out.images):
-                filename = f"{ts}_{width}x{height}_{slug}_{i+1}.png"
-                save_path = os.path.join(OUTPUT_DIR, filename)
-                image.save(save_path)
-                print(f"  -> 保存到 {save_path}")
-
-            print(f"总用时 {t1 - t0:.2f} 秒\n")
+    try:
+        while True:
+            cmd = input("按回车开始本轮生成（或输入 q 回车退出）：").strip().lower()
+            if cmd in {"q", "quit", "exit"}:
+                print("退出程序。")
+                break
+
+            items = load_prompts(PROMPT_FILE)
+            if not items:
+                print(f"[WARN] 没有在 {PROMPT_FILE} 中读到有效内容（可能是空文件或只有注释）。")
+                continue
+
+            if pipe is None:
+                image_counts = {item["count"] for item in items if "count" in item}
+                pipe, embed_cache, recorder, admission, result_cache = load_runtime(image_counts=image_counts)
+
+            batches = make_batches(items)
+            round_start = (writer.written, writer.write_seconds) if writer is not None else None
+            print(f"\n本轮共 {len(items)} 条任务，按尺寸合并为 {len(batches)} 批生成：\n")
+
+            done = 0
+            for batch in batches:
+                width = batch[0]["width"]
+                height = batch[0]["height"]
+                for item in batch:
+                    done += 1
+                    print(f"[{done}/{len(items)}] prompt: {item['prompt']}")
+                print(f"    size: {width}x{height}, 本批 {len(batch)} 条 x {batch[0].get('count', OUTPUT_NUM)} 张")
+
+                t0 = time.time()
+                results = generate_batch(
+                    pipe, batch, embed_cache=embed_cache, recorder=recorder, admission=admission, result_cache=result_cache,
+                )
+                t1 = time.time()
+                meta = {"gen_seconds": round(t1 - t0, 3), "batch_images": len(results)}
+                if recorder is not None:
+                    with recorder.stage("save"):
+                        save_results(results, writer=writer, meta=meta)
+                else:
+                    save_results(results, writer=writer, meta=meta)
+                t2 = time.time()
+
+                n_images = len(results)
+                if writer is not None:
+                    # 后台写盘：这里只是提交（队列满时等待空位），实际写盘时间在本轮结束时汇总
+                    write_note = f"提交写盘队列 {t2 - t1:.2f} 秒"
+                else:
+                    write_note = f"写盘 {t2 - t1:.2f} 秒"
+                print(
+                    f"生成用时 {t1 - t0:.2f} 秒（{n_images} 张，{n_images / max(t1 - t0, 1e-6):.2f} 张/秒），"
+                    f"{write_note}\n"
+                )
+
+            if writer is not None:
+                t_flush = time.time()
+                failures = writer.flush()
+                round_written = writer.written - round_start[0]
+                round_seconds = writer.write_seconds - round_start[1]
+                print(
+                    f"本轮写盘 {round_written} 张，后台编码+写盘共 {round_seconds:.2f} 秒，"
+                    f"生成结束后等待写完 {time.time() - t_flush:.2f} 秒"
+                )
+                if failures:
+                    print(f"[WARN] 本轮 {len(failures)} 张写盘失败：{', '.join(sorted(failures))}")
+                print(writer.summary())
+            if embed_cache is not None:
+                print(embed_cache.summary())
+            if result_cache is not None:
+                result_cache.save_index()
+                print(result_cache.summary())
+            if recorder is not None:
+                print(recorder.summary())
+            if admission is not None:
+                print(admission.summary())
+            if STEP_CACHE and not USE_STUB:
+                from zimage_stepcache import step_cache_of
+                print(step_cache_of(pipe.transformer).summary())
+            print()
+    finally:
+        # Ctrl-C 或本轮中途出错时也保存结果缓存索引（懒加载时 result_cache 只存在于本函数内）
+        if result_cache is not None:
+            result_cache.save_index()
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    writer = make_writer()
+    pipe = embed_cache = recorder = admission = result_cache = None
+    if not LAZY_LOAD:
+        pipe, embed_cache, recorder, admission, result_cache = load_runtime()
+
+    try:
+        run_interactive(pipe, embed_cache, writer, recorder, admission, result_cache)
+    finally:
+        if COMPILE_TRANSFORMER and not USE_STUB and "torch" in sys.modules:
+            from zimage_buckets import save_compile_cache
+            save_compile_cache(COMPILE_CACHE_DIR)
+        if writer is not None:
+            print(">> 等待后台写盘完成...")
+            writer.close()
+            print(writer.summary())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
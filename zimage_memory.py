@@ -0,0 +1,214 @@
+"""
+显存感知的准入控制：按预估峰值显存把大任务拆成多次 pipe() 调用，而不是 OOM。
+
+pipe(..., num_images_per_prompt=OUTPUT_NUM) 完全不看宽高，1024x1360 x3 可能直接打爆显存、
+让整轮生成中途退出。这里用一个线性模型估计峰值显存：
+    peak_bytes ≈ base + per_pixel * (width * height * 图片数)
+base 主要是常驻权重，per_pixel 是激活和 VAE 解码随像素数增长的部分。
+模型参数来自启动时的校准运行，之后每次实际生成都会加入新样本继续修正，并保存到磁盘。
+
+AdmissionController.run() 把 (多条 prompt x 张数) 的一批任务拆成能放进当前显存预算的子批：
+先按 prompt 拆，单条 prompt 也放不下时再按张数拆；连 1 张都放不下时临时切到
+enable_model_cpu_offload()。预估失误仍然 OOM 时，把子批减半重试。
+同一 prompt 拆开的多次调用共用同一个 generator，结果与不拆分时一致。
+"""
+import json
+import os
+import time
+
+import torch
+
+
+class MemoryModel:
+    def __init__(self, path: str = None, key: str = "default"):
+        self.path = path
+        self.key = key                 # 设备名 + dtype，不同显卡/精度分开拟合
+        self.samples = []              # [(pixels, peak_bytes), ...]
+        self.base = None
+        self.per_pixel = None
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f).get(key, {})
+                self.samples = [tuple(s) for s in data.get("samples", [])]
+                self._fit()
+            except (OSError, ValueError) as e:
+                print(f"[WARN] 显存模型读取失败，将重新校准：{e}")
+
+    @property
+    def ready(self) -> bool:
+        return self.per_pixel is not None
+
+    def add(self, pixels: int, peak_bytes: int):
+        self.samples.append((int(pixels), int(peak_bytes)))
+        del self.samples[:-200]
+        self._fit()
+
+    def _fit(self):
+        """最小二乘拟合 peak = base + per_pixel * pixels；至少需要两个不同的像素数"""
+        if len({p for p, _ in self.samples}) < 2:
+            return
+        n = len(self.samples)
+        mean_x = sum(p for p, _ in self.samples) / n
+        mean_y = sum(b for _, b in self.samples) / n
+        var = sum((p - mean_x) ** 2 for p, _ in self.samples)
+        cov = sum((p - mean_x) * (b - mean_y) for p, b in self.samples)
+        per_pixel = max(cov / var, 0.0)
+        base = mean_y - per_pixel * mean_x
+        # 取样本残差的最大值作为余量，宁可保守
+        margin = max(b - (base + per_pixel * p) for p, b in self.samples)
+        self.per_pixel = per_pixel
+        self.base = base + max(margin, 0.0)
+
+    def estimate(self, width: int, height: int, images: int) -> float:
+        return self.base + self.per_pixel * width * height * images
+
+    def max_images(self, width: int, height: int, budget: float) -> int:
+        """在 budget 字节内一次最多能生成几张"""
+        if not self.ready:
+            return 1 << 30
+        if self.per_pixel == 0:
+            return 1 << 30 if self.base <= budget else 0
+        return max(0, int((budget - self.base) // (self.per_pixel * width * height)))
+
+    def save(self):
+        if not self.path:
+            return
+        data = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+        data[self.key] = {"samples": self.samples, "base": self.base, "per_pixel": self.per_pixel}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class AdmissionController:
+    def __init__(self, pipe, device: str, model: MemoryModel, safety: float = 0.9):
+        self.pipe = pipe
+        self.device = device
+        self.model = model
+        self.safety = safety
+        self.splits = 0                # 被拆分的批次数
+        self.oom_retries = 0
+        self.offloaded_jobs = 0
+
+    def budget(self) -> float:
+        """当前可用于一次生成的显存上限：空闲显存 + 本进程已占用（权重等），乘以安全系数"""
+        free, _ = torch.cuda.mem_get_info(self.device)
+        return (free + torch.cuda.memory_allocated(self.device)) * self.safety
+
+    def calibrate(self, sizes, steps: int = 1):
+        """用少量短步数的生成校准显存模型，sizes 为 [(width, height, images), ...]"""
+        for width, height, images in sizes:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            t0 = time.time()
+            self.pipe(
+                prompt="calibration",
+                height=height,
+                width=width,
+                num_inference_steps=steps,
+                guidance_scale=0.0,
+                num_images_per_prompt=images,
+            )
+            peak = torch.cuda.max_memory_allocated(self.device)
+            self.model.add(width * height * images, peak)
+            print(f">> 显存校准 {width}x{height} x{images}：峰值 {peak / 2**30:.2f} GB（{time.time() - t0:.1f} 秒）")
+        self.model.save()
+
+    def _observe(self, generate, batch, num_images, generators):
+        """执行一次子批并把实测峰值加入模型"""
+        torch.cuda.reset_peak_memory_stats(self.device)
+        results = generate(batch, num_images, generators)
+        width, height = batch[0]["width"], batch[0]["height"]
+        self.model.add(width * height * len(batch) * num_images, torch.cuda.max_memory_allocated(self.device))
+        return results
+
+    def _plan(self, width: int, height: int, prompts: int, num_images: int):
+        """返回 (每个子批的 prompt 数, 每次调用的张数)；放不下 1 张时返回 None"""
+        fit = self.model.max_images(width, height, self.budget())
+        if fit >= prompts * num_images:
+            return prompts, num_images
+        if fit >= num_images:
+            return fit // num_images, num_images
+        if fit >= 1:
+            return 1, fit
+        return None
+
+    def run(self, generate, batch, num_images: int, seeds):
+        """
+        generate(batch, num_images, generators) -> [(item, 序号, image), ...]
+        seeds 与 batch 对齐（None 表示随机）。据此创建的 generator 列表会传给每次子调用，
+        拆分后继续使用同一个 generator，保证随机序列连续。
+        """
+        generators = [None if seed is None else torch.Generator(self.device).manual_seed(seed) for seed in seeds]
+
+        width, height = batch[0]["width"], batch[0]["height"]
+        plan = self._plan(width, height, len(batch), num_images)
+        if plan is None:
+            return self._run_offloaded(generate, batch, num_images, generators)
+
+        per_call_prompts, per_call_images = plan
+        if (per_call_prompts, per_call_images) != (len(batch), num_images):
+            self.splits += 1
+            est = self.model.estimate(width, height, len(batch) * num_images)
+            print(f"  [mem] 预估峰值 {est / 2**30:.1f} GB 超出预算 {self.budget() / 2**30:.1f} GB，"
+                  f"拆分为每次 {per_call_prompts} 条 x {per_call_images} 张")
+
+        results = []
+        for start in range(0, len(batch), per_call_prompts):
+            sub = batch[start:start + per_call_prompts]
+            sub_gens = generators[start:start + per_call_prompts]
+            done = 0
+            while done < num_images:
+                n = min(per_call_images, num_images - done)
+                try:
+                    part = self._observe(generate, sub, n, sub_gens)
+                except torch.cuda.OutOfMemoryError:
+                    torch.cuda.empty_cache()
+                    self.oom_retries += 1
+                    if n == 1 and len(sub) == 1:
+                        part = self._run_offloaded(generate, sub, 1, sub_gens)
+                    elif len(sub) > 1:
+                        # 先把 prompt 数减半，递归处理
+                        half = len(sub) // 2
+                        print(f"  [mem] OOM，子批减半重试（{len(sub)} -> {half} 条）")
+                        sub_seeds = seeds[start:start + per_call_prompts]
+                        part = (self.run(generate, sub[:half], num_images, sub_seeds[:half])
+                                + self.run(generate, sub[half:], num_images, sub_seeds[half:]))
+                        results.extend(part)
+                        break
+                    else:
+                        per_call_images = max(1, n // 2)
+                        print(f"  [mem] OOM，每次张数减半重试（{n} -> {per_call_images}）")
+                        continue
+                results.extend((item, i + done, image) for item, i, image in part)
+                done += n
+        self.model.save()
+        return results
+
+    def _run_offloaded(self, generate, batch, num_images, generators):
+        """连 1 张都放不下：临时打开 CPU offload 逐张生成，结束后恢复"""
+        print("  [mem] 显存不足以生成 1 张，本任务临时启用 CPU offload")
+        self.offloaded_jobs += 1
+        self.pipe.enable_model_cpu_offload(device=self.device)
+        try:
+            results = []
+            for k, item in enumerate(batch):
+                for i in range(num_images):
+                    part = generate([item], 1, generators[k:k + 1])
+                    results.extend((it, i + 1, image) for it, _, image in part)
+            return results
+        finally:
+            self.pipe.remove_all_hooks()
+            self.pipe.to(self.device)
+
+    def summary(self) -> str:
+        return (f"显存准入：拆分 {self.splits} 批，OOM 重试 {self.oom_retries} 次，"
+                f"offload {self.offloaded_jobs} 次")
@@ -0,0 +1,217 @@
+"""
+生成过程的分阶段耗时统计。
+
+原来只有整个 pipe() 调用的一个总时间，看不出时间花在文本编码、DiT 前向、
+VAE 解码、转 PIL 还是写盘上。StageRecorder 通过 module hook、方法包装和
+callback_on_step_end 记录：
+    text_encode   文本编码器前向
+    dit_forward   每次 transformer 前向
+    denoise_step  每个去噪步（相邻两次 step 回调之间）
+    vae_decode    VAE 解码
+    postprocess   张量 -> PIL
+    pipe_call     整个 pipe() 调用
+    save          保存（后台写盘时为提交耗时）
+每个阶段保留滚动直方图，可导出为 JSONL（每次调用一行）和 Prometheus 文本格式。
+未启用时不注册任何 hook，调用方拿到的是 None，开销为零。
+"""
+import functools
+import http.server
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 直方图桶上界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class RollingHistogram:
+    """累计的分桶计数 + 最近 window 个样本（用于分位数）"""
+
+    def __init__(self, window: int = 1000):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.n = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.n += 1
+        self.total += value
+        self.recent.append(value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StageRecorder:
+    def __init__(self, device: str = "cuda", jsonl_path: str = None, sync: bool = True):
+        self.device = str(device)
+        # CUDA 是异步执行的，不同步的话阶段时间会被记到后面的阶段上
+        self.sync = sync and self.device.startswith("cuda")
+        self.jsonl_path = jsonl_path
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._call = None              # 当前 pipe() 调用的记录
+        self._open = {}                # 正在计时的 hook 阶段 -> 开始时间
+        self._step_t0 = None
+        self._handles = []
+
+    # ----- 计时原语 -----
+    def _now(self) -> float:
+        if self.sync:
+            import torch
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = RollingHistogram()
+            hist.observe(seconds)
+        if self._call is not None:
+            stages = self._call["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = self._now()
+        try:
+            yield
+        finally:
+            self.observe(name, self._now() - t0)
+
+    # ----- pipeline 挂钩 -----
+    def _hook_module(self, module, stage: str, on_start=None):
+        def pre(mod, args):
+            if on_start is not None:
+                on_start()
+            self._open[stage] = self._now()
+
+        def post(mod, args, output):
+            t0 = self._open.pop(stage, None)
+            if t0 is not None:
+                self.observe(stage, self._now() - t0)
+
+        self._handles.append(module.register_forward_pre_hook(pre))
+        self._handles.append(module.register_forward_hook(post))
+
+    def _wrap_method(self, owner, name: str, stage: str):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            with self.stage(stage):
+                return original(*args, **kwargs)
+
+        setattr(owner, name, wrapper)
+        self._handles.append(_Restore(owner, name))
+
+    def _mark_denoise_start(self):
+        if self._step_t0 is None:
+            self._step_t0 = self._now()
+
+    def instrument(self, pipe):
+        """给 pipeline 各组件挂上计时 hook；stub pipeline 没有这些组件时跳过"""
+        if getattr(pipe, "text_encoder", None) is not None:
+            self._hook_module(pipe.text_encoder, "text_encode")
+        if getattr(pipe, "transformer", None) is not None:
+            self._hook_module(pipe.transformer, "dit_forward", on_start=self._mark_denoise_start)
+        if getattr(pipe, "vae", None) is not None:
+            self._wrap_method(pipe.vae, "decode", "vae_decode")
+        if getattr(pipe, "image_processor", None) is not None:
+            self._wrap_method(pipe.image_processor, "postprocess", "postprocess")
+        return self
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def step_callback(self, pipe, step_index, timestep, callback_kwargs):
+        """作为 callback_on_step_end 传给 pipe()，记录每个去噪步的耗时"""
+        now = self._now()
+        if self._step_t0 is not None:
+            seconds = now - self._step_t0
+            self.observe("denoise_step", seconds)
+            if self._call is not None:
+                self._call["steps"].append(round(seconds, 5))
+        self._step_t0 = now
+        return callback_kwargs
+
+    # ----- 每次调用的记录 -----
+    def begin_call(self, **info):
+        self._call = {"time": time.time(), **info, "stages": {}, "steps": []}
+        self._step_t0 = None
+
+    def end_call(self, **info):
+        call, self._call = self._call, None
+        if call is None:
+            return None
+        call.update(info)
+        call["stages"] = {k: round(v, 5) for k, v in call["stages"].items()}
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(call, ensure_ascii=False) + "\n")
+        return call
+
+    # ----- 导出 -----
+    def summary(self) -> str:
+        parts = []
+        with self._lock:
+            for stage, hist in self.histograms.items():
+                parts.append(f"{stage} p50 {hist.quantile(0.5) * 1000:.1f}ms/p95 {hist.quantile(0.95) * 1000:.1f}ms (n={hist.n})")
+        return "阶段耗时：" + "；".join(parts)
+
+    def prometheus_text(self) -> str:
+        lines = ["# TYPE zimage_stage_seconds histogram"]
+        with self._lock:
+            for stage, hist in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'zimage_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'zimage_stage_seconds_sum{{stage="{stage}"}} {hist.total:.6f}')
+                lines.append(f'zimage_stage_seconds_count{{stage="{stage}"}} {hist.n}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """在后台线程开一个 /metrics 端点"""
+        recorder = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = recorder.prometheus_text().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+        return server
+
+
+class _Restore:
+    """与 hook handle 同样的 remove() 接口，用于还原被包装的方法"""
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def remove(self):
+        # 包装器是实例属性，删除后回落到类上的原方法
+        self.owner.__dict__.pop(self.name, None)
@@ -0,0 +1,44 @@
+"""
+张量原生的后处理：跳过 PIL 的逐张转换。
+
+默认路径让 pipeline 输出 PIL 图片（output_type="pil"），每张图单独做 float -> uint8、
+创建 PIL 对象，之后再由 PIL 编码。这里改为 output_type="pt"：
+整批结果保持为一个 (B, 3, H, W) 的 [0, 1] 张量，在设备上一次完成
+可选的缩放裁剪、clamp、量化为 uint8 和转为 NHWC，再一次性拷回 CPU（uint8 只有 float32 的 1/4 大小）。
+返回的每张图是同一块连续 ndarray 上的 (H, W, 3) 视图，直接交给编码器/分片写入器。
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def cover_crop(images, width: int, height: int):
+    """(B, C, H, W) 张量等比缩放到覆盖 (width, height) 后居中裁剪"""
+    _, _, h, w = images.shape
+    if (w, h) == (width, height):
+        return images
+    scale = max(width / w, height / h)
+    new_w, new_h = max(width, round(w * scale)), max(height, round(h * scale))
+    images = F.interpolate(images, size=(new_h, new_w), mode="bicubic", antialias=True, align_corners=False)
+    top = (new_h - height) // 2
+    left = (new_w - width) // 2
+    return images[:, :, top:top + height, left:left + width]
+
+def to_uint8(images, size=None) -> np.ndarray:
+    """
+    把 [0, 1] 范围的图片批量转成 uint8 的 (B, H, W, 3) 连续数组。
+    images 可以是 (B, 3, H, W) 的 torch 张量（output_type="pt"）或 (B, H, W, 3) 的 ndarray（output_type="np"）。
+    size=(width, height) 时顺带做缩放裁剪（仅张量输入）。
+    """
+    if isinstance(images, np.ndarray):
+        return np.clip(images * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+    with torch.no_grad():
+        if size is not None:
+            images = cover_crop(images.float(), *size)
+        images = images.clamp(0, 1).mul(255).round_().to(torch.uint8)
+        return images.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+def split_batch(array: np.ndarray):
+    """把 (B, H, W, 3) 数组拆成 B 个视图（不拷贝）"""
+    return [array[i] for i in range(array.shape[0])]
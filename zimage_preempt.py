@@ -0,0 +1,386 @@
+"""
+按去噪步粒度抢占的优先级调度：交互预览不再排在整轮批量任务之后。
+
+一次 pipe() 调用会独占设备直到整张图完成。StepScheduler 自己驱动 ZImagePipeline 的去噪循环
+（文本编码 -> 初始噪声 -> 逐步 transformer + scheduler.step -> VAE 解码），每个任务持有
+自己的 latents 和一份 scheduler 副本，因此可以在任意两步之间暂停、先跑更高优先级的任务、再继续。
+
+每执行一步前重新选择任务：
+- 不同优先级类别之间严格优先（interactive 先于 bulk），在步边界抢占
+- 同一类别内按提交者做加权公平分享：每个提交者有虚拟时间，执行一步后按 耗时 / 权重 累加，
+  总是选虚拟时间最小的提交者；新加入的提交者从当前最小虚拟时间开始，不会因为之前空闲而独占
+- 同一提交者的任务按提交顺序执行
+report() 给出每个类别排队延迟（提交 -> 第一步）与总延迟的 p50 / p95；
+summary() 把跨类别抢占和同类别内的公平切换分开计数。
+
+CPU 上用随机初始化的极小模型对比 FIFO 与抢占调度：
+    python zimage_preempt.py --tiny --device cpu
+检查逐步循环与 pipe() 在相同种子下输出一致：
+    python zimage_preempt.py --tiny --device cpu --verify
+"""
+import argparse
+import copy
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from zimage_stepcache import step_cache_of
+
+CLASS_PRIORITY = {"interactive": 0, "bulk": 1}   # 数值越小优先级越高
+
+
+def _pipeline_helpers():
+    try:
+        from diffusers.pipelines.z_image.pipeline_z_image import calculate_shift, retrieve_timesteps
+    except ImportError:
+        from diffusers.pipelines.flux.pipeline_flux import calculate_shift, retrieve_timesteps
+    return calculate_shift, retrieve_timesteps
+
+def _default_sigmas(steps: int):
+    """较新的 diffusers 中 ZImagePipeline 显式传入 sigmas；旧版本没有这个函数，返回 None"""
+    try:
+        from diffusers.pipelines.z_image.pipeline_z_image import get_default_z_image_sigmas
+    except ImportError:
+        return None
+    return get_default_z_image_sigmas(steps)
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, prompt: str, width: int, height: int, steps: int = 9, seed: int = None,
+                 num_images: int = 1, klass: str = "bulk", submitter: str = "default"):
+        if klass not in CLASS_PRIORITY:
+            raise ValueError(f"未知的优先级类别：{klass}")
+        self.id = next(Job._ids)
+        self.prompt = prompt
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.seed = seed if seed is not None else random.randrange(1 << 63)
+        self.num_images = num_images
+        self.klass = klass
+        self.submitter = submitter
+        self.future = Future()
+
+        # 去噪状态：第一次被调度时准备
+        self.latents = None
+        self.prompt_embeds = None
+        self.scheduler = None
+        self.timesteps = None
+        self.step_index = 0
+        self.step_cache_state = None   # 开启步缓存时本任务的缓存状态（residual 等），切换任务时换入换出
+
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.paused = 0                # 被其他任务打断的次数（跨类别抢占与同类别公平切换都算）
+
+    @property
+    def done(self) -> bool:
+        return self.timesteps is not None and self.step_index >= len(self.timesteps)
+
+
+class StepScheduler:
+    def __init__(self, pipe, device: str = "cuda", weights=None, policy: str = "priority"):
+        """
+        weights：提交者 -> 权重（默认 1）
+        policy："priority"（按步抢占 + 加权公平）或 "fifo"（按提交顺序整任务执行，用作对比基线）
+        """
+        if policy not in ("priority", "fifo"):
+            raise ValueError(f"未知的调度策略：{policy}")
+        self.pipe = pipe
+        self.device = device
+        self.weights = dict(weights or {})
+        self.policy = policy
+
+        self._queues = {}              # (类别, 提交者) -> [Job, ...]
+        self._vtime = {}               # 提交者 -> 虚拟时间
+        self._order = []               # fifo 策略下的提交顺序
+        self._cond = threading.Condition()
+        self._current = None
+        self._closed = False
+        self.completed = []
+        self.preemptions = 0           # 被更高优先级类别的任务抢占的次数
+        self.fair_switches = 0         # 同一类别内按加权公平分享切换提交者的次数
+        self._worker = threading.Thread(target=self._run, name="zimage-step-scheduler", daemon=True)
+        self._worker.start()
+
+    # ----- 提交 -----
+    def submit(self, prompt: str, width: int, height: int, klass: str = "bulk", submitter: str = "default",
+               steps: int = 9, seed: int = None, num_images: int = 1) -> Future:
+        """提交任务，返回 Future，结果为 PIL 图片列表"""
+        job = Job(prompt, width, height, steps, seed, num_images, klass, submitter)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("调度器已关闭")
+            if submitter not in self._vtime or not self._has_work(submitter):
+                active = [v for s, v in self._vtime.items() if self._has_work(s)]
+                self._vtime[submitter] = max(self._vtime.get(submitter, 0.0), min(active, default=0.0))
+            self._queues.setdefault((klass, submitter), []).append(job)
+            self._order.append(job)
+            self._cond.notify()
+        return job.future
+
+    def _has_work(self, submitter: str) -> bool:
+        return any(q for (_, s), q in self._queues.items() if s == submitter)
+
+    def close(self, wait: bool = True):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if wait:
+            self._worker.join()
+
+    # ----- 选择 -----
+    def _pick(self):
+        if self.policy == "fifo":
+            return self._order[0] if self._order else None
+        candidates = [(k, s) for (k, s), q in self._queues.items() if q]
+        if not candidates:
+            return None
+        top = min(CLASS_PRIORITY[k] for k, _ in candidates)
+        klass, submitter = min(
+            ((k, s) for k, s in candidates if CLASS_PRIORITY[k] == top),
+            key=lambda ks: self._vtime[ks[1]],
+        )
+        return self._queues[(klass, submitter)][0]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._pick()
+                while job is None and not self._closed:
+                    self._cond.wait()
+                    job = self._pick()
+                if job is None:
+                    return
+                previous = self._current
+                if previous is not None and previous is not job and not previous.done:
+                    previous.paused += 1
+                    if previous.klass != job.klass:
+                        self.preemptions += 1
+                    else:
+                        self.fair_switches += 1
+                self._current = job
+
+            t0 = time.perf_counter()
+            try:
+                self._advance(job)
+            except Exception as e:
+                job.future.set_exception(e)
+                self._finish(job)
+                continue
+            elapsed = time.perf_counter() - t0
+
+            with self._cond:
+                self._vtime[job.submitter] += elapsed / self.weights.get(job.submitter, 1.0)
+            if job.done:
+                try:
+                    images = self._decode(job)
+                except Exception as e:
+                    job.future.set_exception(e)
+                else:
+                    job.future.set_result(images)
+                self._finish(job)
+
+    def _finish(self, job: Job):
+        job.finished_at = time.perf_counter()
+        job.latents = job.prompt_embeds = job.scheduler = job.step_cache_state = None
+        with self._cond:
+            self._queues[(job.klass, job.submitter)].remove(job)
+            self._order.remove(job)
+            if self._current is job:
+                self._current = None
+            self.completed.append(job)
+
+    # ----- 去噪循环（与 ZImagePipeline.__call__ 相同，拆成单步） -----
+    @torch.no_grad()
+    def _prepare(self, job: Job):
+        from diffusers.utils.torch_utils import randn_tensor
+
+        calculate_shift, retrieve_timesteps = _pipeline_helpers()
+        pipe = self.pipe
+        prompt_embeds, _ = pipe.encode_prompt(prompt=job.prompt, device=self.device, do_classifier_free_guidance=False)
+        job.prompt_embeds = [pe for pe in prompt_embeds for _ in range(job.num_images)]
+
+        scale = pipe.vae_scale_factor * 2
+        shape = (job.num_images, pipe.transformer.in_channels, 2 * (job.height // scale), 2 * (job.width // scale))
+        generator = torch.Generator(self.device).manual_seed(job.seed)
+        job.latents = randn_tensor(shape, generator=generator, device=torch.device(self.device), dtype=torch.float32)
+
+        # 每个任务一份 scheduler 副本：step_index 等内部状态互不干扰
+        job.scheduler = copy.deepcopy(pipe.scheduler)
+        config = job.scheduler.config
+        image_seq_len = (job.latents.shape[2] // 2) * (job.latents.shape[3] // 2)
+        mu = calculate_shift(
+            image_seq_len,
+            config.get("base_image_seq_len", 256),
+            config.get("max_image_seq_len", 4096),
+            config.get("base_shift", 0.5),
+            config.get("max_shift", 1.15),
+        )
+        sigmas = _default_sigmas(job.steps)
+        if sigmas is None:
+            job.scheduler.sigma_min = 0.0      # 旧版 pipeline 的做法
+        job.timesteps, _ = retrieve_timesteps(job.scheduler, job.steps, self.device, sigmas=sigmas, mu=mu)
+        job.scheduler.set_begin_index(0)
+        job.started_at = time.perf_counter()
+
+    @torch.no_grad()
+    def _advance(self, job: Job):
+        """执行一步去噪；第一次调度时先完成文本编码和噪声准备"""
+        if job.timesteps is None:
+            self._prepare(job)
+        pipe = self.pipe
+        t = job.timesteps[job.step_index]
+        timestep = (1000 - t.expand(job.latents.shape[0])) / 1000
+        latent_input = list(job.latents.to(pipe.transformer.dtype).unsqueeze(2).unbind(dim=0))
+        # 步缓存只跟踪一次生成，靠时间步回退识别新生成；任务交替推进时这个判断不成立，
+        # 因此每个任务各存一份缓存状态，执行本任务的一步前换入
+        cache = step_cache_of(pipe.transformer)
+        if cache is not None:
+            if job.step_cache_state is None:
+                cache.reset()
+            else:
+                cache.load_state(job.step_cache_state)
+        out = pipe.transformer(latent_input, timestep, job.prompt_embeds, return_dict=False)[0]
+        if cache is not None:
+            job.step_cache_state = cache.save_state()
+        noise_pred = -torch.stack([o.float() for o in out], dim=0).squeeze(2)
+        job.latents = job.scheduler.step(noise_pred, t, job.latents, return_dict=False)[0]
+        job.step_index += 1
+
+    @torch.no_grad()
+    def _decode(self, job: Job):
+        vae = self.pipe.vae
+        latents = job.latents.to(vae.dtype) / vae.config.scaling_factor + vae.config.shift_factor
+        image = vae.decode(latents, return_dict=False)[0]
+        return self.pipe.image_processor.postprocess(image, output_type="pil")
+
+    # ----- 报告 -----
+    def report(self) -> dict:
+        with self._cond:
+            jobs = list(self.completed)
+        result = {}
+        for klass in CLASS_PRIORITY:
+            done = [j for j in jobs if j.klass == klass and j.started_at is not None]
+            if not done:
+                continue
+            queue = [j.started_at - j.submitted_at for j in done]
+            latency = [j.finished_at - j.submitted_at for j in done]
+            result[klass] = {
+                "jobs": len(done),
+                "queue_p50_s": round(percentile(queue, 0.5), 4),
+                "queue_p95_s": round(percentile(queue, 0.95), 4),
+                "latency_p50_s": round(percentile(latency, 0.5), 4),
+                "latency_p95_s": round(percentile(latency, 0.95), 4),
+                "paused": sum(j.paused for j in done),
+            }
+        return result
+
+    def summary(self) -> str:
+        lines = [f"调度（{self.policy}）：跨类别抢占 {self.preemptions} 次，同类别公平切换 {self.fair_switches} 次"]
+        for klass, r in self.report().items():
+            lines.append(
+                f"  {klass:11s} {r['jobs']} 个：排队 p50 {r['queue_p50_s']:.3f}s / p95 {r['queue_p95_s']:.3f}s，"
+                f"总延迟 p50 {r['latency_p50_s']:.3f}s / p95 {r['latency_p95_s']:.3f}s"
+            )
+        return "\n".join(lines)
+
+
+def verify_against_pipe(pipe, device: str, width: int, height: int, steps: int = 9, seed: int = 0,
+                        prompt: str = "a red apple on a wooden table") -> int:
+    """同一 prompt 和种子分别用 pipe() 与 StepScheduler 的逐步循环生成，返回最大像素差（0-255）"""
+    import numpy as np
+
+    reference = pipe(
+        prompt=prompt, width=width, height=height, num_inference_steps=steps, guidance_scale=0.0,
+        generator=torch.Generator(device).manual_seed(seed),
+    ).images[0]
+    scheduler = StepScheduler(pipe, device)
+    try:
+        stepped = scheduler.submit(prompt, width, height, steps=steps, seed=seed).result()[0]
+    finally:
+        scheduler.close()
+    diff = np.abs(np.asarray(reference, dtype=np.int16) - np.asarray(stepped, dtype=np.int16))
+    return int(diff.max())
+
+def simulate(pipe, args, policy: str):
+    """批量提交者一次性提交大任务，交互提交者随机间隔提交小预览"""
+    scheduler = StepScheduler(pipe, args.device, weights={"bulk-a": 1.0, "bulk-b": 1.0}, policy=policy)
+    rng = random.Random(0)
+    futures = []
+    bw, bh = args.bulk_size
+    for n in range(args.bulk):
+        submitter = "bulk-a" if n % 2 == 0 else "bulk-b"
+        futures.append(scheduler.submit(f"bulk scene {n}", bw, bh, "bulk", submitter,
+                                        steps=args.steps, seed=n, num_images=args.bulk_images))
+    iw, ih = args.interactive_size
+    for n in range(args.interactive):
+        time.sleep(rng.uniform(0, 2 * args.interval))
+        futures.append(scheduler.submit(f"preview {n}", iw, ih, "interactive", "user",
+                                        steps=args.steps, seed=1000 + n))
+    for f in futures:
+        f.result()
+    scheduler.close()
+    return scheduler
+
+def parse_size(text: str):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+def main():
+    parser = argparse.ArgumentParser(description="Step-granular preemptive scheduling benchmark")
+    parser.add_argument("--tiny", action="store_true", help="使用随机初始化的极小模型（CPU 自测）")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--policy", default="both", choices=["both", "priority", "fifo"])
+    parser.add_argument("--bulk", type=int, default=6, help="批量任务数")
+    parser.add_argument("--bulk-size", type=parse_size, default=None)
+    parser.add_argument("--bulk-images", type=int, default=3)
+    parser.add_argument("--interactive", type=int, default=10, help="交互任务数")
+    parser.add_argument("--interactive-size", type=parse_size, default=None)
+    parser.add_argument("--interval", type=float, default=None, help="交互任务的平均到达间隔（秒）")
+    parser.add_argument("--steps", type=int, default=9)
+    parser.add_argument("--verify", action="store_true", help="只检查逐步循环与 pipe() 在相同种子下的输出是否一致")
+    args = parser.parse_args()
+
+    if args.tiny:
+        from zimage_tiny import build_tiny_pipeline
+        pipe = build_tiny_pipeline(args.device)
+        args.bulk_size = args.bulk_size or (128, 128)      # 极小模型的 rope 轴长只够到 128x128
+        args.interactive_size = args.interactive_size or (64, 64)
+        args.interval = 0.05 if args.interval is None else args.interval
+    else:
+        from zimage_loop_from_file import load_pipeline
+        pipe = load_pipeline(args.device)
+        args.bulk_size = args.bulk_size or (1024, 1360)
+        args.interactive_size = args.interactive_size or (512, 512)
+        args.interval = 2.0 if args.interval is None else args.interval
+
+    if args.verify:
+        w, h = args.interactive_size
+        diff = verify_against_pipe(pipe, args.device, w, h, args.steps)
+        # 允许 1 级的舍入差异（设备上的非确定性归约）
+        print(f"逐步循环 vs pipe()：{w}x{h}，{args.steps} 步，最大像素差 {diff}（{'一致' if diff <= 1 else '不一致'}）")
+        return
+
+    policies = ["fifo", "priority"] if args.policy == "both" else [args.policy]
+    for policy in policies:
+        scheduler = simulate(pipe, args, policy)
+        print(scheduler.summary())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+本地图片预校验：在调用远程视觉 LLM 之前，用 NumPy 对一批图片整体打分。
+
+两类常见失败：
+- 背景图没有铺满画布：边缘渐隐（edge_fade）、四周与内容明显不同的纯色条带（border_bands）、暗角（vignetting）
+- 透明底的文字/前景素材贴边被裁切：最外圈有不透明像素（touch）；不透明的整幅素材（如 _filled 面板）
+  边缘本来就有内容，无法据此判断，touch 记为 NaN，交给 LLM
+每项得分在 [0, 1]，越大越可能失败。每项有两条阈值 (pass_below, fail_above)：
+全部低于 pass_below 判为明确通过，任一项高于 fail_above 判为明确失败，其余交给 LLM。
+
+阈值可以用人工标注的好/坏样本校准：
+    python zimage_prevalidate.py calibrate --kind background --good ok_dir --bad bad_dir
+    python zimage_prevalidate.py score output/assets/mainscene/*.png --kind background
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+# ===== 配置区域 =====
+SCORE_SIZE = 256                                   # 打分前统一缩放到的边长
+MIN_TEXTURE = 0.02                                 # 平均梯度低于该值的图片纹理太弱，edge_fade 随之降低
+THRESHOLDS_FILE = os.path.join(".cache", "prevalidate_thresholds.json")
+DEFAULT_THRESHOLDS = {                             # 指标 -> [pass_below, fail_above]
+    "edge_fade": [0.35, 0.85],
+    "border_bands": [0.05, 0.50],
+    "vignetting": [0.25, 0.55],
+    "touch": [0.003, 0.03],
+}
+# ====================
+
+KIND_METRICS = {
+    "background": ("edge_fade", "border_bands", "vignetting"),
+    "text": ("touch",),
+}
+
+
+def load_batch(images, size: int = SCORE_SIZE):
+    """路径 / PIL / ndarray 列表 -> (N, size, size, 4) float32，范围 [0, 1]；没有 alpha 时补 1"""
+    arrays = []
+    for image in images:
+        if isinstance(image, str):
+            image = Image.open(image)
+        elif isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image = image.convert("RGBA").resize((size, size), Image.BILINEAR)
+        arrays.append(np.asarray(image))
+    return np.stack(arrays).astype(np.float32) / 255.0
+
+def score_batch(batch: np.ndarray) -> dict:
+    """对 load_batch() 的结果整批打分，返回 指标 -> (N,) 数组"""
+    rgb, alpha = batch[..., :3], batch[..., 3]
+    # 透明区域按黑色计，渐隐到透明和渐隐到黑色一样会被识别
+    luma = (rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)) * alpha
+    n, s = luma.shape[:2]
+    b = max(2, s // 16)
+    eps = 1e-3
+
+    # 边缘渐隐：外圈纹理强度（梯度幅值）相对画面其余部分的衰减；
+    # 整体纹理很弱（纯色、平滑渐变）时没有可衰减的纹理，按整体纹理强度把得分压低
+    grad = np.zeros_like(luma)
+    grad[:, :, 1:] += np.abs(np.diff(luma, axis=2))
+    grad[:, 1:, :] += np.abs(np.diff(luma, axis=1))
+    ring = np.ones((s, s), dtype=bool)
+    ring[b:-b, b:-b] = False
+    inner = np.zeros((s, s), dtype=bool)
+    inner[s // 4:3 * s // 4, s // 4:3 * s // 4] = True
+    ring_tex = grad[:, ring].mean(axis=1)
+    rest_tex = grad[:, ~ring].mean(axis=1)
+    confidence = np.clip(rest_tex / MIN_TEXTURE, 0, 1)
+    edge_fade = np.clip(1 - ring_tex / (rest_tex + eps), 0, 1) * confidence
+
+    # 纯色条带：从每条边向内连续"平坦"（行/列标准差很小）的行数占外侧 1/8 的比例，取四边最大值。
+    # 平坦的天空、地面本身也满足这一点，所以只有条带接近黑色/透明，
+    # 或与紧邻的内侧内容亮度明显不同时才计入
+    k = s // 8
+    m = max(2, k // 2)
+    sides = [
+        luma[:, :k + m, :],                            # 上：逐行
+        luma[:, ::-1, :][:, :k + m, :],                # 下
+        luma[:, :, :k + m].transpose(0, 2, 1),         # 左：逐列
+        luma[:, :, ::-1][:, :, :k + m].transpose(0, 2, 1),   # 右
+    ]
+    flat = np.stack([side[:, :k].std(axis=2) for side in sides], axis=1) < 0.02     # (N, 4, k)
+    run = np.cumprod(flat, axis=2).sum(axis=2)                                      # (N, 4)
+    profile = np.stack([side.mean(axis=2) for side in sides], axis=1)               # (N, 4, k + m)
+    csum = np.concatenate([np.zeros((n, 4, 1), dtype=np.float32), np.cumsum(profile, axis=2)], axis=2)
+    at = lambda idx: np.take_along_axis(csum, idx[..., None], axis=2)[..., 0]
+    band_mean = at(run) / np.maximum(run, 1)
+    adjacent_mean = (at(run + m) - at(run)) / m
+    visible = (band_mean < 0.05) | (np.abs(band_mean - adjacent_mean) > 0.08)
+    border_bands = np.where(visible, run, 0).max(axis=1) / k
+
+    # 暗角：四角相对中心变暗的程度
+    c = s // 8
+    corners = np.stack([luma[:, :c, :c], luma[:, :c, -c:], luma[:, -c:, :c], luma[:, -c:, -c:]], axis=1)
+    corner_mean = corners.reshape(n, -1).mean(axis=1)
+    center_mean = luma[:, inner].mean(axis=1)
+    vignetting = np.clip((center_mean - corner_mean) / (center_mean + eps), 0, 1)
+
+    # 贴边：只对透明底（孤立）的素材有意义，取最外 2 像素中不透明像素的比例。
+    # 不透明的整幅素材边缘与主色不同的像素本来就多，据此判失败会把正常的面板反复重画，记为 NaN
+    edge = np.ones((s, s), dtype=bool)
+    edge[2:-2, 2:-2] = False
+    has_alpha = (alpha < 0.99).any(axis=(1, 2))
+    opaque = alpha[:, edge] > 0.1
+    touch = np.where(has_alpha, opaque.mean(axis=1), np.nan)
+
+    return {
+        "edge_fade": edge_fade,
+        "border_bands": border_bands,
+        "vignetting": vignetting,
+        "touch": touch,
+    }
+
+def load_thresholds(path: str = THRESHOLDS_FILE) -> dict:
+    thresholds = {k: list(v) for k, v in DEFAULT_THRESHOLDS.items()}
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                thresholds.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"[WARN] 阈值文件读取失败，使用默认阈值：{e}")
+    return thresholds
+
+def classify(scores: dict, kind: str, thresholds: dict = None):
+    """返回 (N,) 的 "pass" / "fail" / "uncertain" 数组；得分为 NaN（无法判断）的指标既不通过也不失败"""
+    thresholds = thresholds or load_thresholds()
+    metrics = KIND_METRICS[kind]
+    values = np.stack([scores[m] for m in metrics])                    # (M, N)
+    pass_below = np.array([thresholds[m][0] for m in metrics])[:, None]
+    fail_above = np.array([thresholds[m][1] for m in metrics])[:, None]
+    verdict = np.full(values.shape[1], "uncertain", dtype=object)
+    verdict[(values < pass_below).all(axis=0)] = "pass"
+    verdict[(values > fail_above).any(axis=0)] = "fail"
+    return verdict
+
+def _round_score(value):
+    """NaN（指标不适用）记为 None，结果可以直接写成 JSON"""
+    value = float(value)
+    return None if np.isnan(value) else round(value, 4)
+
+def prevalidate(images, kind: str, thresholds: dict = None):
+    """打分并判定；返回 [{"verdict", 各指标得分}, ...]，与 images 顺序一致"""
+    if not images:
+        return []
+    scores = score_batch(load_batch(images))
+    verdicts = classify(scores, kind, thresholds)
+    return [
+        {"verdict": str(verdicts[i]), **{m: _round_score(scores[m][i]) for m in KIND_METRICS[kind]}}
+        for i in range(len(verdicts))
+    ]
+
+def calibrate(good, bad, kind: str, margin: float = 0.02) -> dict:
+    """
+    由标注样本确定阈值：低于所有坏样本的得分才算明确通过，高于所有好样本才算明确失败。
+    margin 为两侧各留的余量；两类样本重叠时该指标的不确定区间会更宽。
+    """
+    good_scores = score_batch(load_batch(good))
+    bad_scores = score_batch(load_batch(bad))
+    thresholds = {}
+    for metric in KIND_METRICS[kind]:
+        # 不适用的样本（如不透明素材的 touch）得分为 NaN，不参与校准
+        bad_values = bad_scores[metric][~np.isnan(bad_scores[metric])]
+        good_values = good_scores[metric][~np.isnan(good_scores[metric])]
+        if not len(bad_values) or not len(good_values):
+            print(f"[WARN] {metric} 没有可用的好/坏样本，保留默认阈值")
+            thresholds[metric] = list(DEFAULT_THRESHOLDS[metric])
+            continue
+        pass_below = max(0.0, float(bad_values.min()) - margin)
+        fail_above = min(1.0, float(good_values.max()) + margin)
+        thresholds[metric] = [round(pass_below, 4), round(max(fail_above, pass_below), 4)]
+    return thresholds
+
+def expand_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        paths.extend(sorted(p for p in glob.glob(pattern) if p.lower().endswith((".png", ".jpg", ".jpeg", ".webp"))))
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Local vectorized image pre-validation")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("score", help="对图片打分并给出判定")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--kind", default="background", choices=sorted(KIND_METRICS))
+    p = sub.add_parser("calibrate", help="用好/坏样本校准阈值，写入阈值文件")
+    p.add_argument("--kind", default="background", choices=sorted(KIND_METRICS))
+    p.add_argument("--good", nargs="+", required=True)
+    p.add_argument("--bad", nargs="+", required=True)
+    args = parser.parse_args()
+
+    if args.command == "score":
+        paths = expand_paths(args.images)
+        t0 = time.perf_counter()
+        results = prevalidate(paths, args.kind)
+        elapsed = time.perf_counter() - t0
+        for path, result in zip(paths, results):
+            print(f"  {result.pop('verdict'):9s} {path}  {result}")
+        print(f">> {len(paths)} 张，用时 {elapsed:.3f}s")
+        return
+
+    thresholds = load_thresholds()
+    thresholds.update(calibrate(expand_paths(args.good), expand_paths(args.bad), args.kind))
+    os.makedirs(os.path.dirname(THRESHOLDS_FILE) or ".", exist_ok=True)
+    with open(THRESHOLDS_FILE, "w", encoding="utf-8") as f:
+        json.dump(thresholds, f, indent=2)
+    print(f">> 阈值已写入 {THRESHOLDS_FILE}：{thresholds}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+仅权重量化加载：transformer 与 text encoder 的 nn.Linear 权重存为 int8（可选 int4），
+按输出通道（per-channel）对称量化，前向时即时反量化为激活的 dtype 再做矩阵乘。
+其余参数（norm、embedding、VAE）保持 bf16。
+
+权重体积约为 bf16 的 1/2（int8）或 1/4（int4），换取每次前向的反量化开销。
+量化后的模块整体保存到 QUANT_CACHE_DIR（按模型、revision、组件、位数、dtype、MIN_FEATURES 区分），
+之后启动直接 mmap 加载，不再重新量化。
+
+用法：
+    python zimage_quant.py --bits 8              # 量化并写缓存，报告权重体积
+    python zimage_quant.py --bits 4 --tiny --device cpu
+延迟与峰值显存对比用 zimage_bench.py --quant none,int8,int4。
+"""
+import argparse
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+QUANT_COMPONENTS = ("transformer", "text_encoder")
+QUANT_CACHE_DIR = os.path.join(".cache", "quantized")
+MIN_FEATURES = 256                     # 更小的 Linear 量化收益可忽略，保持原精度
+
+
+class QuantLinear(nn.Module):
+    """int8 / int4 仅权重量化的 Linear；int4 两个值打包进一个 uint8"""
+
+    def __init__(self, in_features: int, out_features: int, bits: int = 8, bias: bool = True,
+                 dtype=torch.bfloat16, device=None):
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError(f"只支持 int8 / int4：{bits}")
+        if bits == 4 and in_features % 2:
+            raise ValueError(f"int4 需要偶数 in_features：{in_features}")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        if bits == 8:
+            qweight = torch.empty(out_features, in_features, dtype=torch.int8, device=device)
+        else:
+            qweight = torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", torch.empty(out_features, 1, dtype=dtype, device=device))
+        self.register_buffer("bias", torch.empty(out_features, dtype=dtype, device=device) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int = 8):
+        weight = linear.weight.detach().float()
+        qmax = 127 if bits == 8 else 7
+        scale = (weight.abs().amax(dim=1, keepdim=True) / qmax).clamp(min=1e-8)
+        q = torch.round(weight / scale).clamp(-qmax - 1, qmax)
+
+        module = cls(linear.in_features, linear.out_features, bits, linear.bias is not None,
+                     dtype=linear.weight.dtype, device=linear.weight.device)
+        if bits == 8:
+            module.qweight.copy_(q.to(torch.int8))
+        else:
+            u = (q + 8).to(torch.uint8)
+            module.qweight.copy_(u[:, 0::2] | (u[:, 1::2] << 4))
+        module.scale.copy_(scale.to(module.scale.dtype))
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module
+
+    # 有些模块直接读取 Linear 的权重（如 Z-Image 的 timestep embedder 用 self.mlp[0].weight.dtype
+    # 决定输入 dtype），这里提供与 nn.Linear 相同的 dtype / device / weight
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.scale.dtype
+
+    @property
+    def device(self) -> torch.device:
+        return self.qweight.device
+
+    @property
+    def weight(self) -> torch.Tensor:
+        """反量化后的权重（每次访问都重新计算，只适合读取 dtype / 形状等少量用途）"""
+        return self.dequantize()
+
+    def dequantize(self, dtype=None) -> torch.Tensor:
+        dtype = dtype or self.scale.dtype
+        if self.bits == 8:
+            q = self.qweight
+        else:
+            low = (self.qweight & 0x0F).to(torch.int8) - 8
+            high = (self.qweight >> 4).to(torch.int8) - 8
+            q = torch.stack((low, high), dim=-1).flatten(1)
+        return q.to(dtype) * self.scale.to(dtype)
+
+    def forward(self, x):
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}"
+
+
+def quantize_module(module: nn.Module, bits: int = 8, min_features: int = MIN_FEATURES) -> int:
+    """把 module 中足够大的 nn.Linear 原地替换为 QuantLinear，返回替换数量"""
+    count = 0
+    for name, child in list(module.named_children()):
+        if isinstance(child, nn.Linear):
+            if min(child.in_features, child.out_features) < min_features:
+                continue
+            if bits == 4 and child.in_features % 2:
+                continue
+            setattr(module, name, QuantLinear.from_linear(child, bits))
+            count += 1
+        else:
+            count += quantize_module(child, bits, min_features)
+    return count
+
+def module_bytes(module: nn.Module) -> int:
+    tensors = list(module.parameters()) + [b for b in module.buffers() if b is not None]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def footprint(pipe) -> dict:
+    """各组件权重体积（MB）"""
+    sizes = {}
+    for name in ("transformer", "text_encoder", "vae"):
+        component = getattr(pipe, name, None)
+        if isinstance(component, nn.Module):
+            sizes[name] = round(module_bytes(component) / 1024 / 1024, 1)
+    return sizes
+
+def checkpoint_footprint(model_id: str, revision: str = "main", dtype=torch.bfloat16) -> dict:
+    """
+    按 safetensors 头部估算以 dtype 加载后各组件的权重体积（MB），不加载模型。
+    浮点张量按 dtype 计，其余保持文件中的类型；不含初始化时才创建的 buffer（如 rotary 频率表）。
+    """
+    import glob
+
+    from zimage_fastload import SAFETENSORS_DTYPES, read_safetensors_header, resolve_snapshot
+
+    root = resolve_snapshot(model_id, revision)
+    target = torch.empty((), dtype=dtype).element_size()
+    sizes = {}
+    for name in ("transformer", "text_encoder", "vae"):
+        files = sorted(glob.glob(os.path.join(root, name, "*.safetensors")))
+        if not files:
+            continue
+        total = 0
+        for path in files:
+            with open(path, "rb") as f:
+                _, header = read_safetensors_header(f)
+            for key, info in header.items():
+                if key == "__metadata__":
+                    continue
+                file_dtype = getattr(torch, SAFETENSORS_DTYPES[info["dtype"]])
+                numel = 1
+                for dim in info["shape"]:
+                    numel *= dim
+                size = target if file_dtype.is_floating_point else torch.empty((), dtype=file_dtype).element_size()
+                total += numel * size
+        sizes[name] = round(total / 1024 / 1024, 1)
+    return sizes
+
+def cache_path(cache_dir: str, model_id: str, revision: str, component: str, bits: int,
+               dtype=torch.bfloat16, min_features: int = MIN_FEATURES) -> str:
+    """dtype 与 min_features 都会改变缓存的模块内容，因此也是路径的一部分"""
+    safe_id = model_id.replace("/", "--")
+    dtype_name = str(dtype).replace("torch.", "")
+    return os.path.join(cache_dir, f"{safe_id}@{revision}", f"{component}.int{bits}.{dtype_name}.min{min_features}.pt")
+
+def quantize_pipeline(pipe, bits: int = 8, min_features: int = MIN_FEATURES) -> dict:
+    counts = {}
+    for name in QUANT_COMPONENTS:
+        counts[name] = quantize_module(getattr(pipe, name), bits, min_features)
+    return counts
+
+def load_quantized_pipeline(model_id: str, revision: str = "main", bits: int = 8,
+                            cache_dir: str = QUANT_CACHE_DIR, dtype=torch.bfloat16,
+                            min_features: int = MIN_FEATURES):
+    """
+    加载 ZImagePipeline，transformer 与 text encoder 为量化版本（仍在 CPU 上，调用方负责 .to(device)）。
+    缓存齐全时只加载 VAE/tokenizer 等其余组件，量化组件从缓存 mmap 读入；
+    否则先加载 bf16 权重、量化、写缓存。
+    """
+    from diffusers import ZImagePipeline
+
+    paths = {name: cache_path(cache_dir, model_id, revision, name, bits, dtype, min_features) for name in QUANT_COMPONENTS}
+    if all(os.path.exists(p) for p in paths.values()):
+        t0 = time.perf_counter()
+        # 缓存是本机量化后写下的完整模块，需要 weights_only=False 才能还原模块结构
+        components = {name: torch.load(p, mmap=True, weights_only=False) for name, p in paths.items()}
+        pipe = ZImagePipeline.from_pretrained(
+            model_id, revision=revision, torch_dtype=dtype, low_cpu_mem_usage=True, **components,
+        )
+        print(f">> 已从缓存加载 int{bits} 权重（{time.perf_counter() - t0:.1f}s）：{os.path.dirname(paths['transformer'])}")
+        return pipe
+
+    t0 = time.perf_counter()
+    pipe = ZImagePipeline.from_pretrained(model_id, revision=revision, torch_dtype=dtype, low_cpu_mem_usage=True)
+    counts = quantize_pipeline(pipe, bits, min_features)
+    for name, p in paths.items():
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        tmp = f"{p}.{os.getpid()}.tmp"
+        torch.save(getattr(pipe, name), tmp)
+        os.replace(tmp, p)
+    print(f">> 已量化为 int{bits}（{counts}，{time.perf_counter() - t0:.1f}s），缓存写入 {os.path.dirname(paths['transformer'])}")
+    return pipe
+
+def main():
+    parser = argparse.ArgumentParser(description="Weight-only int8/int4 quantization for Z-Image")
+    parser.add_argument("--bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--tiny", action="store_true", help="使用随机初始化的极小模型（CPU 自测，量化所有 Linear）")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--cache-dir", default=QUANT_CACHE_DIR)
+    args = parser.parse_args()
+
+    if args.tiny:
+        from zimage_tiny import build_tiny_pipeline
+        pipe = build_tiny_pipeline("cpu")
+        before = footprint(pipe)
+        counts = quantize_pipeline(pipe, args.bits, min_features=0)
+        print(f"替换 Linear：{counts}")
+    else:
+        from zimage_loop_from_file import MODEL_ID, MODEL_REVISION
+        # 经模块名导入，缓存里记录的类路径是 zimage_quant.QuantLinear 而不是 __main__.QuantLinear
+        from zimage_quant import checkpoint_footprint, load_quantized_pipeline
+        # bf16 体积从 safetensors 头部算出，不为了对比再完整加载一遍模型
+        before = checkpoint_footprint(MODEL_ID, MODEL_REVISION, torch.bfloat16)
+        pipe = load_quantized_pipeline(MODEL_ID, MODEL_REVISION, args.bits, args.cache_dir)
+    after = footprint(pipe)
+    for name in after:
+        print(f"  {name:13s} {before.get(name, float('nan')):9.1f} MB -> {after[name]:9.1f} MB")
+
+    pipe.to(args.device)
+    t0 = time.perf_counter()
+    pipe(prompt="a red apple on a table", width=64 if args.tiny else 1024, height=64 if args.tiny else 1024,
+         num_inference_steps=9, guidance_scale=0.0, generator=torch.Generator("cpu").manual_seed(0))
+    print(f"单张生成 {time.perf_counter() - t0:.2f}s（完整的 bf16 对比见 zimage_bench.py --quant）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+生成结果缓存：相同的 (prompt, 尺寸, 步数, guidance, 种子, 序号, 模型版本) 直接返回已生成的图片。
+
+prompts.txt 里常留着几乎相同的变体和注释掉的历史，固定 SEED 时重复运行会把同样的图重新算一遍。
+ResultCache 按内容寻址保存每张图片（PNG，无损）：
+- 键是完整生成参数的哈希；种子为 None（随机）的任务不缓存
+- 同一 prompt 的第 i 张图只取决于种子和 i（每条 prompt 一个 generator），与批次组合无关
+- 总大小超过 max_bytes 时按最近最少使用淘汰
+- 索引是一个 JSON 文件（键 -> [字节数, 最近访问时间]），启动时一次读入；
+  索引缺失或损坏时扫描对象目录重建
+- normalize=True 时先规范化 prompt（合并空白、去掉标点），只改了空白或标点的行也能命中
+- array_output=True（POSTPROCESS="tensor"）时命中的图片以 uint8 ndarray 返回，与新生成的结果类型相同
+"""
+import hashlib
+import json
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+INDEX_NAME = "index.json"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """去掉标点、合并空白；保留大小写（文字渲染时大小写有意义）"""
+    text = "".join(" " if unicodedata.category(ch).startswith("P") else ch for ch in prompt)
+    return " ".join(text.split())
+
+
+class ResultCache:
+    def __init__(self, root: str, max_bytes: int = 2 * 1024 ** 3, normalize: bool = False,
+                 model_id: str = "", revision: str = "main", variant=None, array_output: bool = False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.normalize = normalize
+        self.model_id = model_id
+        self.revision = revision
+        self.variant = variant or {}   # 影响输出的其他配置（量化、步缓存、后处理路径等）
+        self.array_output = array_output   # True 时命中返回 uint8 (H, W, 3) ndarray，与张量后处理的结果类型一致
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+
+        self._index = OrderedDict()    # key -> 字节数，按访问顺序（最旧在前）
+        self._access = {}              # key -> 最近访问时间
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dirty = False
+        self._load_index()
+
+    # ----- 索引 -----
+    def _index_path(self) -> str:
+        return os.path.join(self.root, INDEX_NAME)
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.root, "objects", key[:2], key + ".png")
+
+    def _load_index(self):
+        entries = None
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"[WARN] 结果缓存索引损坏，重新扫描：{e}")
+        if entries is None:
+            entries = self._scan()
+            self._dirty = True
+        for key, (size, accessed) in sorted(entries.items(), key=lambda kv: kv[1][1]):
+            self._index[key] = size
+            self._access[key] = accessed
+            self.bytes_held += size
+
+    def _scan(self) -> dict:
+        entries = {}
+        objects = os.path.join(self.root, "objects")
+        for shard in os.scandir(objects):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".png"):
+                    st = entry.stat()
+                    entries[entry.name[:-4]] = [st.st_size, st.st_mtime]
+        return entries
+
+    def save_index(self):
+        if not self._dirty:
+            return
+        data = {key: [size, self._access[key]] for key, size in self._index.items()}
+        tmp = f"{self._index_path()}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self._index_path())
+        self._dirty = False
+
+    # ----- 读写 -----
+    def key(self, item, index: int, steps: int, guidance: float):
+        """item 的第 index 张图的缓存键；种子为 None 时返回 None"""
+        seed = item.get("seed")
+        if seed is None:
+            return None
+        prompt = normalize_prompt(item["prompt"]) if self.normalize else item["prompt"]
+        payload = json.dumps([
+            self.model_id, self.revision, self.variant, prompt,
+            item["width"], item["height"], item.get("out_width"), item.get("out_height"),
+            steps, guidance, seed, index,
+        ], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        if key is None or key not in self._index:
+            return None
+        try:
+            with Image.open(self._object_path(key)) as image:
+                image.load()
+        except OSError:
+            self._drop(key)
+            return None
+        self._index.move_to_end(key)
+        self._access[key] = time.time()
+        self._dirty = True
+        if self.array_output:
+            return np.asarray(image.convert("RGB"))
+        return image
+
+    def put(self, key: str, image):
+        if key is None or key in self._index:
+            return
+        if not hasattr(image, "save"):
+            from zimage_writer import as_pil
+            image = as_pil(image)
+        path = self._object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        image.save(tmp, format="PNG", compress_level=1)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        self._index[key] = size
+        self._access[key] = time.time()
+        self.bytes_held += size
+        self._dirty = True
+        self._evict()
+
+    def _drop(self, key: str):
+        size = self._index.pop(key, 0)
+        self._access.pop(key, None)
+        self.bytes_held -= size
+        self._dirty = True
+        try:
+            os.remove(self._object_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.bytes_held > self.max_bytes and self._index:
+            oldest = next(iter(self._index))
+            self._drop(oldest)
+            self.evictions += 1
+
+    # ----- 按批查找 -----
+    def lookup(self, item, num_images: int, steps: int, guidance: float):
+        """item 的 num_images 张图全部命中时返回图片列表，否则返回 None"""
+        keys = [self.key(item, i, steps, guidance) for i in range(1, num_images + 1)]
+        if keys[0] is None:
+            return None
+        images = []
+        for key in keys:
+            image = self.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            images.append(image)
+        self.hits += 1
+        return images
+
+    def store(self, results, steps: int, guidance: float):
+        for item, index, image in results:
+            self.put(self.key(item, index, steps, guidance), image)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._index),
+            "bytes_held": self.bytes_held,
+            "evictions": self.evictions,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (
+            f"结果缓存：命中 {s['hits']} 条，未命中 {s['misses']} 条，"
+            f"共 {s['entries']} 张 / {s['bytes_held'] / 1024 / 1024:.1f} MB，淘汰 {s['evictions']} 张"
+        )
@@ -0,0 +1,126 @@
+"""
+常驻模型服务：加载一次 ZImagePipeline，之后通过 Unix socket 接收生成任务。
+
+一次性脚本/实验不必每次都付 from_pretrained 的加载和搬运显存的代价，
+客户端（zimage_client.py）从发出请求到拿到第一张图只受推理速度限制。
+
+协议：每个连接发送一行 JSON 请求，服务端回一行 JSON 响应。
+    {"op": "generate", "prompt": "...", "width": 1024, "height": 1024,
+     "steps": 9, "seed": 42, "count": 1, "return": "paths" | "bytes"}
+    {"op": "ping"}
+响应：{"ok": true, "paths": [...]} 或 {"ok": true, "images": [base64 PNG, ...]}，
+      出错时 {"ok": false, "error": "..."}；另带 "seconds" 为服务端生成耗时。
+
+用法：
+    python zimage_server.py            # 加载真实模型
+    python zimage_server.py --stub     # 使用 StubPipeline，离线测试
+"""
+import argparse
+import base64
+import json
+import os
+import socketserver
+import threading
+import time
+import traceback
+
+import zimage_loop_from_file as zl
+from zimage_writer import encode_image
+
+# ===== 配置区域 =====
+SOCKET_PATH = "/tmp/zimage.sock"   # Unix socket 路径
+MAX_REQUEST_BYTES = 1024 * 1024    # 单个请求行的最大长度
+# ====================
+
+
+class ZImageState:
+    """常驻的 pipeline 及其缓存；pipe() 不是线程安全的，用锁串行执行"""
+
+    def __init__(self, device: str):
+        self.device = device
+        self.pipe = zl.load_pipeline(device)
+        self.embed_cache = zl.make_embed_cache(self.pipe)
+        self.lock = threading.Lock()
+        self.jobs = 0
+
+    def generate(self, req: dict) -> dict:
+        prompt = str(req.get("prompt", "")).strip()
+        if not prompt:
+            raise ValueError("prompt 不能为空")
+        item = {
+            "prompt": prompt,
+            "width": int(req.get("width", zl.DEFAULT_WIDTH)),
+            "height": int(req.get("height", zl.DEFAULT_HEIGHT)),
+            "steps": int(req.get("steps", zl.NUM_STEPS)),
+            "seed": req.get("seed", zl.SEED),
+        }
+        count = int(req.get("count", 1))
+
+        with self.lock:
+            t0 = time.time()
+            results = zl.generate_batch(
+                self.pipe, [item], num_images=count, device=self.device, embed_cache=self.embed_cache,
+            )
+            seconds = time.time() - t0
+            self.jobs += 1
+
+        if req.get("return", "paths") == "bytes":
+            images = []
+            for _, _, image in results:
+                images.append(base64.b64encode(encode_image(image)).decode("ascii"))
+            return {"ok": True, "images": images, "seconds": seconds}
+
+        os.makedirs(zl.OUTPUT_DIR, exist_ok=True)
+        paths = [os.path.abspath(p) for p in zl.save_results(results)]
+        return {"ok": True, "paths": paths, "seconds": seconds}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_BYTES)
+        try:
+            req = json.loads(line)
+            op = req.get("op", "generate")
+            if op == "ping":
+                resp = {"ok": True, "device": self.server.state.device, "jobs": self.server.state.jobs}
+            elif op == "generate":
+                resp = self.server.state.generate(req)
+            else:
+                resp = {"ok": False, "error": f"unknown op: {op}"}
+        except Exception as e:
+            traceback.print_exc()
+            resp = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+class ZImageServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, state: ZImageState):
+        self.state = state
+        super().__init__(path, RequestHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident Z-Image pipeline server")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--device", default=zl.DEVICE)
+    parser.add_argument("--stub", action="store_true", help="使用 StubPipeline，不加载模型")
+    args = parser.parse_args()
+
+    zl.USE_STUB = args.stub
+    state = ZImageState(args.device)
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    with ZImageServer(args.socket, state) as server:
+        print(f">> 服务已就绪：{args.socket}（Ctrl-C 退出）")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\n退出服务。")
+        finally:
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
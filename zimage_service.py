@@ -0,0 +1,322 @@
+"""
+asyncio HTTP 生成服务，带动态请求合并（dynamic batching）。
+
+内部工具通过 HTTP 调用 Z-Image-Turbo，而不是去改 prompts.txt。
+CoalescingScheduler 收集在 max_wait 时间窗口内到达的请求，按 (尺寸, 步数, 张数) 分组，
+凑成一次批量 pipe() 调用交给执行线程，再把图片分发回各自请求的 future。
+- max_wait 越大、max_batch 越大：吞吐越高，但 p50 延迟也越高
+- 推理进行中到达的请求会自然地积攒成下一批
+
+接口：
+    POST /generate  {"prompt", "width", "height", "steps", "seed", "count", "return": "paths"|"bytes"}
+    GET  /metrics   Prometheus 文本格式的队列深度、批大小等指标
+    GET  /healthz
+
+用法：python zimage_service.py [--stub] [--port 8765] [--max-wait-ms 50] [--max-batch 6]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import zimage_loop_from_file as zl
+from zimage_writer import encode_image
+
+# ===== 配置区域 =====
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+COALESCE_MAX_WAIT_MS = 50          # 第一条请求到达后最多等待多久再开批
+COALESCE_MAX_BATCH = zl.MAX_BATCH  # 单批最多图片数（prompt 数 x 张数）
+# ====================
+
+
+class _Request:
+    __slots__ = ("item", "count", "future", "arrived")
+
+    def __init__(self, item, count, future):
+        self.item = item
+        self.count = count
+        self.future = future
+        self.arrived = time.monotonic()
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class CoalescingScheduler:
+    def __init__(self, pipe, device: str, max_wait: float, max_batch: int, embed_cache=None):
+        self.pipe = pipe
+        self.device = device
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.embed_cache = embed_cache
+        # 只有一块设备：单线程执行器保证 pipe() 串行
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="zimage-gen")
+        self._groups = {}              # key -> [_Request, ...]
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        # 指标
+        self.requests_total = 0
+        self.batches_total = 0
+        self.images_total = 0
+        self.batch_size_counts = {}    # 每批 prompt 数 -> 次数
+        self.queue_waits = []          # 最近请求的排队时间（秒）
+        self.latencies = []            # 最近请求的总延迟（秒）
+        self.busy_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(reqs) for reqs in self._groups.values())
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item: dict, count: int):
+        """提交一个请求，返回该请求自己的 [(item, 序号, image), ...]"""
+        future = asyncio.get_running_loop().create_future()
+        key = (item["width"], item["height"], item.get("steps", zl.NUM_STEPS), count)
+        self._groups.setdefault(key, []).append(_Request(item, count, future))
+        self.requests_total += 1
+        self._wakeup.set()
+        return await future
+
+    def _ready_key(self, now: float):
+        """返回可以开批的分组：已凑满或最早的请求已等满 max_wait；都没有时返回 None"""
+        oldest_key, oldest = None, None
+        for key, reqs in self._groups.items():
+            if len(reqs) * key[3] >= self.max_batch:
+                return key
+            if oldest is None or reqs[0].arrived < oldest:
+                oldest_key, oldest = key, reqs[0].arrived
+        if oldest is not None and now - oldest >= self.max_wait:
+            return oldest_key
+        return None
+
+    def _next_deadline(self) -> float:
+        return min(reqs[0].arrived for reqs in self._groups.values()) + self.max_wait
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._groups:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key = self._ready_key(time.monotonic())
+            if key is None:
+                self._wakeup.clear()
+                timeout = max(0.0, self._next_deadline() - time.monotonic())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            reqs = self._groups[key]
+            per_batch = max(1, self.max_batch // max(1, key[3]))
+            taken, rest = reqs[:per_batch], reqs[per_batch:]
+            if rest:
+                self._groups[key] = rest
+            else:
+                del self._groups[key]
+
+            # 一批出错只让这一批的请求失败，调度循环继续运行
+            try:
+                await self._run_batch(loop, key, taken)
+            except Exception as e:
+                for r in taken:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+
+    async def _run_batch(self, loop, key, taken):
+        start = time.monotonic()
+        for r in taken:
+            self.queue_waits.append(start - r.arrived)
+        try:
+            results = await loop.run_in_executor(
+                self.executor,
+                lambda: zl.generate_batch(
+                    self.pipe, [r.item for r in taken], num_images=key[3],
+                    device=self.device, embed_cache=self.embed_cache,
+                ),
+            )
+        finally:
+            self.busy_seconds += time.monotonic() - start
+
+        self.batches_total += 1
+        self.images_total += len(results)
+        self.batch_size_counts[len(taken)] = self.batch_size_counts.get(len(taken), 0) + 1
+        done = time.monotonic()
+        for r in taken:
+            mine = [res for res in results if res[0] is r.item]
+            self.latencies.append(done - r.arrived)
+            if not r.future.done():
+                r.future.set_result(mine)
+        # 只保留最近的样本用于分位数
+        del self.queue_waits[:-2000]
+        del self.latencies[:-2000]
+
+    def metrics_text(self) -> str:
+        lines = [
+            "# TYPE zimage_queue_depth gauge",
+            f"zimage_queue_depth {self.queue_depth}",
+            "# TYPE zimage_requests_total counter",
+            f"zimage_requests_total {self.requests_total}",
+            "# TYPE zimage_batches_total counter",
+            f"zimage_batches_total {self.batches_total}",
+            "# TYPE zimage_images_total counter",
+            f"zimage_images_total {self.images_total}",
+            "# TYPE zimage_busy_seconds_total counter",
+            f"zimage_busy_seconds_total {self.busy_seconds:.3f}",
+            "# TYPE zimage_batch_prompts counter",
+        ]
+        for size, n in sorted(self.batch_size_counts.items()):
+            lines.append(f'zimage_batch_prompts{{size="{size}"}} {n}')
+        lines.append("# TYPE zimage_queue_wait_seconds summary")
+        for q in (0.5, 0.95):
+            lines.append(f'zimage_queue_wait_seconds{{quantile="{q}"}} {_percentile(self.queue_waits, q):.4f}')
+        lines.append("# TYPE zimage_latency_seconds summary")
+        for q in (0.5, 0.95):
+            lines.append(f'zimage_latency_seconds{{quantile="{q}"}} {_percentile(self.latencies, q):.4f}')
+        lines.append(f"zimage_max_wait_seconds {self.max_wait}")
+        lines.append(f"zimage_max_batch {self.max_batch}")
+        return "\n".join(lines) + "\n"
+
+
+# ----- 最小 HTTP/1.1 实现（不依赖第三方 web 框架） -----
+_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+async def _respond(writer, status: int, body: bytes, content_type: str):
+    head = (
+        f"HTTP/1.1 {status} {_STATUS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+async def _respond_json(writer, status: int, obj):
+    await _respond(writer, status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json")
+
+
+def _encode_results(results, mode: str):
+    if mode == "bytes":
+        images = []
+        for _, _, image in results:
+            images.append(base64.b64encode(encode_image(image)).decode("ascii"))
+        return {"images": images}
+    return {"paths": [os.path.abspath(p) for p in zl.save_results(results)]}
+
+
+def _int_field(req: dict, name: str, default, minimum: int = 1, optional: bool = False):
+    """读取整数字段；类型不对或小于 minimum 时抛 ValueError（返回 400）"""
+    value = req.get(name, default)
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{name} 必须是整数，收到 {value!r}")
+    if value < minimum:
+        raise ValueError(f"{name} 不能小于 {minimum}，收到 {value}")
+    return value
+
+
+def make_handler(scheduler: CoalescingScheduler):
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            if not request_line:
+                return
+            method, path, _ = request_line.split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+
+            if method == "GET" and path == "/metrics":
+                await _respond(writer, 200, scheduler.metrics_text().encode("utf-8"), "text/plain; version=0.0.4")
+            elif method == "GET" and path == "/healthz":
+                await _respond_json(writer, 200, {"ok": True, "queue_depth": scheduler.queue_depth})
+            elif method == "POST" and path == "/generate":
+                req = json.loads(body or b"{}")
+                prompt = str(req.get("prompt", "")).strip()
+                if not prompt:
+                    await _respond_json(writer, 400, {"ok": False, "error": "prompt 不能为空"})
+                    return
+                item = {
+                    "prompt": prompt,
+                    "width": _int_field(req, "width", zl.DEFAULT_WIDTH),
+                    "height": _int_field(req, "height", zl.DEFAULT_HEIGHT),
+                    "steps": _int_field(req, "steps", zl.NUM_STEPS),
+                    "seed": _int_field(req, "seed", zl.SEED, minimum=0, optional=True),
+                }
+                count = _int_field(req, "count", 1)
+                t0 = time.monotonic()
+                results = await scheduler.submit(item, count)
+                payload = await asyncio.get_running_loop().run_in_executor(
+                    None, _encode_results, results, req.get("return", "paths"),
+                )
+                payload.update(ok=True, seconds=time.monotonic() - t0)
+                await _respond_json(writer, 200, payload)
+            else:
+                await _respond_json(writer, 404, {"ok": False, "error": f"{method} {path}"})
+        except (ValueError, KeyError) as e:
+            await _respond_json(writer, 400, {"ok": False, "error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            await _respond_json(writer, 500, {"ok": False, "error": f"{type(e).__name__}: {e}"})
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host: str, port: int, scheduler: CoalescingScheduler):
+    scheduler.start()
+    server = await asyncio.start_server(make_handler(scheduler), host, port)
+    print(f">> 服务已就绪：http://{host}:{port}  (max_wait={scheduler.max_wait * 1000:.0f}ms, max_batch={scheduler.max_batch})")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Asyncio Z-Image service with request coalescing")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--device", default=zl.DEVICE)
+    parser.add_argument("--max-wait-ms", type=float, default=COALESCE_MAX_WAIT_MS)
+    parser.add_argument("--max-batch", type=int, default=COALESCE_MAX_BATCH)
+    parser.add_argument("--stub", action="store_true", help="使用 StubPipeline，不加载模型")
+    args = parser.parse_args()
+
+    zl.USE_STUB = args.stub
+    os.makedirs(zl.OUTPUT_DIR, exist_ok=True)
+    pipe = zl.load_pipeline(args.device)
+    scheduler = CoalescingScheduler(
+        pipe,
+        device=args.device,
+        max_wait=args.max_wait_ms / 1000.0,
+        max_batch=args.max_batch,
+        embed_cache=zl.make_embed_cache(pipe),
+    )
+    try:
+        asyncio.run(serve(args.host, args.port, scheduler))
+    except KeyboardInterrupt:
+        print("\n退出服务。")
+
+if __name__ == "__main__":
+    main()
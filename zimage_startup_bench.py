@@ -0,0 +1,154 @@
+"""
+启动基准：同时启动 N 个 CPU worker，测量每个 worker 的就绪时间与内存占用。
+
+每个 worker（spawn 启动的新进程）依次：导入 zimage_loop_from_file（不导入 torch）-> 按模式加载 pipeline
+-> 等所有 worker 都加载完 -> 读取 /proc/self/status 的 RSS 与 /proc/self/smaps_rollup 的 PSS。
+PSS 把共享页按共享进程数均摊：default 模式下每个 worker 的 PSS 约等于整份权重，
+mmap 模式下随 worker 数增加而下降。
+
+模式：
+    default   ZImagePipeline.from_pretrained(low_cpu_mem_usage=True)
+    eager     ZImagePipeline.from_pretrained(low_cpu_mem_usage=False)（zimage_test.py 的方式）
+    mmap      zimage_fastload.load_mmap_pipeline
+
+用法：
+    python zimage_startup_bench.py --workers 4 --modes default,mmap
+    python zimage_startup_bench.py --tiny --workers 4           # 极小模型，先保存到临时目录
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+MODES = ("default", "eager", "mmap")
+
+
+def read_memory_mb() -> dict:
+    """当前进程的 RSS 与 PSS（MB）；非 Linux 时 PSS 为 None"""
+    result = {"rss_mb": None, "pss_mb": None}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    result["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    result["pss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return result
+
+def worker_main(rank: int, mode: str, model: str, dtype_name: str, generate: bool, started: float, barrier, results):
+    t0 = time.perf_counter()
+    import zimage_loop_from_file as zl
+    import_s = time.perf_counter() - t0
+
+    import torch
+    torch.set_num_threads(1)
+    torch_s = time.perf_counter() - t0 - import_s
+
+    if mode == "mmap":
+        from zimage_fastload import load_mmap_pipeline
+        pipe = load_mmap_pipeline(model, zl.MODEL_REVISION)
+    else:
+        from diffusers import ZImagePipeline
+        pipe = ZImagePipeline.from_pretrained(
+            model,
+            torch_dtype=getattr(torch, dtype_name),
+            low_cpu_mem_usage=(mode == "default"),
+        )
+    pipe.set_progress_bar_config(disable=True)
+    ready = time.time() - started
+    load_s = time.perf_counter() - t0 - import_s - torch_s
+
+    first_image_s = None
+    if generate:
+        t1 = time.perf_counter()
+        pipe(prompt="a red apple", width=64, height=64, num_inference_steps=2, guidance_scale=0.0)
+        first_image_s = round(time.perf_counter() - t1, 3)
+
+    # 所有 worker 都加载完之后再量内存，PSS 才能反映共享
+    barrier.wait()
+    results.put({
+        "rank": rank,
+        "mode": mode,
+        "import_s": round(import_s, 4),
+        "torch_import_s": round(torch_s, 3),
+        "load_s": round(load_s, 3),
+        "ready_s": round(ready, 3),
+        "first_image_s": first_image_s,
+        **read_memory_mb(),
+    })
+    barrier.wait()
+
+def run_mode(mode: str, args, model: str):
+    ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(args.workers)
+    results = ctx.Queue()
+    started = time.time()
+    procs = [
+        ctx.Process(target=worker_main, args=(r, mode, model, args.dtype, args.generate, started, barrier, results))
+        for r in range(args.workers)
+    ]
+    for p in procs:
+        p.start()
+    rows = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return sorted(rows, key=lambda r: r["rank"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and per-worker memory benchmark")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--modes", default="default,mmap", help=",".join(MODES))
+    parser.add_argument("--model", default=None, help="模型 ID 或本地目录，默认 zimage_loop_from_file.MODEL_ID")
+    parser.add_argument("--dtype", default="bfloat16", help="default/eager 模式的 torch_dtype")
+    parser.add_argument("--tiny", action="store_true", help="把随机初始化的极小模型保存到临时目录后测试")
+    parser.add_argument("--generate", action="store_true", help="就绪后再生成一张小图，确认加载结果可用")
+    parser.add_argument("--out", default="startup_results.json")
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"未知模式：{mode}")
+
+    tmp = None
+    if args.tiny:
+        from zimage_tiny import build_tiny_pipeline
+        tmp = tempfile.TemporaryDirectory()
+        build_tiny_pipeline("cpu").save_pretrained(tmp.name, safe_serialization=True)
+        model = tmp.name
+        args.dtype = "float32"
+    else:
+        import zimage_loop_from_file as zl
+        model = args.model or zl.MODEL_ID
+
+    summary = {}
+    try:
+        for mode in modes:
+            print(f">> {mode}：启动 {args.workers} 个 worker ...")
+            rows = run_mode(mode, args, model)
+            for r in rows:
+                print(f"   worker {r['rank']}: 就绪 {r['ready_s']:.2f}s（导入 torch {r['torch_import_s']:.2f}s，"
+                      f"加载 {r['load_s']:.2f}s），RSS {r['rss_mb']} MB，PSS {r['pss_mb']} MB")
+            pss = [r["pss_mb"] for r in rows if r["pss_mb"] is not None]
+            summary[mode] = {
+                "workers": rows,
+                "max_ready_s": max(r["ready_s"] for r in rows),
+                "total_pss_mb": round(sum(pss), 1) if pss else None,
+            }
+            print(f"   最慢就绪 {summary[mode]['max_ready_s']:.2f}s，PSS 合计 {summary[mode]['total_pss_mb']} MB")
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({"model": args.model or ("tiny" if args.tiny else model), "summary": summary}, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {args.out}")
+
+if __name__ == "__main__":
+    main()
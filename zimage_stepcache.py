@@ -0,0 +1,269 @@
+"""
+DiT 逐步特征缓存（TeaCache / DeepCache 思路），针对 Turbo 的 9 步调度。
+
+相邻去噪步的中间激活高度相似。StepCache 挂在 pipe.transformer 上：
+- 每次 transformer 前向时，计算输入潜变量相对上一步的相对 L1 变化并累加
+- 累计变化低于 threshold 时本步"跳过"：首尾两个 block 照常计算，
+  中间 block 不计算，直接用上一次完整计算时缓存的 block 残差（输出 - 输入）；
+  mode="extrapolate" 时用最近两次完整计算的残差做线性外推
+- 前 warmup_steps 步总是完整计算，连续跳过不超过 max_consecutive 步
+同一时刻只跟踪一次生成；交替推进多次生成时用 save_state() / load_state() 切换。
+每次生成都会留下逐步报告（变化量、累计量、是否跳过），
+compare() 用同一种子对比开/关缓存的输出，给出 PSNR（装有 lpips 时另给 LPIPS）与加速比。
+
+用法（CPU 上用随机初始化的极小模型自测）：
+    python zimage_stepcache.py --tiny --device cpu --threshold 0.1
+"""
+import argparse
+import math
+import time
+
+import torch
+
+BLOCK_LIST_NAMES = ("layers", "transformer_blocks", "blocks")
+
+
+def _flatten_input(x):
+    if isinstance(x, (list, tuple)):
+        return torch.cat([t.detach().float().flatten() for t in x])
+    return x.detach().float().flatten()
+
+def _timestep_value(t):
+    if torch.is_tensor(t):
+        return float(t.flatten()[0])
+    return float(t)
+
+
+class StepCache:
+    def __init__(self, transformer, threshold: float = 0.1, mode: str = "reuse",
+                 warmup_steps: int = 1, max_consecutive: int = 2):
+        if mode not in ("reuse", "extrapolate"):
+            raise ValueError(f"unknown mode: {mode}")
+        self.transformer = transformer
+        self.threshold = threshold
+        self.mode = mode
+        self.warmup_steps = warmup_steps
+        self.max_consecutive = max_consecutive
+        self.enabled = True
+
+        self.blocks = None
+        for name in BLOCK_LIST_NAMES:
+            blocks = getattr(transformer, name, None)
+            if blocks is not None and len(blocks) >= 3:
+                self.blocks = blocks
+                break
+        if self.blocks is None:
+            raise ValueError("transformer 没有可缓存的 block 列表（至少需要 3 个 block）")
+
+        self._handles = []
+        self._originals = {}
+        self.reports = []              # 每次生成一份逐步报告
+        self.reset()
+        self._install()
+
+    # ----- 状态 -----
+    def reset(self):
+        """开始新的一次生成（检测到时间步回退时也会自动调用）"""
+        self.step = 0
+        self.skipping = False
+        self._prev_input = None
+        self._prev_t = None
+        self._accumulated = 0.0
+        self._consecutive = 0
+        self._residuals = {}           # block 序号 -> [(step, residual), ...]（最多两个）
+        self.report = []
+        self.reports.append(self.report)
+        del self.reports[:-20]
+
+    _STATE_FIELDS = ("step", "_prev_input", "_prev_t", "_accumulated", "_consecutive", "_residuals", "report")
+
+    def save_state(self) -> dict:
+        """当前这次生成的缓存状态；交替推进多个生成（如 zimage_preempt）时每个生成各存一份"""
+        return {name: getattr(self, name) for name in self._STATE_FIELDS}
+
+    def load_state(self, state: dict):
+        """恢复 save_state() 保存的状态，继续那次生成"""
+        for name in self._STATE_FIELDS:
+            setattr(self, name, state[name])
+        self.skipping = False
+
+    def _install(self):
+        self._handles.append(self.transformer.register_forward_pre_hook(self._before_forward, with_kwargs=True))
+        self._handles.append(self.transformer.register_forward_hook(self._after_forward))
+        # 首尾 block 每步都计算，只缓存中间的
+        for index in range(1, len(self.blocks) - 1):
+            block = self.blocks[index]
+            self._originals[index] = block.forward
+            block.forward = self._wrap_block(index, block.forward)
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        for index, original in self._originals.items():
+            self.blocks[index].__dict__.pop("forward", None)
+        self._handles = []
+        self._originals = {}
+
+    # ----- 每步决策 -----
+    def _before_forward(self, module, args, kwargs):
+        if not self.enabled:
+            self.skipping = False
+            return None
+        x = args[0] if args else kwargs.get("x", kwargs.get("hidden_states"))
+        t = args[1] if len(args) > 1 else kwargs.get("t", kwargs.get("timestep"))
+        t_value = _timestep_value(t) if t is not None else None
+
+        # Z-Image 的归一化时间步单调增加；回退说明开始了新的一次生成
+        if self._prev_t is not None and t_value is not None and t_value <= self._prev_t:
+            self.reset()
+
+        current = _flatten_input(x)
+        change = None
+        if self._prev_input is not None and self._prev_input.shape == current.shape:
+            change = float((current - self._prev_input).abs().mean() / (self._prev_input.abs().mean() + 1e-8))
+            self._accumulated += change
+        self._prev_input = current
+        self._prev_t = t_value
+
+        can_skip = (
+            change is not None
+            and self.step >= self.warmup_steps
+            and self._consecutive < self.max_consecutive
+            and len(self._residuals) == len(self._originals)
+            and self._accumulated < self.threshold
+        )
+        self.skipping = can_skip
+        if can_skip:
+            self._consecutive += 1
+        else:
+            self._consecutive = 0
+            self._accumulated = 0.0
+        self.report.append({
+            "step": self.step,
+            "change": None if change is None else round(change, 5),
+            "skipped": can_skip,
+        })
+        return None
+
+    def _after_forward(self, module, args, output):
+        self.step += 1
+        self.skipping = False
+        return None
+
+    def _cached_residual(self, index: int):
+        history = self._residuals[index]
+        step, residual = history[-1]
+        if self.mode == "extrapolate" and len(history) == 2:
+            step0, residual0 = history[0]
+            return residual + (residual - residual0) * ((self.step - step) / max(step - step0, 1))
+        return residual
+
+    def _wrap_block(self, index: int, forward):
+        def cached_forward(*args, **kwargs):
+            x = args[0] if args else next(iter(kwargs.values()))
+            if self.skipping and index in self._residuals:
+                return x + self._cached_residual(index)
+            out = forward(*args, **kwargs)
+            if self.enabled and torch.is_tensor(out) and out.shape == x.shape:
+                history = self._residuals.setdefault(index, [])
+                history.append((self.step, (out - x).detach()))
+                del history[:-2]
+            return out
+
+        return cached_forward
+
+    # ----- 报告 -----
+    def last_report(self):
+        """最近一次完成的生成的逐步报告"""
+        for report in reversed(self.reports):
+            if report:
+                return report
+        return []
+
+    def summary(self) -> str:
+        report = self.last_report()
+        skipped = [r["step"] for r in report if r["skipped"]]
+        return f"步缓存：{len(report)} 步中跳过 {len(skipped)} 步 {skipped}（threshold={self.threshold}, mode={self.mode}）"
+
+
+def enable_step_cache(transformer, **kwargs) -> StepCache:
+    cache = StepCache(transformer, **kwargs)
+    transformer._zimage_step_cache = cache
+    return cache
+
+def step_cache_of(transformer):
+    return getattr(transformer, "_zimage_step_cache", None)
+
+# ----- 质量检查 -----
+def psnr(a, b) -> float:
+    """a、b 为 [0, 1] 范围的同形状数组/张量"""
+    a = torch.as_tensor(a, dtype=torch.float64)
+    b = torch.as_tensor(b, dtype=torch.float64)
+    mse = float(((a - b) ** 2).mean())
+    return float("inf") if mse == 0 else 10 * math.log10(1.0 / mse)
+
+def lpips_distance(a, b):
+    """装有 lpips 包时返回 LPIPS 距离，否则返回 None"""
+    try:
+        import lpips
+    except ImportError:
+        return None
+    metric = lpips.LPIPS(net="alex", verbose=False)
+    to_t = lambda x: torch.as_tensor(x, dtype=torch.float32).permute(0, 3, 1, 2) * 2 - 1
+    with torch.no_grad():
+        return float(metric(to_t(a), to_t(b)).mean())
+
+def compare(pipe, cache: StepCache, prompt: str, width: int, height: int, steps: int = 9, seed: int = 42, device: str = "cpu"):
+    """同一种子分别在关闭/开启缓存时生成，返回质量差异、加速比和逐步报告"""
+    def run():
+        t0 = time.perf_counter()
+        images = pipe(
+            prompt=prompt, width=width, height=height, num_inference_steps=steps, guidance_scale=0.0,
+            generator=torch.Generator(device).manual_seed(seed), output_type="np",
+        ).images
+        return images, time.perf_counter() - t0
+
+    cache.enabled = False
+    baseline, t_base = run()
+    cache.enabled = True
+    cache.reset()
+    cached, t_cached = run()
+    return {
+        "psnr": round(psnr(baseline, cached), 3),
+        "lpips": lpips_distance(baseline, cached),
+        "baseline_s": round(t_base, 4),
+        "cached_s": round(t_cached, 4),
+        "speedup": round(t_base / t_cached, 3) if t_cached else None,
+        "steps": cache.last_report(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Step-to-step DiT feature cache quality/speed check")
+    parser.add_argument("--tiny", action="store_true", help="使用随机初始化的极小模型（CPU 自测）")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--mode", default="reuse", choices=["reuse", "extrapolate"])
+    parser.add_argument("--size", default=None, help="宽x高，默认 tiny 为 64x64，否则 1024x1024")
+    parser.add_argument("--steps", type=int, default=9)
+    parser.add_argument("--prompt", default="A cute shiba inu astronaut floating in space, detailed illustration.")
+    args = parser.parse_args()
+
+    if args.tiny:
+        from zimage_tiny import build_tiny_pipeline
+        pipe = build_tiny_pipeline(args.device, n_layers=4)   # 首尾之外至少要有一个可缓存的 block
+        size = args.size or "64x64"
+    else:
+        from zimage_loop_from_file import load_pipeline
+        pipe = load_pipeline(args.device)
+        size = args.size or "1024x1024"
+    width, height = (int(v) for v in size.lower().split("x"))
+
+    cache = enable_step_cache(pipe.transformer, threshold=args.threshold, mode=args.mode)
+    result = compare(pipe, cache, args.prompt, width, height, args.steps, device=args.device)
+    for r in result["steps"]:
+        print(f"  step {r['step']}: change={r['change']}  {'跳过' if r['skipped'] else '计算'}")
+    print(f"PSNR {result['psnr']} dB, LPIPS {result['lpips']}, "
+          f"{result['baseline_s']}s -> {result['cached_s']}s（{result['speedup']}x）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+不依赖模型权重的 ZImagePipeline 替身，用于在 CPU 上测试调度/批处理逻辑。
+
+StubPipeline 接受与 ZImagePipeline.__call__ 相同的主要参数，
+把每次调用的形状记录在 self.calls 中，并返回纯色图片：
+颜色由 prompt 决定，因此可以校验图片是否映射回了正确的 prompt。
+output_type 支持 "pil"（默认）、"np" 和 "pt"，可以在没有模型时测试张量后处理路径。
+"""
+import hashlib
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+
+def prompt_color(prompt: str):
+    """由 prompt 内容得到一个确定的 RGB 颜色"""
+    digest = hashlib.md5(prompt.encode("utf-8")).digest()
+    return digest[0], digest[1], digest[2]
+
+
+class StubPipeline:
+    def __init__(self, delay: float = 0.0):
+        # delay：每次调用额外 sleep 的秒数，用于模拟推理耗时
+        self.delay = delay
+        self.device = "cpu"
+        self.calls = []
+
+    def to(self, device):
+        self.device = str(device)
+        return self
+
+    def set_progress_bar_config(self, **kwargs):
+        pass
+
+    def __call__(
+        self,
+        prompt=None,
+        height=1024,
+        width=1024,
+        num_inference_steps=9,
+        guidance_scale=0.0,
+        generator=None,
+        num_images_per_prompt=1,
+        output_type="pil",
+        **kwargs,
+    ):
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt or [])
+        self.calls.append({
+            "batch_size": len(prompts),
+            "num_images_per_prompt": num_images_per_prompt,
+            "width": width,
+            "height": height,
+            "num_inference_steps": num_inference_steps,
+            "prompts": prompts,
+        })
+        if self.delay:
+            time.sleep(self.delay)
+
+        colors = [prompt_color(p) for p in prompts for _ in range(num_images_per_prompt)]
+        if output_type in ("np", "pt"):
+            # 与 diffusers 一致：np 为 (B, H, W, 3)，pt 为 (B, 3, H, W)，取值 [0, 1]
+            import numpy as np
+            images = np.broadcast_to(
+                np.array(colors, dtype=np.float32).reshape(-1, 1, 1, 3) / 255.0,
+                (len(colors), height, width, 3),
+            ).copy()
+            if output_type == "pt":
+                import torch
+                images = torch.from_numpy(images).permute(0, 3, 1, 2)
+            return SimpleNamespace(images=images)
+        return SimpleNamespace(images=[Image.new("RGB", (width, height), color) for color in colors])
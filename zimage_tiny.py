@@ -0,0 +1,80 @@
+"""
+随机初始化的极小 ZImagePipeline，结构与 Z-Image-Turbo 相同但参数量很小。
+
+用于在只有 CPU 的 CI 中跑通基准测试框架、特征缓存、调度器等需要真实
+transformer/VAE 前向的代码，不下载 Z-Image 权重（只下载一个极小的测试 tokenizer）。
+配置参照 diffusers 中 Z-Image pipeline 的单元测试。
+"""
+import torch
+from diffusers import (
+    AutoencoderKL,
+    FlowMatchEulerDiscreteScheduler,
+    ZImagePipeline,
+    ZImageTransformer2DModel,
+)
+from transformers import Qwen2Tokenizer, Qwen3Config, Qwen3Model
+
+TINY_TOKENIZER_ID = "hf-internal-testing/tiny-random-Qwen2VLForConditionalGeneration"
+
+
+def build_tiny_transformer(seed: int = 0, n_layers: int = 2):
+    torch.manual_seed(seed)
+    return ZImageTransformer2DModel(
+        all_patch_size=(2,),
+        all_f_patch_size=(1,),
+        in_channels=16,
+        dim=32,
+        n_layers=n_layers,
+        n_refiner_layers=1,
+        n_heads=2,
+        n_kv_heads=2,
+        norm_eps=1e-5,
+        qk_norm=True,
+        cap_feat_dim=16,
+        rope_theta=256.0,
+        t_scale=1000.0,
+        axes_dims=[8, 4, 4],
+        axes_lens=[256, 32, 32],
+    )
+
+def build_tiny_pipeline(device: str = "cpu", dtype=torch.float32, seed: int = 0, n_layers: int = 2):
+    """构建极小的随机 ZImagePipeline；生成尺寸需为 16 的倍数（如 64x64）"""
+    transformer = build_tiny_transformer(seed, n_layers)
+
+    torch.manual_seed(seed)
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        block_out_channels=[32, 64],
+        layers_per_block=1,
+        latent_channels=16,
+        norm_num_groups=32,
+        sample_size=32,
+        scaling_factor=0.3611,
+        shift_factor=0.1159,
+    )
+
+    torch.manual_seed(seed)
+    text_encoder = Qwen3Model(Qwen3Config(
+        hidden_size=16,
+        intermediate_size=16,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        vocab_size=151936,
+        max_position_embeddings=512,
+    ))
+    tokenizer = Qwen2Tokenizer.from_pretrained(TINY_TOKENIZER_ID)
+
+    pipe = ZImagePipeline(
+        scheduler=FlowMatchEulerDiscreteScheduler(),
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        transformer=transformer,
+    )
+    pipe.to(device, dtype)
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
@@ -0,0 +1,155 @@
+"""
+监视模式：不再需要按回车，prompts.txt 保存后自动增量生成。
+
+- 轮询 PROMPT_FILE 的 mtime/size 检测改动（不依赖 inotify，跨平台）
+- 每条任务以 (prompt, 尺寸, 步数, 种子) 的哈希为键，与 manifest 对比，
+  只生成新增或修改过的行；改一行只花一次生成的时间
+- manifest 保存在 OUTPUT_DIR 下，重启后已完成的任务不会重复生成
+
+用法：python zimage_watch.py
+"""
+import hashlib
+import json
+import os
+import time
+
+from zimage_loop_from_file import (
+    PROMPT_FILE,
+    OUTPUT_DIR,
+    NUM_STEPS,
+    SEED,
+    load_prompts,
+    load_pipeline,
+    make_embed_cache,
+    make_writer,
+    make_batches,
+    generate_batch,
+    save_results,
+)
+
+# ===== 配置区域 =====
+MANIFEST_FILE = os.path.join(OUTPUT_DIR, "manifest.json")
+POLL_INTERVAL = 1.0                # 检查文件改动的间隔（秒）
+# ====================
+
+
+def item_key(item) -> str:
+    """任务内容哈希：prompt + 尺寸 + 步数 + 种子（+ 单独指定的张数），任一改变都视为新任务"""
+    fields = [
+        item["prompt"],
+        item.get("out_width", item["width"]),
+        item.get("out_height", item["height"]),
+        item.get("steps", NUM_STEPS),
+        item.get("seed", SEED),
+    ]
+    if "count" in item:
+        fields.append(item["count"])
+    payload = json.dumps(fields, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def load_manifest(path: str = MANIFEST_FILE):
+    """读取 manifest：{ key: {"prompt", "size", "files", "time"} }；不存在或损坏时返回空表"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] manifest 读取失败，将重新开始：{e}")
+        return {}
+
+def save_manifest(manifest, path: str = MANIFEST_FILE):
+    """先写临时文件再替换，进程中途被杀也不会留下半个 manifest"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+def pending_items(items, manifest):
+    """返回 manifest 中没有记录的任务（同一轮内重复的行只保留一条）"""
+    pending = []
+    seen = set()
+    for item in items:
+        key = item_key(item)
+        if key in manifest or key in seen:
+            continue
+        seen.add(key)
+        pending.append(item)
+    return pending
+
+def file_signature(path: str):
+    """(mtime_ns, size)；文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def run_pending(pipe, manifest, embed_cache=None, writer=None):
+    items = load_prompts(PROMPT_FILE)
+    pending = pending_items(items, manifest)
+    if not pending:
+        print(f"[watch] {len(items)} 条任务均已生成，无需处理。")
+        return
+
+    print(f"\n[watch] 共 {len(items)} 条任务，其中 {len(pending)} 条新增/修改，开始生成：\n")
+    for batch in make_batches(pending):
+        for item in batch:
+            print(f"  prompt: {item['prompt']}")
+        print(f"    size: {batch[0]['width']}x{batch[0]['height']}")
+
+        t0 = time.time()
+        results = generate_batch(pipe, batch, embed_cache=embed_cache)
+        t1 = time.time()
+        paths = save_results(results, writer=writer)
+        failures = {}
+        if writer is not None:
+            # 写盘完成后才能记入 manifest；同一批的多张图仍在后台并行编码
+            failures = writer.flush()
+        t2 = time.time()
+
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        for item in batch:
+            files = [p for (it, _, _), p in zip(results, paths) if it is item]
+            failed = [p for p in files if p in failures]
+            if failed:
+                # 不记入 manifest：下次 prompt 文件变动时会重新生成
+                print(f"[WARN] {item['prompt']}：{len(failed)} 张写盘失败，未记入 manifest")
+                continue
+            manifest[item_key(item)] = {
+                "prompt": item["prompt"],
+                "size": f"{item.get('out_width', item['width'])}x{item.get('out_height', item['height'])}",
+                "files": files,
+                "time": now,
+            }
+        # 每批完成后立即落盘，中断后已完成的部分不会重做
+        save_manifest(manifest)
+        print(f"生成用时 {t1 - t0:.2f} 秒，写盘 {t2 - t1:.2f} 秒\n")
+
+def main():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    pipe = load_pipeline()
+    embed_cache = make_embed_cache(pipe)
+    writer = make_writer()
+    manifest = load_manifest()
+    print(f">> manifest 中已有 {len(manifest)} 条完成记录：{MANIFEST_FILE}")
+    print(f">> 正在监视 {PROMPT_FILE}（每 {POLL_INTERVAL} 秒检查一次），Ctrl-C 退出。")
+
+    last_sig = None
+    try:
+        while True:
+            sig = file_signature(PROMPT_FILE)
+            if sig is not None and sig != last_sig:
+                last_sig = sig
+                run_pending(pipe, manifest, embed_cache, writer)
+                # 生成期间文件可能又被修改，重新取一次签名交给下一轮比较
+                continue
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("\n退出监视模式。")
+    finally:
+        if writer is not None:
+            writer.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+多进程/多设备分片执行 prompts.txt。
+
+协调进程解析 load_prompts() 并按尺寸打包成批（make_batches），逐个派发给空闲的 worker；
+N 个 worker 进程各自在分配的设备上加载一份 pipeline，从自己的管道取任务、生成并保存，
+再把结果路径、错误和耗时经同一条管道发回协调进程。
+worker 中途崩溃时，它正在处理的任务会被重新放回队列（最多 MAX_RETRIES 次）。
+
+用法：
+    python zimage_workers.py                          # 使用 WORKER_DEVICES
+    python zimage_workers.py --devices cuda:0,cuda:1
+    python zimage_workers.py --devices cpu,cpu --stub # 无 GPU 时测试调度与容错
+"""
+import argparse
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import time
+import traceback
+from collections import deque
+
+import zimage_loop_from_file as zl
+
+# ===== 配置区域 =====
+WORKER_DEVICES = ["cuda:0"]        # 每个元素启动一个 worker，可重复（如 ["cpu", "cpu"]）
+MAX_RETRIES = 1                    # worker 崩溃时任务重新入队的次数
+# ====================
+
+
+def worker_main(worker_id: int, device: str, use_stub: bool, conn):
+    """worker 进程入口：加载 pipeline，循环从自己的管道取任务直到收到 None"""
+    zl.USE_STUB = use_stub
+    try:
+        pipe = zl.load_pipeline(device)
+        embed_cache = zl.make_embed_cache(pipe)
+    except Exception:
+        conn.send(("load_error", None, traceback.format_exc()))
+        return
+    conn.send(("ready", None, device))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        task_id, batch = task
+        try:
+            t0 = time.time()
+            results = zl.generate_batch(pipe, batch, device=device, embed_cache=embed_cache)
+            t1 = time.time()
+            paths = zl.save_results(results)
+            t2 = time.time()
+            conn.send(("done", task_id, {
+                "paths": paths,
+                "gen_seconds": t1 - t0,
+                "write_seconds": t2 - t1,
+            }))
+        except Exception:
+            conn.send(("error", task_id, traceback.format_exc()))
+
+def run_sharded(items, devices, use_stub: bool = False, max_retries: int = MAX_RETRIES):
+    """
+    把 items 分给 len(devices) 个 worker 执行，阻塞到全部完成。
+    每个 worker 与协调进程之间一条独立管道（不共享锁，某个 worker 被杀不会卡住其他 worker）；
+    任务由协调进程逐个派发给空闲 worker，派发时即记录 worker -> 任务，
+    worker 崩溃时总能把它手上的任务放回待派发队列。
+    返回 {"done": {task_id: info}, "failed": {task_id: 错误信息}, "workers": {worker_id: 统计}}
+    """
+    ctx = mp.get_context("spawn")      # CUDA 不能在 fork 出的子进程里使用
+
+    tasks = dict(enumerate(zl.make_batches(items)))
+    pending = deque(tasks)
+
+    workers, conns = {}, {}
+    for worker_id, device in enumerate(devices):
+        parent_conn, child_conn = ctx.Pipe()
+        p = ctx.Process(
+            target=worker_main,
+            args=(worker_id, device, use_stub, child_conn),
+            daemon=True,
+        )
+        p.start()
+        child_conn.close()             # 只留 worker 持有写端，worker 退出后这里才能读到 EOF
+        workers[worker_id] = p
+        conns[worker_id] = parent_conn
+
+    stats = {wid: {"device": dev, "tasks": 0, "images": 0, "gen_seconds": 0.0} for wid, dev in enumerate(devices)}
+    in_flight = {}                     # worker_id -> task_id
+    idle = []                          # 已就绪、手上没有任务的 worker
+    retries = {}
+    done, failed = {}, {}
+    dead = set()
+
+    def handle(worker_id, kind, task_id, payload):
+        if kind == "ready":
+            print(f"[worker {worker_id}] ready on {payload}")
+            idle.append(worker_id)
+        elif kind == "load_error":
+            print(f"[ERROR] worker {worker_id} 加载 pipeline 失败：\n{payload}")
+        elif kind == "done":
+            in_flight.pop(worker_id, None)
+            idle.append(worker_id)
+            done[task_id] = payload
+            s = stats[worker_id]
+            s["tasks"] += 1
+            s["images"] += len(payload["paths"])
+            s["gen_seconds"] += payload["gen_seconds"]
+            print(
+                f"[worker {worker_id}] 任务 {task_id} 完成：{len(payload['paths'])} 张，"
+                f"生成 {payload['gen_seconds']:.2f} 秒，写盘 {payload['write_seconds']:.2f} 秒"
+                f"（{len(done) + len(failed)}/{len(tasks)}）"
+            )
+        elif kind == "error":
+            in_flight.pop(worker_id, None)
+            idle.append(worker_id)
+            failed[task_id] = payload
+            print(f"[ERROR] worker {worker_id} 任务 {task_id} 失败：\n{payload}")
+
+    def mark_dead(worker_id):
+        p = workers[worker_id]
+        p.join(timeout=5)
+        dead.add(worker_id)
+        task_id = in_flight.pop(worker_id, None)
+        if task_id is None:
+            return
+        print(f"[WARN] worker {worker_id} 意外退出（exitcode={p.exitcode}）")
+        retries[task_id] = retries.get(task_id, 0) + 1
+        if retries[task_id] <= max_retries:
+            print(f"[WARN] 任务 {task_id} 重新入队（第 {retries[task_id]} 次重试）")
+            pending.appendleft(task_id)
+        else:
+            failed[task_id] = f"worker {worker_id} crashed (exitcode={p.exitcode})"
+
+    while len(done) + len(failed) < len(tasks):
+        # 把任务派给空闲 worker，派发前先记录归属
+        while idle and pending:
+            worker_id = idle.pop()
+            if worker_id in dead:
+                continue
+            task_id = pending.popleft()
+            in_flight[worker_id] = task_id
+            try:
+                conns[worker_id].send((task_id, tasks[task_id]))
+            except OSError:
+                mark_dead(worker_id)
+
+        live = {conns[wid]: wid for wid in workers if wid not in dead}
+        if not live:
+            for task_id in tasks:
+                if task_id not in done and task_id not in failed:
+                    failed[task_id] = "no live workers left"
+            break
+
+        # 先读完管道里的全部消息；读到 EOF 才说明 worker 已退出，此时它发出的结果都已处理
+        for conn in mp.connection.wait(list(live), timeout=1.0):
+            worker_id = live[conn]
+            try:
+                while conn.poll():
+                    handle(worker_id, *conn.recv())
+            except (EOFError, OSError):
+                mark_dead(worker_id)
+
+    for worker_id, conn in conns.items():
+        if worker_id not in dead:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+    for p in workers.values():
+        p.join(timeout=30)
+        if p.is_alive():
+            p.terminate()
+    for conn in conns.values():
+        conn.close()
+
+    return {"done": done, "failed": failed, "workers": stats}
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded Z-Image generation over multiple workers")
+    parser.add_argument("--devices", default=",".join(WORKER_DEVICES), help="逗号分隔的设备列表，如 cuda:0,cuda:1 或 cpu,cpu")
+    parser.add_argument("--prompts", default=zl.PROMPT_FILE)
+    parser.add_argument("--stub", action="store_true", help="使用 StubPipeline，不加载模型")
+    args = parser.parse_args()
+
+    devices = [d.strip() for d in args.devices.split(",") if d.strip()]
+    os.makedirs(zl.OUTPUT_DIR, exist_ok=True)
+    items = zl.load_prompts(args.prompts)
+    if not items:
+        print(f"[WARN] 没有在 {args.prompts} 中读到有效内容。")
+        return
+
+    print(f">> {len(items)} 条任务，{len(devices)} 个 worker：{devices}")
+    t0 = time.time()
+    report = run_sharded(items, devices, use_stub=args.stub)
+    elapsed = time.time() - t0
+
+    n_images = sum(len(info["paths"]) for info in report["done"].values())
+    print(f"\n完成 {len(report['done'])} 批，失败 {len(report['failed'])} 批；"
+          f"{n_images} 张，总用时 {elapsed:.2f} 秒（{n_images / max(elapsed, 1e-6):.2f} 张/秒）")
+    for worker_id, s in report["workers"].items():
+        print(f"  worker {worker_id} [{s['device']}]：{s['tasks']} 批，{s['images']} 张，生成 {s['gen_seconds']:.2f} 秒")
+
+if __name__ == "__main__":
+    main()
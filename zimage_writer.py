@@ -0,0 +1,225 @@
+"""
+后台图片写盘。
+
+PNG 压缩 1024x1360 的图片要花不少 CPU 时间，同步 image.save() 会推迟下一批的生成。
+AsyncImageWriter 把编码/写盘交给线程池（Pillow 编码时会释放 GIL，可以真正并行），
+排队数量有上限：队列满时 submit() 阻塞，避免生成速度快于写盘时内存无限增长。
+
+输出后端：
+- FileBackend：每张图一个文件（原有布局）
+- TarShardBackend：WebDataset 风格的滚动 tar 分片，每个样本为 <key>.<ext> + <key>.json，
+  分片达到上限大小后切换到下一个，适合生成数百万张图的数据集
+编码格式可选 PNG、无损 WebP 或指定质量的 JPEG。
+"""
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 格式名 -> (PIL 格式, 扩展名, 额外参数)
+FORMATS = {
+    "png": ("PNG", ".png", {}),
+    "webp": ("WEBP", ".webp", {"lossless": True}),
+    "jpeg": ("JPEG", ".jpg", {}),
+}
+
+
+def format_ext(fmt: str) -> str:
+    return FORMATS[fmt][1]
+
+def as_pil(image):
+    """PIL 图片原样返回；uint8 的 (H, W, 3) ndarray（张量后处理路径）包装成 PIL，不拷贝像素"""
+    if hasattr(image, "save"):
+        return image
+    from PIL import Image
+    return Image.fromarray(image)
+
+def encode_image(image, fmt: str = "png", quality: int = 95) -> bytes:
+    """把 PIL 图片或 uint8 ndarray 编码为字节串"""
+    image = as_pil(image)
+    pil_format, _, kwargs = FORMATS[fmt]
+    if fmt == "jpeg":
+        kwargs = {"quality": quality}
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, format=pil_format, **kwargs)
+    return buf.getvalue()
+
+
+class FileBackend:
+    """每张图保存为一个文件，路径由调用方给出"""
+
+    def __init__(self, fmt: str = "png", quality: int = 95):
+        self.fmt = fmt
+        self.quality = quality
+
+    def write(self, image, path: str, meta=None) -> str:
+        if self.fmt == "png":
+            as_pil(image).save(path)
+        else:
+            with open(path, "wb") as f:
+                f.write(encode_image(image, self.fmt, self.quality))
+        return path
+
+    def close(self):
+        pass
+
+
+class TarShardBackend:
+    """
+    滚动 tar 分片：shard-000000.tar、shard-000001.tar ...
+    编码在调用线程中并行完成，只有追加到 tar 的部分加锁串行。
+    """
+
+    def __init__(self, out_dir: str, fmt: str = "png", quality: int = 95,
+                 max_bytes: int = 1024 ** 3, prefix: str = "shard"):
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._tar = None
+        self._shard_path = None
+        self._shard_bytes = 0
+        os.makedirs(out_dir, exist_ok=True)
+        # 接着已有的最大分片编号往后写；编号可能不连续（删过分片），按个数计会覆盖已有分片
+        existing = []
+        for n in os.listdir(out_dir):
+            number = n[len(prefix) + 1:-len(".tar")]
+            if n.startswith(prefix + "-") and n.endswith(".tar") and number.isdigit():
+                existing.append(int(number))
+        self._index = max(existing, default=-1) + 1
+
+    def _open_next(self):
+        if self._tar is not None:
+            self._tar.close()
+        self._shard_path = os.path.join(self.out_dir, f"{self.prefix}-{self._index:06d}.tar")
+        self._index += 1
+        self._tar = tarfile.open(self._shard_path, "w")
+        self._shard_bytes = 0
+
+    def _add(self, name: str, data: bytes, mtime: float):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        self._tar.addfile(info, io.BytesIO(data))
+        # 512 字节头 + 按 512 对齐的数据
+        self._shard_bytes += 512 + (len(data) + 511) // 512 * 512
+
+    def write(self, image, path: str, meta=None) -> str:
+        key = os.path.splitext(os.path.basename(path))[0].replace(".", "_")
+        data = encode_image(image, self.fmt, self.quality)
+        sidecar = json.dumps(meta or {}, ensure_ascii=False).encode("utf-8")
+        now = time.time()
+        with self._lock:
+            if self._tar is None or self._shard_bytes + len(data) + len(sidecar) > self.max_bytes:
+                self._open_next()
+            self._add(key + format_ext(self.fmt), data, now)
+            self._add(key + ".json", sidecar, now)
+            # 调用方（如 zimage_jobs 的 journal）拿到位置后就会记为完成，先确保样本已落盘
+            self._tar.fileobj.flush()
+            os.fsync(self._tar.fileobj.fileno())
+            return f"{self._shard_path}:{key}{format_ext(self.fmt)}"
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._tar.close()
+                self._tar = None
+
+
+class AsyncImageWriter:
+    def __init__(self, max_workers: int = None, max_pending: int = 16, backend=None):
+        self.backend = backend or FileBackend()
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="img-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._futures = set()
+        self._failures = {}            # 自上次 flush() 以来写盘失败的 提交路径 -> 异常
+        self.written = 0
+        self.failed = 0
+        self.write_seconds = 0.0       # 各线程编码+写盘时间之和
+        self.blocked_seconds = 0.0     # 生成线程因队列满而等待的时间
+
+    def _write(self, image, path: str, on_done, meta):
+        t0 = time.time()
+        try:
+            path = self.backend.write(image, path, meta)
+            dt = time.time() - t0
+            with self._lock:
+                self.written += 1
+                self.write_seconds += dt
+            print(f"  -> 保存到 {path}（写盘 {dt:.2f} 秒）")
+            if on_done is not None:
+                on_done(None, path)
+            return dt
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self._failures[path] = e
+            print(f"[WARN] 保存失败：{path} ({e})")
+            if on_done is not None:
+                on_done(e, None)
+            raise
+        finally:
+            self._slots.release()
+
+    def submit(self, image, path: str, on_done=None, meta=None):
+        """
+        提交一张图片；队列已满时阻塞到有空位为止。返回 Future（结果为写盘秒数）。
+        path 的文件名（去掉扩展名）同时作为 tar 分片中的样本键，meta 写入 .json 附属文件。
+        on_done(error, location) 在写盘线程中、Future 完成之前调用：成功时 error 为 None、
+        location 为实际写入位置（文件路径或 "分片.tar:样本名"），因此 flush() 返回时所有 on_done 都已执行完。
+        """
+        t0 = time.time()
+        self._slots.acquire()
+        self.blocked_seconds += time.time() - t0
+
+        future = self._pool.submit(self._write, image, path, on_done, meta)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def flush(self) -> dict:
+        """
+        等待所有已提交的图片写完，返回自上次 flush() 以来写盘失败的 {提交时的 path: 异常}；
+        调用方据此决定哪些图片不能记为完成。
+        """
+        with self._lock:
+            pending = list(self._futures)
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass  # 已在 _write 中打印并记入 _failures
+        with self._lock:
+            failures, self._failures = self._failures, {}
+        return failures
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown(wait=True)
+        self.backend.close()
+
+    def summary(self) -> str:
+        return (
+            f"写盘：{self.written} 张（失败 {self.failed}），后台编码共 {self.write_seconds:.2f} 秒，"
+            f"{self.max_workers} 线程，生成线程因队列满等待 {self.blocked_seconds:.2f} 秒"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()